@@ -0,0 +1,151 @@
+'''
+Cache of DEM windows shared between runs and projects.
+
+The DEM is cut into cells of a fixed grid (CELL_PIXELS x CELL_PIXELS pixels, aligned to the origin of the CRS), and
+each cell that a target needs is written once to demCacheDir, under a key made of the DEM source, the pixel size and the
+CRS. The DEM of a target is then read from a VRT mosaic of its cached cells, so a rerun over the same targets (e.g. the
+same lakes every season), or another project nearby, does not read the source DEM again. Cells without data are
+remembered as well. When the cache grows over demCacheQuota GB, the least recently used cells are removed.
+'''
+import os, json, math, time, hashlib
+from scene_store import open_lock, remove_locked
+
+# Width and height of a cell in pixels
+CELL_PIXELS = 2048
+
+
+def source_signature(demSource):
+    '''
+    Identify a DEM source, so that cells are rebuilt when it changes.
+
+    Input:
+    - demSource (str) - Full path to a DEM raster or a folder of DEM tiles.
+
+    Output:
+    - signature (str) - Path, size and modification time of the raster, or of the newest tile and the number of tiles.
+    '''
+    demSource = os.path.abspath(demSource)
+    if not os.path.isdir(demSource):
+        stat = os.stat(demSource)
+        return f'{demSource}:{stat.st_size}:{int(stat.st_mtime)}'
+    count, newest = 0, 0
+    for root, _, names in os.walk(demSource):
+        for name in names:
+            count += 1
+            newest = max(newest, int(os.stat(os.path.join(root, name)).st_mtime))
+    return f'{demSource}:{count}:{newest}'
+
+
+def cache_folder(cacheDir, signature, pixelSize, crs):
+    '''
+    Folder of the cells of a DEM source at a pixel size and CRS.
+
+    Input:
+    - cacheDir (str) - Full path to the DEM cache.
+    - signature (str) - Output of source_signature.
+    - pixelSize (float) - Pixel size of the cells.
+    - crs (str) - CRS of the DEM, e.g. as WKT.
+
+    Output:
+    - folder (str) - Full path to the folder.
+    '''
+    key = hashlib.sha1(json.dumps([signature, pixelSize, crs]).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, key)
+
+
+def snap_bounds(bounds, pixelSize):
+    '''
+    Extend bounds outwards to the pixel grid of the cells, so that reading them needs no resampling.
+    '''
+    return (math.floor(bounds[0] / pixelSize) * pixelSize, math.floor(bounds[1] / pixelSize) * pixelSize,
+            math.ceil(bounds[2] / pixelSize) * pixelSize, math.ceil(bounds[3] / pixelSize) * pixelSize)
+
+
+def grid_cells(bounds, pixelSize):
+    '''
+    Cells of the grid that intersect an area.
+
+    Input:
+    - bounds (tuple) - xmin, ymin, xmax, ymax.
+    - pixelSize (float) - Pixel size of the cells.
+
+    Output:
+    - cells (list) - (column, row, cell bounds) of each cell. Rows grow northwards.
+    '''
+    size = CELL_PIXELS * pixelSize
+    cells = []
+    for row in range(int(math.floor(bounds[1] / size)), int(math.ceil(bounds[3] / size))):
+        for column in range(int(math.floor(bounds[0] / size)), int(math.ceil(bounds[2] / size))):
+            cells.append((column, row, (column * size, row * size, (column + 1) * size, (row + 1) * size)))
+    return cells
+
+
+def cached_cells(folder, bounds, pixelSize, build):
+    '''
+    Make sure that the cells of an area are in the cache, building the missing ones.
+
+    Input:
+    - folder (str) - Output of cache_folder.
+    - bounds (tuple) - xmin, ymin, xmax, ymax of the area.
+    - pixelSize (float) - Pixel size of the cells.
+    - build (function) - Writes the DEM of cell bounds to a path, returns False if the cell has no data.
+
+    Output:
+    - cells (list) - (full path, cell bounds) of the cells with data.
+    - built (int) - Number of cells that were built.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    cells = []
+    built = 0
+    for column, row, cell_bounds in grid_cells(bounds, pixelSize):
+        path = os.path.join(folder, f'{column}_{row}.tif')
+        empty = f'{path}.empty'
+        # Several runs may need the same cell, only one of them builds it
+        with open_lock(f'{path}.lock'):
+            if not os.path.exists(path) and not os.path.exists(empty):
+                built += 1
+                if not build(cell_bounds, path):
+                    open(empty, 'w').close()
+        if os.path.exists(path):
+            # Mark the cell as recently used
+            os.utime(path)
+            cells.append((path, cell_bounds))
+    return cells, built
+
+
+def evict(cacheDir, quota, minAge=3600):
+    '''
+    Remove the least recently used cells until the cache is within the quota. Cells used within minAge seconds may
+    be read by a running job, and are never removed.
+
+    Input:
+    - cacheDir (str) - Full path to the DEM cache.
+    - quota (float) - Size limit of the cache in GB, 0 for no limit.
+    - minAge (float) - Seconds since the last use before a cell can be removed.
+
+    Output:
+    - removed (int) - Number of removed cells.
+    '''
+    if quota <= 0 or not os.path.isdir(cacheDir):
+        return 0
+    cells = []
+    for root, _, names in os.walk(cacheDir):
+        for name in names:
+            if name.endswith('.tif'):
+                stat = os.stat(os.path.join(root, name))
+                cells.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for _, size, _ in cells)
+    removed = 0
+    now = time.time()
+    for used, size, path in sorted(cells):
+        if total <= quota * 1024**3 or now - used < minAge:
+            break
+        # A cell that is being read or rebuilt is left alone
+        lock = open_lock(f'{path}.lock', blocking=False)
+        if lock is None:
+            continue
+        with lock:
+            remove_locked(path)
+        total -= size
+        removed += 1
+    return removed
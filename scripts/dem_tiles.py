@@ -0,0 +1,211 @@
+'''
+DEM from a folder of DEM tiles.
+
+demSource can be a single raster (e.g. the national VRT at CSC) or a folder of GeoTIFF tiles, e.g. on a laptop or
+another cluster. For a folder, the footprints of the tiles are kept in an SQLite R*Tree index. Only tiles that are new or
+changed since the last run are opened, so the index is ready almost at once. For an area, the tiles that intersect it
+are found from the index and combined into a small VRT mosaic, which is then read like any other DEM.
+'''
+import os, sqlite3, hashlib, fcntl
+from contextlib import closing
+from xml.sax.saxutils import escape
+from dem_window import GDAL_TYPES
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tiles (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    size INTEGER,
+    mtime REAL,
+    width INTEGER,
+    height INTEGER,
+    bands INTEGER,
+    dtype TEXT,
+    nodata REAL,
+    crs TEXT,
+    x REAL,
+    y REAL,
+    pixel_x REAL,
+    pixel_y REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tile_bounds USING rtree (id, min_x, max_x, min_y, max_y);
+'''
+
+TILE_EXTENSIONS = ('.tif', '.tiff')
+
+
+def read_tile(path):
+    '''
+    Read the georeferencing of a tile.
+
+    Input:
+    - path (str) - Full path to the tile.
+
+    Output:
+    - tile (dict) - width, height, bands, dtype, nodata, crs (WKT), x and y of the upper left corner, pixel_x and
+      pixel_y (pixel width and height, both positive).
+    '''
+    import rasterio
+    with rasterio.open(path) as src:
+        return {'width': src.width, 'height': src.height, 'bands': src.count, 'dtype': src.dtypes[0],
+                'nodata': src.nodata, 'crs': src.crs.to_wkt(), 'x': src.transform.c, 'y': src.transform.f,
+                'pixel_x': src.transform.a, 'pixel_y': -src.transform.e}
+
+
+def index_path(cacheDir, directory):
+    '''
+    Location of the index of a tile folder.
+
+    Input:
+    - cacheDir (str) - Full path to the cache folder.
+    - directory (str) - Full path to the tile folder.
+
+    Output:
+    - indexPath (str) - Full path to the index.
+    '''
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()[:16]
+    return os.path.join(cacheDir, f'tile_index_{key}.sqlite')
+
+
+def update_tile_index(directory, indexPath, read=read_tile):
+    '''
+    Bring the index up to date with the tile folder: add new and changed tiles, and remove deleted ones.
+
+    Input:
+    - directory (str) - Full path to the tile folder, searched recursively.
+    - indexPath (str) - Full path to the index.
+    - read (function) - Reads the georeferencing of a tile, see read_tile.
+
+    Output:
+    - changed (int) - Number of tiles that were read.
+    '''
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(TILE_EXTENSIONS):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                files[path] = (stat.st_size, stat.st_mtime)
+
+    os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+    changed = 0
+    with closing(sqlite3.connect(indexPath, timeout=60)) as connection, connection:
+        connection.executescript(SCHEMA)
+        indexed = {path: (size, mtime, id) for id, path, size, mtime in
+                   connection.execute('SELECT id, path, size, mtime FROM tiles')}
+        for path, (size, mtime, id) in indexed.items():
+            if files.get(path) != (size, mtime):
+                connection.execute('DELETE FROM tiles WHERE id = ?', (id,))
+                connection.execute('DELETE FROM tile_bounds WHERE id = ?', (id,))
+        for path, (size, mtime) in files.items():
+            if indexed.get(path, (None, None))[:2] == (size, mtime):
+                continue
+            tile = read(path)
+            cursor = connection.execute('''
+                INSERT INTO tiles (path, size, mtime, width, height, bands, dtype, nodata, crs, x, y, pixel_x, pixel_y)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (path, size, mtime, tile['width'], tile['height'], tile['bands'], tile['dtype'], tile['nodata'],
+                 tile['crs'], tile['x'], tile['y'], tile['pixel_x'], tile['pixel_y']))
+            connection.execute('INSERT INTO tile_bounds VALUES (?, ?, ?, ?, ?)',
+                               (cursor.lastrowid, tile['x'], tile['x'] + tile['width'] * tile['pixel_x'],
+                                tile['y'] - tile['height'] * tile['pixel_y'], tile['y']))
+            changed += 1
+    return changed
+
+
+def find_tiles(indexPath, bounds):
+    '''
+    Find the tiles that intersect an area.
+
+    Input:
+    - indexPath (str) - Full path to the index.
+    - bounds (tuple) - xmin, ymin, xmax, ymax in the CRS of the tiles.
+
+    Output:
+    - tiles (list) - Dictionaries with the path and georeferencing of each tile, see read_tile.
+    '''
+    with closing(sqlite3.connect(indexPath, timeout=60)) as connection:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute('''
+            SELECT tiles.* FROM tiles JOIN tile_bounds ON tile_bounds.id = tiles.id
+            WHERE tile_bounds.max_x > ? AND tile_bounds.min_x < ? AND tile_bounds.max_y > ? AND tile_bounds.min_y < ?
+            ORDER BY tiles.path''', (bounds[0], bounds[2], bounds[1], bounds[3]))
+        return [dict(row) for row in rows]
+
+
+def mosaic_vrt(tiles, vrtPath):
+    '''
+    Write a VRT that mosaics tiles on the grid of the finest tile. The tiles need to share their CRS and data type.
+
+    Input:
+    - tiles (list) - Output of find_tiles.
+    - vrtPath (str) - Full path to the VRT that is written.
+    '''
+    pixel = min(min(tile['pixel_x'], tile['pixel_y']) for tile in tiles)
+    x = min(tile['x'] for tile in tiles)
+    y = max(tile['y'] for tile in tiles)
+    right = max(tile['x'] + tile['width'] * tile['pixel_x'] for tile in tiles)
+    bottom = min(tile['y'] - tile['height'] * tile['pixel_y'] for tile in tiles)
+    width = int(round((right - x) / pixel))
+    height = int(round((y - bottom) / pixel))
+    first = tiles[0]
+    nodata = first['nodata'] if first['nodata'] is not None else -9999
+
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+             f'  <SRS>{escape(first["crs"])}</SRS>',
+             f'  <GeoTransform>{x!r}, {pixel!r}, 0.0, {y!r}, 0.0, {-pixel!r}</GeoTransform>']
+    for band in range(1, first['bands'] + 1):
+        lines += [f'  <VRTRasterBand dataType="{GDAL_TYPES[first["dtype"]]}" band="{band}">',
+                  f'    <NoDataValue>{nodata}</NoDataValue>']
+        for tile in tiles:
+            # Coarser tiles are scaled to the grid of the mosaic
+            lines += ['    <ComplexSource resampling="average">',
+                      f'      <SourceFilename relativeToVRT="0">{escape(os.path.abspath(tile["path"]))}</SourceFilename>',
+                      f'      <SourceBand>{band}</SourceBand>',
+                      f'      <SrcRect xOff="0" yOff="0" xSize="{tile["width"]}" ySize="{tile["height"]}"/>',
+                      f'      <DstRect xOff="{(tile["x"] - x) / pixel!r}" yOff="{(y - tile["y"]) / pixel!r}" '
+                      f'xSize="{tile["width"] * tile["pixel_x"] / pixel!r}" ySize="{tile["height"] * tile["pixel_y"] / pixel!r}"/>']
+            if tile['nodata'] is not None:
+                lines.append(f'      <NODATA>{tile["nodata"]}</NODATA>')
+            lines.append('    </ComplexSource>')
+        lines.append('  </VRTRasterBand>')
+    lines.append('</VRTDataset>')
+    os.makedirs(os.path.dirname(vrtPath), exist_ok=True)
+    temporary = f'{vrtPath}.tmp'
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, vrtPath)
+
+
+def dem_source(demSource, bounds, cacheDir, read=read_tile):
+    '''
+    Raster to read the DEM of an area from.
+
+    Input:
+    - demSource (str) - Full path to a DEM raster, or to a folder of DEM tiles.
+    - bounds (tuple) - xmin, ymin, xmax, ymax in the CRS of the DEM.
+    - cacheDir (str) - Full path to the folder of the tile index and the mosaics.
+    - read (function) - See update_tile_index.
+
+    Output:
+    - source (str) - demSource itself if it is a raster, else a VRT mosaic of the tiles that intersect the area. None if
+      no tile intersects it.
+    '''
+    if not os.path.isdir(demSource):
+        return demSource
+    indexPath = index_path(cacheDir, demSource)
+    os.makedirs(cacheDir, exist_ok=True)
+    # Identifiers starting at the same time would index the same new tiles
+    with open(f'{indexPath}.lock', 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        changed = update_tile_index(demSource, indexPath, read)
+        if changed:
+            print(f'Indexed {changed} new or changed DEM tiles.')
+        tiles = find_tiles(indexPath, bounds)
+        if not tiles:
+            return None
+        key = hashlib.sha1(repr(sorted((tile['path'], tile['mtime']) for tile in tiles)).encode()).hexdigest()[:16]
+        vrtPath = os.path.join(cacheDir, f'mosaic_{key}.vrt')
+        if not os.path.exists(vrtPath):
+            mosaic_vrt(tiles, vrtPath)
+    return vrtPath
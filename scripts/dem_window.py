@@ -0,0 +1,90 @@
+'''
+Per-identifier DEMs as windows of a shared DEM.
+
+Without bulk download, download_dem.py runs once per identifier, and neighbouring targets have overlapping DEMs. With
+demSharing shared, the DEM of the union of all targets is written once (path/.cache/dem/shared_dem.tif), and each
+identifier gets <identifier>_dem.vrt: a small GDAL VRT that points to its window of the shared DEM, instead of a copy.
+Processing uses <identifier>_dem.tif if there is one, and the VRT otherwise.
+'''
+import os, math
+from xml.sax.saxutils import escape
+
+# numpy data types as GDAL data types
+GDAL_TYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32',
+              'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64'}
+
+
+def resolve_dem(pathToDem):
+    '''
+    Find the DEM of a target, a GeoTIFF or a VRT window of the shared DEM.
+
+    Input:
+    - pathToDem (str) - Full path to <identifier>_dem.tif.
+
+    Output:
+    - pathToDem (str) - The GeoTIFF if it exists, else the VRT if it exists, else the GeoTIFF path unchanged.
+    '''
+    vrt = f'{os.path.splitext(pathToDem)[0]}.vrt'
+    if not os.path.exists(pathToDem) and os.path.exists(vrt):
+        return vrt
+    return pathToDem
+
+
+def grid_window(bounds, origin, pixelSize, shape):
+    '''
+    Window of a grid that covers the bounds, extended outwards to whole pixels and clipped to the grid.
+
+    Input:
+    - bounds (tuple) - xmin, ymin, xmax, ymax.
+    - origin (tuple) - x and y of the upper left corner of the grid.
+    - pixelSize (float) - Pixel size of the grid.
+    - shape (tuple) - Height and width of the grid in pixels.
+
+    Output:
+    - window (tuple) - Column and row offsets, width and height in pixels.
+    '''
+    # Tolerate floating point noise before rounding outwards
+    left = max(int(math.floor((bounds[0] - origin[0]) / pixelSize + 1e-6)), 0)
+    top = max(int(math.floor((origin[1] - bounds[3]) / pixelSize + 1e-6)), 0)
+    right = min(int(math.ceil((bounds[2] - origin[0]) / pixelSize - 1e-6)), shape[1])
+    bottom = min(int(math.ceil((origin[1] - bounds[1]) / pixelSize - 1e-6)), shape[0])
+    return left, top, max(right - left, 0), max(bottom - top, 0)
+
+
+def window_vrt(sourcePath, vrtPath, window, origin, pixelSize, crsWkt, dtype, bands=1, nodata=-9999):
+    '''
+    Write a VRT of a window of a GeoTIFF. The source is referenced relative to the VRT, so the results folder can be moved.
+
+    Input:
+    - sourcePath (str) - Full path to the GeoTIFF.
+    - vrtPath (str) - Full path to the VRT that is written.
+    - window (tuple) - Output of grid_window.
+    - origin (tuple) - x and y of the upper left corner of the GeoTIFF.
+    - pixelSize (float) - Pixel size of the GeoTIFF.
+    - crsWkt (str) - CRS of the GeoTIFF as WKT.
+    - dtype (str) - numpy data type of the GeoTIFF, e.g. float32.
+    - bands (int) - Number of bands.
+    - nodata (float) - Nodata value.
+    '''
+    column, row, width, height = window
+    x = origin[0] + column * pixelSize
+    y = origin[1] - row * pixelSize
+    source = escape(os.path.relpath(sourcePath, os.path.dirname(os.path.abspath(vrtPath))))
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+             f'  <SRS>{escape(crsWkt)}</SRS>',
+             f'  <GeoTransform>{x!r}, {pixelSize!r}, 0.0, {y!r}, 0.0, {-pixelSize!r}</GeoTransform>']
+    for band in range(1, bands + 1):
+        lines += [f'  <VRTRasterBand dataType="{GDAL_TYPES[dtype]}" band="{band}">',
+                  f'    <NoDataValue>{nodata}</NoDataValue>',
+                  '    <SimpleSource>',
+                  f'      <SourceFilename relativeToVRT="1">{source}</SourceFilename>',
+                  f'      <SourceBand>{band}</SourceBand>',
+                  f'      <SrcRect xOff="{column}" yOff="{row}" xSize="{width}" ySize="{height}"/>',
+                  f'      <DstRect xOff="0" yOff="0" xSize="{width}" ySize="{height}"/>',
+                  '    </SimpleSource>',
+                  '  </VRTRasterBand>']
+    lines.append('</VRTDataset>')
+    temporary = f'{vrtPath}.tmp'
+    with open(temporary, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary, vrtPath)
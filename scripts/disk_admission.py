@@ -0,0 +1,123 @@
+'''
+Admission control of downloads by free disk space.
+
+The size of every product is known from the search results ('bytes'). A download only starts when the product fits in
+the free space of the file system, minus what the running downloads still need and minDiskSpace GB kept free. Besides
+the zip, space is held for unzipping it (spaceFactor times the zip in total), until it is given back by extracted().
+When streaming, processed scenes are removed (deleteUnprocessedImages), and the freed space lets the waiting downloads
+start. Processed zips in the scene store are removed when their space is needed. A download that still does not fit
+once nothing is downloading, unzipping or processing fails with ENOSPC instead of waiting forever.
+'''
+import os, errno, shutil, threading
+
+
+class DiskAdmission:
+    def __init__(self, path, spaceFactor=2.0, minFree=0, wait=False, poll=10, reclaim=None, busy=None):
+        '''
+        Input:
+        - path (str) - Full path to a folder on the file system the products are downloaded to.
+        - spaceFactor (float) - Space needed per byte of zip: 1 if the zips are not unzipped, 2 if they are.
+        - minFree (float) - Space in GB that is always left free.
+        - wait (bool) - Whether a product that does not fit even when nothing else is downloading waits for space to be
+          freed (streaming), or is skipped (all images are downloaded before any are processed).
+        - poll (float) - Seconds between checks of the free space while waiting.
+        - reclaim (function) - Called with a number of bytes, frees up to that much space that is no longer needed (e.g.
+          processed zips in the scene store), and returns the number of bytes freed. None if nothing can be reclaimed.
+        - busy (function) - Returns whether something that frees space when it finishes is still running (e.g. SNAP
+          processing). Without it, waiting ends once nothing is downloading or unzipping.
+        '''
+        self.path = path
+        self.spaceFactor = spaceFactor
+        self.minFree = minFree * 1024**3
+        self.wait = wait
+        self.poll = poll
+        self.reclaim = reclaim
+        self.busy = busy if busy is not None else lambda: False
+        # Zips being downloaded by their .part file, and the space held for unzipping
+        self.downloading = {}
+        self.held = 0
+        self.condition = threading.Condition()
+
+    def free_space(self):
+        '''
+        Free space in bytes that new downloads can use. The running downloads still need the part of their zip that is
+        not yet written.
+        '''
+        pending = 0
+        for partPath, size in self.downloading.items():
+            written = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+            pending += max(size - written, 0)
+        return shutil.disk_usage(self.path).free - pending - self.held - self.minFree
+
+    def acquire(self, size, partPath):
+        '''
+        Wait until a product fits, and reserve the space for it.
+
+        Input:
+        - size (int) - Size of the zip in bytes.
+        - partPath (str) - Full path to the .part file the zip is downloaded to.
+        '''
+        need = size * self.spaceFactor
+        name = os.path.basename(partPath)[:-len('.part')]
+        with self.condition:
+            waiting = False
+            while need > self.free_space():
+                if self.reclaim is not None and self.reclaim(need - self.free_space()) > 0:
+                    continue
+                # Nothing running could free the space
+                if not self.downloading and (not self.wait or not self.held and not self.busy()):
+                    raise OSError(errno.ENOSPC, f'Not enough disk space for {name} ({need / 1024**3:.1f} GB needed, '
+                                                f'{max(self.free_space(), 0) / 1024**3:.1f} GB free)')
+                if not waiting:
+                    print(f'Waiting for disk space for {name}.')
+                    waiting = True
+                self.condition.wait(self.poll)
+            self.downloading[partPath] = size
+            self.held += size * (self.spaceFactor - 1)
+
+    def downloaded(self, partPath, ok=True):
+        '''
+        End the reservation of a zip once it is on disk, keeping the space for unzipping it.
+
+        Input:
+        - partPath (str) - Full path to the .part file of the zip.
+        - ok (bool) - False if the download failed, which also gives back the space for unzipping.
+        '''
+        with self.condition:
+            size = self.downloading.pop(partPath)
+            if not ok:
+                self.held -= size * (self.spaceFactor - 1)
+            self.condition.notify_all()
+
+    def extracted(self, size):
+        '''
+        Give back the space held for unzipping a product.
+
+        Input:
+        - size (int) - Size of the zip in bytes.
+        '''
+        with self.condition:
+            self.held -= size * (self.spaceFactor - 1)
+            self.condition.notify_all()
+
+
+def disk_admission(path, args, wait=False, reclaim=None, busy=None):
+    '''
+    Create the admission control of a download folder from the arguments file.
+
+    Input:
+    - path (str) - Full path to the download folder.
+    - args (dict) - Output of read_arguments_from_file.
+    - wait (bool) - See DiskAdmission.
+    - reclaim (function) - See DiskAdmission.
+    - busy (function) - See DiskAdmission.
+
+    Output:
+    - admission (DiskAdmission) - The admission control, or None if it is disabled.
+    '''
+    if args.get('diskAdmission', 'True') != 'True':
+        return None
+    os.makedirs(path, exist_ok=True)
+    spaceFactor = 1.0 if args.get('productAccess') == 'zip' else float(args.get('downloadSpaceFactor', 2))
+    return DiskAdmission(path, spaceFactor, float(args.get('minDiskSpace', 5)), wait,
+                         reclaim=reclaim, busy=busy)
@@ -1,9 +1,302 @@
-import os, sys
+import os, sys, csv, math, json, fcntl, hashlib, threading
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
 import rasterio
+import rasterio.windows
 from rasterio.windows import from_bounds
 from rasterio.transform import from_origin
+from rasterio.enums import Resampling
 import numpy as np
+from processing_parameters import read_processing_parameters
+from raster_output import creation_options
+from dem_window import grid_window, window_vrt
+from dem_tiles import dem_source, mosaic_vrt
+from dem_cache import CELL_PIXELS, source_signature, cache_folder, snap_bounds, grid_cells, cached_cells, evict
+from scene_store import store_directory
+from product_cache import read_dem_description, write_dem_description
+
+# National 2 m DEM at CSC, and its resolution
+NATIONAL_DEM = '/appl/data/geo/mml/dem2m/dem2m_direct.vrt'
+NATIVE_RESOLUTION = 2.0
+
+
+def read_arguments_from_file(file_path):
+    '''
+    Helper function to read the arguments.csv file.
+    
+    Input:
+    - file_path (str) - Full path to the arguments file.
+    
+    Output: 
+    arguments (dict) - Dictionary of the arguments.
+    '''
+    arguments = {}
+    with open(file_path, 'r') as file:
+        reader = csv.reader(file, delimiter='\t')
+        for row in reader:
+            if row and not row[0].startswith('#'):
+                arg_name, arg_value = row
+                arguments[arg_name.strip()] = arg_value.strip()
+    return arguments
+
+
+def dem_pixel_size(terrainResolution, oversampling, nativeResolution=NATIVE_RESOLUTION):
+    '''
+    Pixel size of the extracted DEM. Terrain correction resamples the DEM to terrainResolution anyway, so reading the
+    DEM finer than a few pixels per output pixel only costs memory and disk.
+    
+    Input:
+    - terrainResolution (float) - Pixel spacing of the terrain correction in metres.
+    - oversampling (float) - DEM pixels per terrain-corrected pixel, in each direction. 0 for the native resolution.
+    - nativeResolution (float) - Resolution of the source DEM in metres.
+    
+    Output:
+    - pixelSize (float) - Pixel size in metres, never finer than the source DEM.
+    '''
+    if oversampling <= 0:
+        return nativeResolution
+    return max(float(terrainResolution) / oversampling, nativeResolution)
+
+
+def is_empty(block, nodata=-9999):
+    '''
+    Whether a block of the DEM has no data at all.
+    '''
+    return bool(np.all((block == nodata) | np.isnan(block)))
+
+
+def extract_dem(vrtPath, bounds, pathToDem, pixelSize, workers=1):
+    '''
+    Read the DEM of an area at the given pixel size, averaging the source pixels, and save it as a tiled, compressed
+    GeoTIFF. The DEM is copied one output tile at a time, so memory use does not grow with the area, and an empty area
+    is recognised without holding the whole DEM.
+    
+    Input:
+    - vrtPath (str) - Full path to the source DEM.
+    - bounds (tuple) - xmin, ymin, xmax, ymax in the CRS of the source DEM.
+    - pathToDem (str) - Full path to the DEM that is written.
+    - pixelSize (float) - Pixel size of the written DEM, in the units of the source CRS.
+    - workers (int) - Number of tiles read at the same time.
+    
+    Output:
+    - written (bool) - False if the area has no DEM data, and nothing was written.
+    '''
+    # Whole pixels, the area grows a little to the east and south
+    width = max(int(math.ceil((bounds[2] - bounds[0]) / pixelSize)), 1)
+    height = max(int(math.ceil((bounds[3] - bounds[1]) / pixelSize)), 1)
+    transform = from_origin(bounds[0], bounds[3], pixelSize, pixelSize)
+
+    with rasterio.open(vrtPath) as src:
+        profile = dict(driver='GTiff', width=width, height=height, count=src.count, dtype=src.dtypes[0],
+                       crs=src.crs, transform=transform, nodata=-9999, **creation_options(src.dtypes[0]))
+
+    # A dataset must not be shared between threads, so each worker opens the source itself
+    local = threading.local()
+
+    def read_block(window):
+        if not hasattr(local, 'src'):
+            local.src = rasterio.open(vrtPath)
+            sources.append(local.src)
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        return window, local.src.read(window=from_bounds(left, bottom, right, top, local.src.transform),
+                                      out_shape=(local.src.count, window.height, window.width),
+                                      resampling=Resampling.average, boundless=True, fill_value=0)
+
+    sources = []
+    empty = True
+    partial = f'{pathToDem}.partial'
+    print(f"Writing DEM at {pixelSize} m...")
+    try:
+        with rasterio.open(partial, 'w', **profile) as dst, \
+             ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            windows = [window for _, window in dst.block_windows(1)]
+            # Only a few tiles are read ahead of the writer
+            for first in range(0, len(windows), 2 * max(workers, 1)):
+                for window, block in executor.map(read_block, windows[first:first + 2 * max(workers, 1)]):
+                    empty = empty and is_empty(block)
+                    dst.write(block, window=window)
+    finally:
+        for src in sources:
+            src.close()
+
+    if empty:
+        os.remove(partial)
+        print("DEM is empty. Skipping saving.")
+        return False
+    os.replace(partial, pathToDem)
+    print("DEM saved.")
+    return True
+
+
+def target_bounds(pathToShapefile, buffer=500):
+    '''
+    Area of the DEM of a target: the bounds of its polygons in EPSG:3067, with a buffer.
+    
+    Input:
+    - pathToShapefile (str) - Full path to the shapefile of the target.
+    - buffer (float) - Buffer around the polygons in metres.
+    
+    Output:
+    - bounds (tuple) - xmin, ymin, xmax, ymax.
+    '''
+    # Get DEM area of interest
+    gdf = gpd.read_file(pathToShapefile)
+
+    # Change to 3067
+    if gdf.crs != 'epsg:3067':
+        gdf = gdf.to_crs(epsg=3067)
+
+    bounds = gdf.total_bounds
+    return (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+
+def source_resolution(source):
+    '''
+    Pixel size of a DEM raster, in the units of its CRS.
+    '''
+    with rasterio.open(source) as src:
+        return src.res[0]
+
+
+def cached_extract(demSource, source, bounds, pathToDem, pixelSize, workers=1, demCacheDir=None, cacheDir=None):
+    '''
+    Write the DEM of an area like extract_dem, through the DEM window cache (see dem_cache.py) if there is one.
+    
+    Input:
+    - demSource (str) - Full path to the DEM raster or folder of DEM tiles, identifies the cached cells.
+    - source (str) - Raster to read the area from, output of dem_tiles.dem_source.
+    - bounds, pathToDem, pixelSize, workers - See extract_dem.
+    - demCacheDir (str) - Full path to the DEM window cache, or None to read the source directly.
+    - cacheDir (str) - Full path to the DEM cache folder of the results, for the mosaics.
+    
+    Output:
+    - written (bool) - False if the area has no DEM data, and nothing was written.
+    '''
+    if demCacheDir is None:
+        return extract_dem(source, bounds, pathToDem, pixelSize, workers)
+    with rasterio.open(source) as src:
+        crs, dtype, bands = src.crs.to_wkt(), src.dtypes[0], src.count
+    folder = cache_folder(demCacheDir, source_signature(demSource), pixelSize, crs)
+
+    def build(cell_bounds, path):
+        cell_source = dem_source(demSource, cell_bounds, cacheDir)
+        return cell_source is not None and extract_dem(cell_source, cell_bounds, path, pixelSize, workers)
+
+    bounds = snap_bounds(bounds, pixelSize)
+    cells, built = cached_cells(folder, bounds, pixelSize, build)
+    print(f'DEM cache: {len(grid_cells(bounds, pixelSize)) - built} cells reused, {built} built.')
+    if not cells:
+        print("DEM is empty. Skipping saving.")
+        return False
+
+    # The cells are on the grid of the DEM, so the area is copied from them without resampling
+    tiles = [{'path': path, 'width': CELL_PIXELS, 'height': CELL_PIXELS, 'bands': bands, 'dtype': dtype,
+              'nodata': -9999, 'crs': crs, 'x': cell_bounds[0], 'y': cell_bounds[3],
+              'pixel_x': pixelSize, 'pixel_y': pixelSize} for path, cell_bounds in cells]
+    key = hashlib.sha1(repr(sorted(path for path, _ in cells)).encode()).hexdigest()[:16]
+    mosaic = os.path.join(cacheDir, f'cells_{key}.vrt')
+    mosaic_vrt(tiles, mosaic)
+    return extract_dem(mosaic, bounds, pathToDem, pixelSize, workers)
+
+
+def shared_dem(demSource, pathToResult, cacheDir, terrainResolution, oversampling, workers=1, demCacheDir=None):
+    '''
+    Write the DEM of the union of all identifiers once, or reuse it if it is already written with the same source and
+    pixel size. The first identifier writes it, and the others wait for it.
+    
+    Input:
+    - demSource (str) - Full path to the DEM raster or folder of DEM tiles.
+    - pathToResult (str) - Full path to the results folder.
+    - cacheDir (str) - Full path to the DEM cache folder.
+    - terrainResolution, oversampling - See dem_pixel_size.
+    - workers (int) - See extract_dem.
+    - demCacheDir (str) - See cached_extract.
+    
+    Output:
+    - sharedPath (str) - Full path to the shared DEM, or None if the targets are so far apart that the shared DEM
+      would be larger than separate DEMs together, or if it has no data.
+    '''
+    identifiers = [name for name in sorted(os.listdir(pathToResult))
+                   if os.path.exists(os.path.join(pathToResult, name, 'shapefile', f'{name}.shp'))]
+    all_bounds = [target_bounds(os.path.join(pathToResult, name, 'shapefile', f'{name}.shp')) for name in identifiers]
+    if not all_bounds:
+        return None
+    union = [min(bounds[0] for bounds in all_bounds), min(bounds[1] for bounds in all_bounds),
+             max(bounds[2] for bounds in all_bounds), max(bounds[3] for bounds in all_bounds)]
+    source = dem_source(demSource, union, cacheDir)
+    if source is None:
+        return None
+    pixelSize = dem_pixel_size(terrainResolution, oversampling, source_resolution(source))
+
+    def pixels(bounds):
+        return math.ceil((bounds[2] - bounds[0]) / pixelSize) * math.ceil((bounds[3] - bounds[1]) / pixelSize)
+    if pixels(union) > sum(pixels(bounds) for bounds in all_bounds):
+        print('Targets are too far apart for a shared DEM, writing a DEM for each.')
+        return None
+
+    sharedPath = os.path.join(cacheDir, 'shared_dem.tif')
+    expected = {'source': source, 'signature': source_signature(demSource), 'bounds': union, 'pixelSize': pixelSize}
+    with open(os.path.join(cacheDir, 'shared_dem.lock'), 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        metadata = os.path.join(cacheDir, 'shared_dem.json')
+        if os.path.exists(sharedPath) and os.path.exists(metadata):
+            with open(metadata) as file:
+                if json.load(file) == expected:
+                    print('Using the shared DEM.')
+                    return sharedPath
+        if not cached_extract(demSource, source, union, sharedPath, pixelSize, workers, demCacheDir, cacheDir):
+            return None
+        with open(metadata, 'w') as file:
+            json.dump(expected, file)
+    return sharedPath
+
+
+def write_dem_window(sharedPath, bounds, pathToDem, description=None):
+    '''
+    Give a target its window of the shared DEM as a VRT next to where its DEM would be, see dem_window.py.
+    
+    Input:
+    - sharedPath (str) - Full path to the shared DEM.
+    - bounds (tuple) - Area of the target, output of target_bounds.
+    - pathToDem (str) - Full path to <identifier>_dem.tif.
+    - description (dict) - What the window is made from, see product_cache.write_dem_description.
+    '''
+    vrtPath = f'{os.path.splitext(pathToDem)[0]}.vrt'
+    with rasterio.open(sharedPath) as src:
+        origin = (src.transform.c, src.transform.f)
+        window = grid_window(bounds, origin, src.transform.a, (src.height, src.width))
+        window_vrt(sharedPath, vrtPath, window, origin, src.transform.a,
+                   src.crs.to_wkt(), src.dtypes[0], src.count, src.nodata)
+    write_dem_description(vrtPath, description)
+    # A DEM of an earlier run would be used before the window
+    if os.path.exists(pathToDem):
+        os.remove(pathToDem)
+    write_dem_description(pathToDem, None)
+
+
+def write_target_dem(demSource, source, bounds, pathToDem, pixelSize, workers=1, demCacheDir=None, cacheDir=None):
+    '''
+    Write the DEM of a target, unless the DEM of an earlier run was made from the same source, area and pixel size.
+    Keeping it keeps the processed scenes of the earlier run valid, see product_cache.py.
+    
+    Input:
+    - See cached_extract.
+    
+    Output:
+    - written (bool) - False if the area has no DEM data.
+    '''
+    description = {'source': source_signature(demSource), 'bounds': [float(value) for value in bounds],
+                   'pixelSize': float(pixelSize)}
+    if os.path.exists(pathToDem) and read_dem_description(pathToDem) == description:
+        print('The DEM is up to date.')
+        return True
+    # An interrupted write must not leave the description of the earlier DEM
+    write_dem_description(pathToDem, None)
+    written = cached_extract(demSource, source, bounds, pathToDem, pixelSize, workers, demCacheDir, cacheDir)
+    if written:
+        write_dem_description(pathToDem, description)
+    return written
+
 
 def main():
     # Extract arguments from shellscript
@@ -24,69 +317,48 @@ def main():
         pathToDem = os.path.join(pathToResult, identifier, f'{identifier}_dem.tif')
         pathToShapefile = os.path.join(pathToResult, identifier, 'shapefile', f'{identifier}.shp')
 
-    # Get DEM area of interest
-    gdf = gpd.read_file(pathToShapefile)
+    # Create a 500m buffer around the shapefile
+    bounds = target_bounds(pathToShapefile)
 
-    # Change to 3067
-    if gdf.crs != 'epsg:3067':
-        gdf = gdf.to_crs(epsg=3067)
+    # Read the DEM at the pixel spacing that the terrain correction needs
+    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
+    terrainResolution = read_processing_parameters(args)['terrainResolution'] or 10.0
+    oversampling = float(args.get('demOversampling', 2))
+    workers = int(args.get('demWorkers', 1))
 
-    # Create a 500m buffer around the shapefile
-    bounds = None
-
-    for index, row in gdf.iterrows():
-        polygon_bounds = row.geometry.bounds
-        if bounds is None:
-            bounds = polygon_bounds
-        else:
-            bounds = (
-                min(bounds[0], polygon_bounds[0]),
-                min(bounds[1], polygon_bounds[1]),
-                max(bounds[2], polygon_bounds[2]),
-                max(bounds[3], polygon_bounds[3])
-            )
-
-    buffer = 500
-    bounds = (
-        bounds[0] - buffer,
-        bounds[1] - buffer,
-        bounds[2] + buffer,
-        bounds[3] + buffer
-    )
-
-
-    # Call the virtual raster with spahefile inputs and save it
-    vrt_path = "/appl/data/geo/mml/dem2m/dem2m_direct.vrt"
-
-    with rasterio.open(vrt_path) as src:
-        rst = src.read(window=from_bounds(bounds[0], bounds[1], bounds[2], bounds[3], src.transform), 
-                       boundless=True, fill_value=0)
-        # Extract DEM CRS
-        crs = src.crs
-
-    # Create a new transformation matrix for the raster    
-    xmin = bounds[0]
-    ymax = bounds[3]
-    pixel_size_x = (bounds[2] - bounds[0]) / rst.shape[2]
-    pixel_size_y = (bounds[3] - bounds[1]) / rst.shape[1]
-    transform = from_origin(xmin, ymax, pixel_size_x, pixel_size_y)
-
-    # Save DEM
-    # Check if the DEM slice is empty
-    dem_data = np.where(rst != -9999, rst, np.nan)
-    if np.isnan(dem_data).all():
-        print("DEM is empty. Skipping saving.")
-    else:
-        print(f"Writing DEM...")
-        with rasterio.open(pathToDem, 'w', driver='GTiff', 
-                        width=rst.shape[2], height=rst.shape[1], 
-                        count=rst.shape[0], dtype=rst.dtype, 
-                        crs=crs, transform=transform,
-                        nodata=-9999) as dst:
-            dst.write(rst)
-
-        # Print the mean DEM value
-        print("DEM saved.")
+    # A single DEM raster, e.g. the national virtual raster, or a folder of DEM tiles
+    demSource = args.get('demSource', NATIONAL_DEM)
+    cacheDir = os.path.join(os.path.dirname(store_directory(pathToResult)), 'dem')
+    os.makedirs(cacheDir, exist_ok=True)
+    # DEM windows shared between runs and projects
+    demCacheDir = args.get('demCacheDir', 'none')
+    demCacheDir = None if demCacheDir == 'none' else os.path.expanduser(demCacheDir)
+    if demCacheDir is not None:
+        removed = evict(demCacheDir, float(args.get('demCacheQuota', 20)))
+        if removed:
+            print(f'Removed {removed} least recently used cells from the DEM cache.')
+
+    # Identifiers share one DEM of all targets, and each gets a window of it
+    if not bulkDownload and args.get('demSharing', 'shared') == 'shared':
+        sharedPath = shared_dem(demSource, pathToResult, cacheDir, terrainResolution, oversampling, workers, demCacheDir)
+        if sharedPath is not None:
+            with open(os.path.join(cacheDir, 'shared_dem.json')) as file:
+                shared = json.load(file)
+            write_dem_window(sharedPath, bounds, pathToDem,
+                             {'source': source_signature(demSource), 'bounds': [float(value) for value in bounds],
+                              'shared': shared})
+            return
+
+    window = f'{os.path.splitext(pathToDem)[0]}.vrt'
+    if os.path.exists(window):
+        os.remove(window)
+    write_dem_description(window, None)
+    source = dem_source(demSource, bounds, cacheDir)
+    if source is None:
+        print("No DEM tiles cover the target. Skipping saving.")
+        return
+    pixelSize = dem_pixel_size(terrainResolution, oversampling, source_resolution(source))
+    write_target_dem(demSource, source, bounds, pathToDem, pixelSize, workers, demCacheDir, cacheDir)
     
 if __name__ == "__main__":
     main()
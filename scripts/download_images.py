@@ -1,6 +1,18 @@
-import sys, os, subprocess, zipfile, dask, csv
+import sys, os, subprocess, csv
 import geopandas as gpd
-from shapely.geometry import box, Point, Polygon
+from product_access import extract_products, access_options
+from search_cache import cached_search
+from search_shards import date_shards, sharded_search
+from scene_store import fetch_products, store_directory
+from downloader import download_products, missing_products
+from disk_admission import disk_admission
+from processing_parameters import read_processing_parameters
+from product_cache import processed_scenes
+from scene_catalog import add_results, record_local_path, catalog_path
+from session_cache import session_lock, load_cookies, save_cookies
+from requests.adapters import HTTPAdapter
+from shapely.geometry import box, Point, Polygon, shape
+from shapely.strtree import STRtree
 
 try:
     import asf_search as asf
@@ -10,31 +22,6 @@ except:
 
 
             
-def unzip(dataPath, file):
-    '''
-    Unzip a single zip file and remove the zip file.
-    
-    Input:
-    - zip_file_path (str) - Full path to the zip file.
-    
-    Output: 
-    Unzipped files.
-    '''
-    
-    # Extract the directory path without the zip extension
-    extract_to = os.path.splitext(file)[0]
-    
-    # Unzip
-    if file.endswith('.zip'):
-        with zipfile.ZipFile(file, 'r') as zip_ref:
-            zip_ref.extractall(dataPath)
-        
-        # Delete the zip file
-        os.remove(file)
-
-
-    
-
 def read_arguments_from_file(file_path):
     '''
     Helper function to read the arguments.csv file.
@@ -55,12 +42,49 @@ def read_arguments_from_file(file_path):
     return arguments
 
 
-def authenticate():
+def authenticate(cacheDir=None, sessionHours=0, poolSize=10):
     '''
-    Authenticates your asf account.
+    Authenticates your asf account. The login is reused from cacheDir when possible, see session_cache.py.
     
     Input:
-    - pathToClient (str) - Full path to the file containing client info.
+    - cacheDir (str) - Full path to the cache folder of the results, or None to always log in.
+    - sessionHours (float) - How long a cached login is reused, in hours.
+    - poolSize (int) - Number of connections kept open to each host, at least the number of simultaneous downloads.
+    
+    Output: 
+    - session - authenticated session file.
+    '''
+    session = asf.ASFSession()
+    # Without a large enough pool, parallel downloads keep opening and dropping connections
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if cacheDir is None:
+        return login(session)
+    cachePath = os.path.join(cacheDir, 'asf_session.json')
+    with session_lock(cachePath):
+        cookies = load_cookies(cachePath, sessionHours)
+        if cookies is not None:
+            # Checks the login cookies, and restores the Earthdata token that downloads need as well as the cookies
+            try:
+                session.auth_with_cookiejar(cookies)
+                print('Using the cached ASF login.')
+                return session
+            except asf.ASFAuthenticationError as e:
+                print(f'The cached ASF login is not valid ({e}), logging in again.')
+                session.cookies.clear()
+        login(session)
+        save_cookies(session, cachePath)
+    return session
+
+
+def login(session):
+    '''
+    Log in with the Earthdata credentials of ~/.netrc.
+    
+    Input:
+    - session (ASFSession) - The session to log in.
     
     Output: 
     - session - authenticated session file.
@@ -78,15 +102,15 @@ def authenticate():
 
     # Authenticate the account
     print('Authenticating...')
-    session = asf.ASFSession().auth_with_creds(username, password)
+    session.auth_with_creds(username, password)
     
     return session
     
     
     
-def search_and_download(start,end,season,wkt_aoi,beamMode,flightDirection,polarization,processingLevel,processes,pathToResult,session):
+def search_products(start,end,season,wkt_aoi,beamMode,flightDirection,polarization,processingLevel,cacheDir=None,cacheHours=0,pathToTarget=None,shardDays=0,searchWorkers=4):
     '''
-    Searches and downloads S1 files with the given parameters.
+    Searches S1 files with the given parameters.
     
     Input:
     - start (str) - Start of the observation period (e.g. 2021-03-25)
@@ -97,41 +121,77 @@ def search_and_download(start,end,season,wkt_aoi,beamMode,flightDirection,polari
     - flightDirection (str) - Flight direction, ASCENDING or DESCENDING (cannot be both).
     - polarization (str) - Desired polarization (e.g. VV,VV+VH or HH)
     - processingLevel (str) - Whether SLC or GRD (e.g. GRD_HD or SLC)
+    - cacheDir (str) - Full path to the search cache, or None to always search.
+    - cacheHours (float) - How long cached results are used, in hours.
+    - pathToTarget (str) - Full path to the target shapefile. If given, products that do not cover any of its polygons are dropped.
+    - shardDays (int) - Longest date window searched at once, in days. The windows are searched in parallel. 0 to search the whole period at once.
+    - searchWorkers (int) - Number of date windows searched at the same time.
+    
+    Output: 
+    - results (ASFSearchResults) - The found products.
+    '''
+    query = dict(platform=asf.PLATFORM.SENTINEL1A, start=start, end=end, season=season, beamMode=beamMode,
+                 flightDirection=flightDirection, polarization=polarization, processingLevel=processingLevel)
+
+    def search():
+        #search for the results
+        print('Searching for results...')
+        # ['GRD_HS', 'GRD_HD', 'GRD_MS', 'GRD_MD', 'GRD_FD']
+        shards = date_shards(start, end, season, shardDays) if shardDays > 0 else []
+        if len(shards) <= 1:
+            return asf.search(intersectsWith=wkt_aoi, **query)
+        # The shards already cover only the season
+        shard_query = dict(query, season=[])
+        return sharded_search(shards, lambda shard_start, shard_end: asf.search(
+            intersectsWith=wkt_aoi, **dict(shard_query, start=shard_start, end=shard_end)), searchWorkers)
+
+    results = cached_search(cacheDir, cacheHours, query, wkt_aoi, search)
+    if pathToTarget is not None:
+        results = filter_by_footprint(results, pathToTarget)
+    return results
+
+
+def search_and_download(start,end,season,wkt_aoi,beamMode,flightDirection,polarization,processingLevel,processes,pathToResult,session,cacheDir=None,cacheHours=0,storeDir=None,storeQuota=0,pathToTarget=None,shardDays=0,searchWorkers=4,admission=None,catalogPath=None,processed=()):
+    '''
+    Searches and downloads S1 files with the given parameters.
+    
+    Input:
+    - start, end, season, wkt_aoi, beamMode, flightDirection, polarization, processingLevel - See search_products.
     - processes (int) - How many files are downloaded simultaneously.
     - pathToResult (str) - Full path to the result folder.
     - session - Authenticated session file.
+    - cacheDir, cacheHours - See search_products.
+    - storeDir (str) - Full path to the shared scene store, or None to download straight to pathToResult.
+    - storeQuota (float) - Size limit of the scene store in GB, 0 for no limit.
+    - pathToTarget, shardDays, searchWorkers - See search_products.
+    - admission (DiskAdmission) - Starts downloads only when they fit on the disk, or None.
+    - catalogPath (str) - Full path to the scene catalog the found products are added to, or None.
+    - processed (set) - Product IDs of the scenes already processed with the current parameters, which are not downloaded again.
     
     Output: 
     - Downloaded S1 files.
     '''
-    #search for the results
-    print('Searching for results...')
-    results = asf.search(
-        platform=asf.PLATFORM.SENTINEL1A,
-        #processingLevel=[asf.PRODUCT_TYPE.SLC],
-        start=start,
-        end=end,
-        season=season, # beginning of october to end of may #[274,152]
-        intersectsWith=wkt_aoi,
-        beamMode=beamMode,
-        flightDirection=flightDirection,
-        polarization=polarization,
-        processingLevel=processingLevel
-        )
-    # ['GRD_HS', 'GRD_HD', 'GRD_MS', 'GRD_MD', 'GRD_FD']
-    ### Save Metadata to a Dictionary
-    metadata = results.geojson()
-
-    print(f'Downloading {len(results)} images...')
+    results = search_products(start,end,season,wkt_aoi,beamMode,flightDirection,polarization,processingLevel,cacheDir,cacheHours,pathToTarget,shardDays,searchWorkers)
+    if catalogPath is not None:
+        add_results(catalogPath, results)
 
     if not os.path.exists(pathToResult):
             os.makedirs(pathToResult)
 
-    results.download(
-         path = pathToResult,
-         session = session, 
-         processes = processes 
-      )   
+    # Reruns only fetch what is not already on disk
+    missing = missing_products(results, pathToResult, processed)
+    print(f'Downloading {len(missing)} images...')
+
+    if storeDir is not None:
+        fetch_products(missing, storeDir, pathToResult, session, processes, storeQuota, admission)
+    else:
+        download_products(missing, pathToResult, session, processes, admission=admission)
+
+    if catalogPath is not None:
+        for product in results:
+            localPath = os.path.join(storeDir or pathToResult, product.properties['fileName'])
+            if os.path.exists(localPath):
+                record_local_path(catalogPath, product.properties['sceneName'], localPath)
 
     print('Download complete.')
     
@@ -147,39 +207,72 @@ def create_wkt(pathToTarget):
         # Reproject geometry to WGS84 (EPSG:4326)
         gdf = gdf.to_crs(epsg=4326)
 
-    bounds = None
-
-    for index, row in gdf.iterrows():
-        polygon_bounds = row.geometry.bounds
-        if bounds is None:
-            bounds = polygon_bounds
-        else:
-            bounds = (
-                min(bounds[0], polygon_bounds[0]),
-                min(bounds[1], polygon_bounds[1]),
-                max(bounds[2], polygon_bounds[2]),
-                max(bounds[3], polygon_bounds[3])
-            )
-
-
-    gdf_bounds = gpd.GeoSeries([box(*bounds)])
+    gdf_bounds = gpd.GeoSeries([box(*gdf.total_bounds)])
     wkt_aoi = gdf_bounds.to_wkt().values.tolist()[0]
     
     return wkt_aoi
 
 
+def filter_by_footprint(results, pathToTarget):
+    '''
+    Drop the products whose footprint does not intersect any of the target polygons. The search is done with the
+    bounding box of all polygons, so with widely separated targets many of the found products only cover the empty
+    space between them.
+    
+    Input:
+    - results (ASFSearchResults) - The found products.
+    - pathToTarget (str) - Full path to the target shapefile.
+    
+    Output: 
+    - results (ASFSearchResults) - The products that intersect at least one polygon.
+    '''
+    gdf = gpd.read_file(pathToTarget)
+    if gdf.crs != 'EPSG:4326':
+        gdf = gdf.to_crs(epsg=4326)
+    tree = STRtree(gdf.geometry.values)
+
+    kept = []
+    avoided = 0
+    for product in results:
+        if len(tree.query(shape(product.geometry), predicate='intersects')) > 0:
+            kept.append(product)
+        else:
+            avoided += product.properties.get('bytes') or 0
+    
+    print(f'{len(results) - len(kept)} of {len(results)} images do not cover any target, '
+          f'avoided downloading {avoided / 1024**3:.1f} GB.')
+    return results.__class__(kept)
+
 
+def find_identifiers(path):
+    '''
+    List the identifiers of a non-bulk run, i.e. the folders with a shapefile of their own.
+    
+    Input:
+    - path (str) - Full path to the results folder.
+    
+    Output: 
+    - identifiers (list) - The identifiers in alphabetical order.
+    '''
+    return [name for name in sorted(os.listdir(path))
+            if os.path.exists(os.path.join(path, name, 'shapefile', f'{name}.shp'))]
 
-def main():
-    # Read arguments from shellscript
-    pathToTarget = sys.argv[1]
-    path = sys.argv[2]
-    bulkDownload = sys.argv[3].lower() == 'true'
-    if not bulkDownload:
-        identifier = sys.argv[4]
 
-    # Read arguments from the text file
-    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
+def download_target(pathToTarget, path, bulkDownload, identifier, args, session):
+    '''
+    Search, download and unzip the images of a target.
+    
+    Input:
+    - pathToTarget (str) - Full path to the original target file.
+    - path (str) - Full path to the results folder.
+    - bulkDownload (bool) - Whether the images are downloaded in bulk.
+    - identifier (str) - The target, when not downloading in bulk.
+    - args (dict) - Arguments from arguments.csv.
+    - session - Authenticated session.
+    
+    Output: 
+    - Downloaded and unzipped S1 files.
+    '''
     start = args.get('start')
     end = args.get('end')
     season = args.get('season')
@@ -192,9 +285,12 @@ def main():
     polarization = args.get('polarization')
     processingLevel = args.get('processingLevel')
     processes = int(args.get('processes'))
-
-    # Authenticate the session
-    session = authenticate()
+    searchCacheHours = float(args.get('searchCacheHours', 24))
+    searchShardDays = int(args.get('searchShardDays', 0))
+    searchWorkers = int(args.get('searchWorkers', 4))
+    cacheDir = os.path.join(path, '.cache', 'search')
+    storeDir = store_directory(path) if args.get('sceneStore') == 'True' else None
+    storeQuota = float(args.get('sceneStoreQuota', 0))
     
     # Create paths and wkt's
     if bulkDownload:
@@ -206,32 +302,57 @@ def main():
      
     else:
         pathToResult = os.path.join(path,identifier,'tiffs')
-        wkt_aoi = create_wkt(os.path.join(path,identifier,'shapefile',f'{identifier}.shp'))
+        pathToTarget = os.path.join(path,identifier,'shapefile',f'{identifier}.shp')
+        wkt_aoi = create_wkt(pathToTarget)
     
     
+    # Start downloads only when they fit on the disk
+    admission = disk_admission(storeDir or pathToResult, args)
+
+    # Scenes already processed with the current parameters are not downloaded again
+    processed = processed_scenes(pathToResult, read_processing_parameters(args, bulkDownload), pathToTarget)
+
     # Download files
     search_and_download(start,end,season,wkt_aoi,beamMode,flightDirection,
-                            polarization,processingLevel,processes,pathToResult,session)
+                            polarization,processingLevel,processes,pathToResult,session,cacheDir,searchCacheHours,storeDir,storeQuota,pathToTarget,
+                            searchShardDays,searchWorkers,admission,catalog_path(path),processed)
 
 
     # ------- START UNZIP -------
-
-    sorted_files = sorted(os.listdir(pathToResult))
-
-     # Create list of delayed functions
-    list_of_delayed_functions = []
-
+    # Extract the products in parallel, fully or only the needed files, or leave them zipped for SNAP to read
     print("Unzipping...")
-    # Loop through folders
-    for file in sorted_files:
-        result = dask.delayed(unzip)(pathToResult,os.path.join(pathToResult,file))
-        # Append the list of delayed functions
-        list_of_delayed_functions.append(result)
-
-    # Execute delayed computations
-    dask.compute(list_of_delayed_functions)
+    extract_products(pathToResult, **access_options(args))
     print("Unzip done. \n")
     # ------- END UNZIP --------
+
+
+def main():
+    # Read arguments from shellscript
+    pathToTarget = sys.argv[1]
+    path = sys.argv[2]
+    bulkDownload = sys.argv[3].lower() == 'true'
+    identifier = None
+    if not bulkDownload:
+        identifier = sys.argv[4]
+
+    # Read arguments from the text file
+    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
+    processes = int(args.get('processes'))
+    searchWorkers = int(args.get('searchWorkers', 4))
+
+    # Authenticate the session, reusing an earlier login of the run
+    session = authenticate(os.path.dirname(store_directory(path)), float(args.get('sessionHours', 12)),
+                           max(processes, searchWorkers))
+
+    # With identifier 'all', a single process downloads every identifier with the same session and connections
+    if identifier == 'all':
+        identifiers = find_identifiers(path)
+    else:
+        identifiers = [identifier]
+    for identifier in identifiers:
+        if identifier is not None and len(identifiers) > 1:
+            print(f'ID: {identifier}')
+        download_target(pathToTarget, path, bulkDownload, identifier, args, session)
     
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
 import os, subprocess, sys, shutil, csv
+from scene_catalog import scene_facts, lookup_scenes, catalog_path
 
 try:
     from eof.download import download_eofs
@@ -51,27 +52,32 @@ def download_orbit_files():
    
     # ------- END ARGUMENT CALL -------- 
     
+    names = [file for file in os.listdir(dataPath) if file.endswith('.SAFE') or file.endswith('.zip')]
+    download_orbits_for(names, orbit_folder, lookup_scenes(catalog_path(path), names))
+    
+    
+def download_orbits_for(names, orbit_folder, scenes=None):
+    '''
+    Download and sort the precise orbit files of the given products.
+    
+    Input:
+    - names (list) - Names of the products, e.g. S1A_IW_GRDH_1SDV_20210301T160000_..._ABCD.SAFE
+    - orbit_folder (str) - Full path to the POEORB folder of the SNAP auxdata.
+    - scenes (dict) - Output of scene_catalog.lookup_scenes. Products not in it are parsed from their names.
+    
+    Output:
+    Downloaded and sorted orbit files.
+    '''
     # Create proper folder structure within the snap temporary folder
     dates = []
     sat = []
-    for file in os.listdir(dataPath):
-        if not file.endswith('.SAFE'):
-            continue
+    for file in names:
+        # Get the acquisition start
+        start = scene_facts(file, scenes)[0]
+        year = start.strftime('%Y')
+        month = start.strftime('%m')
         
-        # Ensure that the file still exists after possible deletions
-        if not os.path.exists(os.path.join(dataPath, file)):
-            continue
-
-        # Get the absolute orbit identifier
-        date = file.split('_')[5]
-        year = date[:4]
-        month = date[4:6]
-        day = date[6:8]
-        hour = date[9:11]
-        minute = date[11:13]
-        second = date[13:15]
-        
-        date = f'{year}{month}{day}{hour}{minute}{second}'
+        date = start.strftime('%Y%m%d%H%M%S')
         
         os.makedirs(os.path.join(orbit_folder,year,month), exist_ok=True)
         
@@ -98,6 +104,10 @@ def download_orbit_files():
 
         destination = os.path.join(orbit_folder, year, month)
 
+        # Orbit files may already be there from an earlier call
+        if os.path.exists(os.path.join(destination, file)):
+            os.remove(source)
+            continue
         shutil.move(source, destination)
 
     print("Orbit files sorted and moved to their respective directories. \n")
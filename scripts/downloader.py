@@ -0,0 +1,223 @@
+'''
+Resumable product downloader.
+
+A product is downloaded to <fileName>.part, and only renamed to its final name once it is complete and its MD5 matches
+the md5sum of the search results. A dropped connection does not start the product over: the next attempt asks for the
+rest of the file with an HTTP Range request. Each product is retried on its own, with an exponential backoff, so one
+failing product does not restart the whole search and download.
+
+Products that are already on disk are not downloaded again: a complete zip, an extracted .SAFE folder (the zip is
+removed after unzipping), or a scene that is already processed with the current parameters.
+'''
+import os, sys, time, hashlib, subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import requests
+except:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--user", "requests"])
+    import requests
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def file_md5(path):
+    '''
+    MD5 of the part of a file that is already downloaded.
+
+    Input:
+    - path (str) - Full path to the file.
+
+    Output:
+    - digest (hashlib object) - MD5 that further chunks can be added to.
+    '''
+    digest = hashlib.md5()
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    return digest
+
+
+def download_file(url, destination, session=None, md5=None, size=None, retries=5, backoff=2, timeout=60,
+                  chunkSize=1024 * 1024):
+    '''
+    Download a file, resuming after dropped connections and verifying its checksum.
+
+    Input:
+    - url (str) - URL of the file.
+    - destination (str) - Full path to the downloaded file.
+    - session (requests.Session) - Authenticated session, e.g. the ASFSession of download_images.authenticate.
+    - md5 (str) - Expected MD5 hex digest, or None to skip the check.
+    - size (int) - Expected size in bytes, or None to skip the check.
+    - retries (int) - How many times the download is retried after an error.
+    - backoff (float) - Wait before the first retry in seconds, doubled for every following retry.
+    - timeout (float) - Seconds without data after which the connection is considered dropped.
+    - chunkSize (int) - Bytes read and written at a time.
+
+    Output:
+    - stats (dict) - Bytes downloaded, seconds taken, throughput in MB/s, attempts and bytes resumed.
+    '''
+    session = session or requests.Session()
+    partial = f'{destination}.part'
+    start = time.perf_counter()
+    received = 0
+    resumed = 0
+
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # Nothing left to download, the part is already complete
+                    digest = file_md5(partial)
+                else:
+                    response.raise_for_status()
+                    if offset and response.status_code == 206:
+                        resumed += offset
+                        digest = file_md5(partial)
+                        mode = 'ab'
+                    else:
+                        # The server ignored the range, start over
+                        digest = hashlib.md5()
+                        mode = 'wb'
+                    with open(partial, mode) as file:
+                        for chunk in response.iter_content(chunk_size=chunkSize):
+                            file.write(chunk)
+                            digest.update(chunk)
+                            received += len(chunk)
+
+            if size is not None and os.path.getsize(partial) < size:
+                raise requests.exceptions.ConnectionError(f'Connection closed after {os.path.getsize(partial)} of {size} bytes')
+            if md5 is not None and digest.hexdigest() != md5:
+                os.remove(partial)
+                raise ChecksumError(f'MD5 of {os.path.basename(destination)} does not match')
+            os.replace(partial, destination)
+            break
+
+        except (requests.exceptions.RequestException, ChecksumError) as e:
+            if attempt == retries:
+                raise
+            wait = backoff * 2**attempt
+            print(f'Download of {os.path.basename(destination)} failed ({e}), retrying in {wait} s.')
+            time.sleep(wait)
+
+    seconds = time.perf_counter() - start
+    return {'file': os.path.basename(destination), 'bytes': received, 'seconds': round(seconds, 1),
+            'MBps': round(received / 1024**2 / seconds, 2) if seconds > 0 else None,
+            'attempts': attempt + 1, 'resumed': resumed}
+
+
+def local_product(product, path):
+    '''
+    Find a product that is already in the download folder.
+
+    Input:
+    - product (ASFProduct) - The product.
+    - path (str) - Full path to the download folder.
+
+    Output:
+    - localPath (str) - Full path to the extracted .SAFE folder or the complete zip, or None if neither is there.
+    '''
+    properties = product.properties
+    safe = os.path.join(path, f"{properties['sceneName']}.SAFE")
+    if os.path.isdir(safe):
+        return safe
+    zipPath = os.path.join(path, properties['fileName'])
+    # Zips only get their final name once verified, but a zip of a different size is from another product version
+    if os.path.isfile(zipPath) and (not properties.get('bytes') or os.path.getsize(zipPath) == properties['bytes']):
+        return zipPath
+    return None
+
+
+def missing_products(results, path, processed=()):
+    '''
+    Leave out the products that do not need to be downloaded.
+
+    Input:
+    - results (ASFSearchResults) - The found products.
+    - path (str) - Full path to the download folder.
+    - processed (set) - Product IDs of the scenes that are already processed, see product_cache.processed_scenes.
+
+    Output:
+    - results (ASFSearchResults) - The products that are neither processed, extracted nor downloaded.
+    '''
+    missing = [product for product in results
+               if product.properties['sceneName'] not in processed and local_product(product, path) is None]
+    if len(missing) < len(results):
+        print(f'{len(results) - len(missing)} of {len(results)} images are already downloaded or processed.')
+    return results.__class__(missing)
+
+
+def download_product(product, path, session=None, retries=5, admission=None):
+    '''
+    Download a product of the search results.
+
+    Input:
+    - product (ASFProduct) - The product.
+    - path (str) - Full path to the folder the product is downloaded to.
+    - session - Authenticated session.
+    - retries (int) - See download_file.
+    - admission (DiskAdmission) - Waits for disk space before the download starts, or None.
+
+    Output:
+    - stats (dict) - See download_file, and reserved: whether space for unzipping the product is held in admission,
+      to be given back with admission.extracted.
+    '''
+    properties = product.properties
+    destination = os.path.join(path, properties['fileName'])
+    size = properties.get('bytes')
+    if os.path.isfile(destination) and (not size or os.path.getsize(destination) == size):
+        print(f"{properties['fileName']} is already downloaded.")
+        return {'file': properties['fileName'], 'bytes': 0, 'seconds': 0, 'MBps': None, 'attempts': 0, 'resumed': 0,
+                'reserved': False}
+    reserved = admission is not None and bool(size)
+    if reserved:
+        admission.acquire(size, f'{destination}.part')
+    ok = False
+    try:
+        stats = download_file(properties['url'], destination, session, md5=properties.get('md5sum'), size=size,
+                              retries=retries)
+        ok = True
+    finally:
+        if reserved:
+            admission.downloaded(f'{destination}.part', ok)
+    stats['reserved'] = reserved
+    print(f"{stats['file']}: {stats['bytes'] / 1024**2:.0f} MB in {stats['seconds']} s ({stats['MBps']} MB/s, "
+          f"{stats['attempts']} attempts)")
+    return stats
+
+
+def download_products(results, path, session=None, processes=8, retries=5, admission=None):
+    '''
+    Download all products of the search results in parallel.
+
+    Input:
+    - results (ASFSearchResults) - The products.
+    - path (str) - Full path to the folder the products are downloaded to.
+    - session - Authenticated session.
+    - processes (int) - How many products are downloaded simultaneously.
+    - retries (int) - See download_file.
+    - admission (DiskAdmission) - See download_product.
+
+    Output:
+    - failed (list) - Names of the products that could not be downloaded.
+    '''
+    failed = []
+    total = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(processes, 1)) as executor:
+        futures = {executor.submit(download_product, product, path, session, retries, admission): product for product in results}
+        for future in as_completed(futures):
+            try:
+                total += future.result()['bytes']
+            except Exception as e:
+                fileName = futures[future].properties['fileName']
+                print(f'Download of {fileName} failed: {e}')
+                failed.append(fileName)
+    seconds = time.perf_counter() - start
+    print(f'Downloaded {total / 1024**3:.1f} GB in {seconds:.0f} s.')
+    return failed
@@ -1,8 +1,9 @@
-import sys, os, signal, csv, subprocess
+import sys, os, signal, csv, subprocess, math
 from datetime import datetime
 import geopandas as gpd
 import pandas as pd
 from shapely.geometry import Point
+from shapely.strtree import STRtree
 
 def process_shapefiles(source_path, result_path, identifierColumn, separate=False, bulkDownload=False):
     '''
@@ -51,6 +52,91 @@ def process_shapefiles(source_path, result_path, identifierColumn, separate=Fals
         gdf.to_file(os.path.join(result_path,f'{filename}.shp'))
             
             
+def cluster_targets(gdf, clusterDistance, clusterMaxExtent=0):
+    '''
+    Group nearby polygons into clusters. Polygons closer than clusterDistance to each other end up in the same cluster,
+    also through other polygons (single linkage). A cluster that grows wider than clusterMaxExtent is split along a grid,
+    so that a chain of polygons does not grow back into one huge area.
+    
+    Input:
+    gdf (GeoDataFrame) - The target polygons.
+    clusterDistance (float) - Largest distance between polygons of the same cluster, in km.
+    clusterMaxExtent (float) - Largest width or height of a cluster in km. 0 for no limit.
+    
+    Output:
+    labels (list) - Cluster number of each polygon, in the order of gdf.
+    '''
+    # Distances in metres
+    if gdf.crs.is_geographic:
+        gdf = gdf.to_crs(gdf.estimate_utm_crs())
+    geometries = gdf.geometry.values
+    
+    # Union-find over the pairs of polygons within clusterDistance
+    parent = list(range(len(geometries)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    left, right = STRtree(geometries).query(geometries, predicate='dwithin', distance=clusterDistance * 1000)
+    for i, j in zip(left, right):
+        parent[find(i)] = find(j)
+    roots = [find(i) for i in range(len(geometries))]
+    
+    keys = list(roots)
+    if clusterMaxExtent > 0:
+        size = clusterMaxExtent * 1000
+        centroids = gdf.geometry.centroid
+        for root in set(roots):
+            members = [i for i in range(len(roots)) if roots[i] == root]
+            minx, miny, maxx, maxy = gdf.geometry.iloc[members].total_bounds
+            if max(maxx - minx, maxy - miny) > size:
+                for i in members:
+                    keys[i] = (root, math.floor(centroids.iloc[i].x / size), math.floor(centroids.iloc[i].y / size))
+    
+    # Number the clusters in the order of the polygons
+    numbers = {}
+    return [numbers.setdefault(key, len(numbers)) for key in keys]
+
+
+def write_clusters(source_path, result_path, identifierColumn, clusterDistance, clusterMaxExtent=0):
+    '''
+    Organize the polygons into clusters of nearby targets. Each cluster gets a folder in result_path/clusters that looks
+    like the results folder of a bulk download: the polygons of the cluster in <cluster>.shp, and a folder for each polygon.
+    Each cluster is then searched, downloaded, and processed on its own, with its own DEM and subset.
+    
+    Input:
+    source_path (str) - Full path to the shapefile.
+    result_path (str) - Full path to the results folder.
+    identifierColumn (str) - Name of the column which identifies each polygon.
+    clusterDistance (float) - See cluster_targets.
+    clusterMaxExtent (float) - See cluster_targets.
+    
+    Output:
+    Folder structure for the next steps, and clusters.csv listing the cluster of each polygon.
+    '''
+    gdf = gpd.read_file(source_path)
+    if identifierColumn not in gdf.columns:
+        print(f"Error: Column identifier '{identifierColumn}' not found in the file. Possible identifier columns are: {list(gdf.columns)}.")
+        parent_pid = os.getppid()
+        os.kill(parent_pid, signal.SIGTERM)
+        sys.exit(1)
+    
+    gdf['cluster'] = [f'cluster_{label:03d}' for label in cluster_targets(gdf, clusterDistance, clusterMaxExtent)]
+    for cluster, cluster_gdf in gdf.groupby('cluster'):
+        cluster_path = os.path.join(result_path, 'clusters', cluster)
+        os.makedirs(cluster_path, exist_ok=True)
+        cluster_gdf.drop(columns='cluster').to_file(os.path.join(cluster_path, f'{cluster}.shp'))
+        for index, row in cluster_gdf.drop(columns='cluster').iterrows():
+            folder_name = str(row[identifierColumn])
+            folder_shapefile = os.path.join(cluster_path, folder_name, 'shapefile')
+            os.makedirs(folder_shapefile, exist_ok=True)
+            gpd.GeoDataFrame([row], crs=gdf.crs).to_file(os.path.join(folder_shapefile, f'{folder_name}.shp'))
+    
+    gdf[[identifierColumn, 'cluster']].to_csv(os.path.join(result_path, 'clusters', 'clusters.csv'), sep='\t', index=False)
+    print(f"Grouped {len(gdf)} targets into {gdf['cluster'].nunique()} clusters.")
+
+
 def process_coordinates(input_csv, result_path, bulkDownload=False):
     '''
     Read coordinates file, create buffered shapefiles and organize them to correct folders. The coordinates are treated as individual shapefiles.
@@ -341,10 +427,16 @@ def main():
     bulkDownload = sys.argv[4].lower() == 'true'
     identifierColumn = args.get('identifierColumn')
 
+    clusterDistance = float(args.get('clusterDistance', 0))
+    clusterMaxExtent = float(args.get('clusterMaxExtent', 0))
+
     # Process input
     if source_path.endswith('.csv'):
         process_coordinates(source_path, result_path, bulkDownload)
         print("Coordinate processing complete.")
+    elif bulkDownload and separate and clusterDistance > 0:
+        write_clusters(source_path, result_path, identifierColumn, clusterDistance, clusterMaxExtent)
+        print("Shapefile processing complete. \n")
     else:
         process_shapefiles(source_path, result_path, identifierColumn, separate, bulkDownload)
         print("Shapefile processing complete. \n")
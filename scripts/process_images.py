@@ -1,12 +1,12 @@
 '''
 This script does the following:
 1. Read necessary arguments from the arguments.txt file.
-2. Unzip all files in the folder to which the results were downloaded.
-3. Loop through each .SAFE file, and if another .SAFE is found with matching orbit (composite image):
-    a) Send those two to processing
-    b) If no match is found, send only the one .SAFE to processing without slice assembly.
+2. List the products (.SAFE folders, or zips with productAccess zip) in the folder to which the results were downloaded.
+3. Group the .SAFE files by absolute orbit in a single pass and write the plan to processing_plan.json:
+    a) Consecutive slices of the same orbit (composite image) are sent to processing together for slice assembly.
+    b) A slice with no neighbours is sent to processing alone, without slice assembly.
     
-This script therefore does not do any processing itself, only unzips and send the files for further processing. This is done to clean the java temporary memory used by SNAP by terminating the processing script after each process. Otherwise the pipeline would choke after only a few processes.
+This script therefore does not do any processing itself, only plans and sends the files for further processing. The processing is done by long-lived SNAP workers (snap_worker.py), which keep their JVM between scenes. The java temporary memory used by SNAP is still cleaned by recycling each worker after workerMaxProducts scenes, or once it uses more than workerMaxMemory GB. Otherwise the pipeline would choke after only a few processes.
 
 In order to run this properly, ensure you have the following:
 1. Updated arguments.txt to match with your parameters
@@ -22,12 +22,11 @@ NOTE: For now it has some hard-coded things specific to Finland, so refrain from
 
 '''
 
-import os,sys, subprocess, shutil, csv, time, datetime
-import threading
-from queue import Queue
-
-# Queue to hold processing tasks
-file_queue = Queue()
+import os,sys, subprocess, shutil, csv, time, datetime, json
+from processing_parameters import read_processing_parameters
+from product_cache import product_key, lookup
+from scene_catalog import parse_product_name, scene_facts, lookup_scenes, catalog_path
+from dem_window import resolve_dem
 
 def read_arguments_from_file(file_path):
     '''
@@ -48,98 +47,96 @@ def read_arguments_from_file(file_path):
                 arguments[arg_name.strip()] = arg_value.strip()
     return arguments
 
-def process_sar_data(image1, image2, dataPath, pathToDem, pathToShapefile, cache_dir):
-    """
-    Caller function to the subscript which does the processing.
+def group_slices(names, maxGap=10, scenes=None):
+    '''
+    Group products into processing units in a single pass. Products are indexed by absolute orbit, sorted by
+    acquisition start, and consecutive slices are kept together for slice assembly. A new group is started whenever
+    the gap between two slices of the same orbit exceeds maxGap seconds.
     
     Input:
-    - image1 (str): Full path to the first .SAFE folder to be processed. 
-    - image2 (str): Full path to the second .SAFE folder to be processed. Can be 'none' when no slice assembly is needed.
-    """
-    # Construct the command to run snap_process.py with the specified arguments
-    command = [
-        'python3', 'snap_process.py',
-        image1, image2, dataPath, pathToDem, pathToShapefile]
+    - names (list) - Names of the products.
+    - maxGap (int) - Largest allowed gap between the end of a slice and the start of the next one, in seconds.
+    - scenes (dict) - Output of scene_catalog.lookup_scenes. Products not in it are parsed from their names.
+    
+    Output:
+    - groups (list) - List of groups, each a tuple of the orbit and the names of its slices in acquisition order.
+    '''
+    orbits = {}
+    for name in names:
+        start, stop, orbit = scene_facts(name, scenes)
+        orbits.setdefault(orbit, []).append((start, stop, name))
+
+    groups = []
+    for orbit in sorted(orbits):
+        group = []
+        previous_stop = None
+        for start, stop, name in sorted(orbits[orbit]):
+            if group and (start - previous_stop).total_seconds() > maxGap:
+                groups.append((orbit, group))
+                group = []
+            group.append(name)
+            previous_stop = stop
+        groups.append((orbit, group))
+    return groups
+
+
+def plan_slice_groups(dataPath, maxGap=10, catalogPath=None):
+    '''
+    Group the products of a folder into processing units, see group_slices.
+    
+    Input:
+    - dataPath (str) - Path to the directory containing .SAFE folders or product zips.
+    - maxGap (int) - Largest allowed gap between the end of a slice and the start of the next one, in seconds.
+    - catalogPath (str) - Full path to the scene catalog, or None to parse the product names.
+    
+    Output:
+    - plan (list) - List of groups, each a dictionary with the orbit and the full paths of its slices in acquisition order.
+    '''
+    # Products left zipped (productAccess zip) are read by SNAP directly
+    files = os.listdir(dataPath)
+    names = [filename for filename in files if filename.endswith('.SAFE')
+             or (filename.endswith('.zip') and filename.replace('.zip', '.SAFE') not in files)]
+    return [{'orbit': orbit, 'images': [os.path.join(dataPath, name) for name in group]}
+            for orbit, group in group_slices(names, maxGap, lookup_scenes(catalogPath, names))]
+
+
+def write_plan(plan, pathToPlan):
+    '''
+    Save the processing plan as json, so that the grouping of a run can be inspected afterwards.
     
-    # Run the command using subprocess
-    try:
-        subprocess.run(command, check=True)
-    except subprocess.CalledProcessError as e:
-        print('Error!')
-        sys.exit(1)
+    Input:
+    - plan (list) - Output of plan_slice_groups.
+    - pathToPlan (str) - Full path to the json file.
+    '''
+    with open(pathToPlan, 'w') as file:
+        json.dump({'created': datetime.datetime.now().isoformat(), 'groups': plan}, file, indent=2)
 
 
-def enqueue_files(dataPath, pathToDem, pathToShapefile):
+def enqueue_files(dataPath, pathToDem, pathToShapefile, parameters, catalogPath=None):
     """
-    Function to enqueue SAR data files for processing.
+    Function to plan the SAR data files for processing. Units that are already processed with the same parameters are left out.
     
     Input:
     - dataPath (str): Path to the directory containing .SAFE folders.
     - pathToDem (str): Path to the DEM file.
     - pathToShapefile (str): Path to the shapefile.
+    - parameters (dict): Output of read_processing_parameters.
+    - catalogPath (str): Full path to the scene catalog, or None.
+    
+    Output:
+    - tasks (list): Processing tasks for the SNAP workers.
     """
-    used_files = []
-    # Iterate through files in the folder
-    for filename1 in os.listdir(dataPath):
-        combined = False
-        # Ensure that the file still exists after possible deletions
-        if not os.path.exists(os.path.join(dataPath, filename1)):
-            continue
-
-        if filename1 in used_files:
-            continue
-
-        if not filename1.endswith('.SAFE'):
-            continue
-
-        # Get the absolute orbit identifier
-        orbit1 = filename1.split('_')[6]
-
-        # Iterate through files again to compare with other files
-        for filename2 in os.listdir(dataPath):
-            # Ensure that we're not comparing the file with itself
-            if filename1 == filename2:
-                continue
-            # Ensure that we're only working with .SAFE data
-            if not filename2.endswith('.SAFE'):
-                continue
-
-            # Ensure that the file still exists after possible deletions
-            if filename2 in used_files:
-                continue
-
-            # Get the second absolute orbit identifier
-            orbit2 = filename2.split('_')[6]
-
-            # Check if the orbits match, then perform processing
-            if orbit1 == orbit2:
-                #print(f'Sending to process: {filename1} and {filename2}')
-                # Enqueue the processing function with filenames
-                file_queue.put((process_sar_data, (os.path.join(dataPath, filename1), os.path.join(dataPath, filename2), dataPath, pathToDem, pathToShapefile, os.path.join(dataPath, "snap_cache"))))
-                time.sleep(10)
-                # Mark filenames as used
-                used_files.append(filename1)
-                used_files.append(filename2)
-                combined = True
-                # Break the second loop, move to next file in the first loop
-                break
-
-        # If no match is found after searching all files, enqueue processing for just the one image
-        if not combined:
-            #print(f'Sending to process: {filename1}')
-            file_queue.put((process_sar_data, (os.path.join(dataPath, filename1), 'none', dataPath, pathToDem, pathToShapefile, os.path.join(dataPath, "snap_cache"))))
-            time.sleep(10)
-            used_files.append(filename1)
-
-
-def worker():
-    """
-    Worker function to process tasks from the file_queue.
-    """
-    while True:
-        func, args = file_queue.get()
-        func(*args)
-        file_queue.task_done()
+    plan = plan_slice_groups(dataPath, catalogPath=catalogPath)
+    write_plan(plan, os.path.join(dataPath, 'processing_plan.json'))
+
+    tasks = []
+    for group in plan:
+        key, entry = product_key(group['images'], parameters, resolve_dem(pathToDem), pathToShapefile)
+        if lookup(dataPath, key) is None:
+            tasks.append((group['images'], dataPath, pathToDem, pathToShapefile))
+    print(f'Planned {len(plan)} processing units, {len(plan) - len(tasks)} of them already processed.')
+
+    return tasks
 
 def main():
     # Main function to call all sub-functions and subscripts.
@@ -159,32 +156,28 @@ def main():
         filename = os.path.splitext(filename)[0]
         pathToShapefile = os.path.join(path, f'{filename}.shp')
         pathToDem = os.path.join(path, f'{filename}_dem.tif')
+    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
+    parameters = read_processing_parameters(args, bulkDownload)
+    workerMaxProducts = int(args.get('workerMaxProducts', 10))
+    workerMaxMemory = float(args.get('workerMaxMemory', 0))
     # ------- END ARGUMENT CALL -------- 
-    # Ensure pipeline is clean
-    processinglimit_filepath = os.path.join(os.getcwd(), "processinglimit.txt")
-    if os.path.exists(processinglimit_filepath):
-        os.remove(processinglimit_filepath)
-
-    
-    # Number of worker threads (max of 4 is recommended)
-    num_threads = 6
 
-    # Start worker threads
-    for _ in range(num_threads):
-        threading.Thread(target=worker, daemon=True).start()
-
-    # Enqueue files for processing
-    enqueue_files(dataPath, pathToDem, pathToShapefile)
-
-    # Wait for all tasks to be processed
-    file_queue.join()
+    # Plan the processing units
+    tasks = enqueue_files(dataPath, pathToDem, pathToShapefile, parameters, catalog_path(path))
+    if not tasks:
+        print("All tasks completed.")
+        return
+
+    # Process them with long-lived SNAP workers
+    from snap_worker import run_workers
+    from scheduler import pool_size
+    snapWorkers = pool_size(args.get('snapWorkers', 'auto'), parameters['memoryPerScene'], parameters['maxConcurrentScenes'])
+    print(f'Processing with {snapWorkers} SNAP workers.')
+    failed = run_workers(tasks, snapWorkers, workerMaxProducts, workerMaxMemory)
+    if failed:
+        print(f'{len(failed)} processing units failed: {failed}')
 
     print("All tasks completed.")
 
-    # Remove used locks and processing limits
-    lock_filepath = os.path.join(os.getcwd(), "lock.lock")
-    os.remove(lock_filepath)
-    os.remove(processinglimit_filepath)
-
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,122 @@
+'''
+Resolution of the processing parameters from arguments.csv. Kept apart from snap_process.py, so that the parameters can be
+read without starting SNAP, e.g. to look up already processed products.
+'''
+
+
+def read_processing_parameters(args, bulkDownload=True):
+    '''
+    Resolve the processing preset, or the custom processing booleans, from the arguments file.
+    
+    Input:
+    - args (dict) - Output of read_arguments_from_file.
+    - bulkDownload (bool) - Whether the images are downloaded in bulk. multiTarget needs the bulk layout of the results.
+    
+    Output:
+    - parameters (dict) - The effective processing parameters.
+    '''
+    if args.get('multiTarget') == 'True' and not bulkDownload:
+        raise ValueError('multiTarget needs bulk download (-b). Set multiTarget to False in arguments.csv.')
+    deleteUnprocessedImages = args.get('deleteUnprocessedImages')
+    process = args.get('process')
+    if process == 'GRD':
+        applyOrbitFile = True
+        thermalNoiseRemoval = True
+        calibration = True
+        complexOutput = False
+        speckleFiltering = True
+        filterResolution = 5
+        terrainCorrection = True
+        terrainResolution = 10.0
+        bandMaths = False
+        linearToDb = True
+        slcSplit = False
+        slcDeburst = False
+        polarimetricSpeckleFiltering = False
+        polarimetricParameters = False
+        multilook = False
+        
+    elif process == 'SLC':
+        applyOrbitFile = True
+        thermalNoiseRemoval = False
+        calibration = True
+        complexOutput = True
+        speckleFiltering = True
+        filterResolution = 5
+        terrainCorrection = True
+        terrainResolution = 10.0
+        bandMaths = False
+        linearToDb = False
+        slcSplit = True
+        slcDeburst = True
+        polarimetricSpeckleFiltering = False
+        polarimetricParameters = False
+        multilook = True
+        
+    elif process == 'polSAR':
+        applyOrbitFile = True
+        thermalNoiseRemoval = False
+        calibration = True
+        complexOutput = True
+        speckleFiltering = False
+        filterResolution = 5
+        terrainCorrection = True
+        terrainResolution = 10.0
+        bandMaths = False
+        linearToDb = False
+        slcSplit = False
+        slcDeburst = True
+        polarimetricSpeckleFiltering = True
+        polarimetricParameters = True
+        multilook = True
+        
+        
+    else:
+        polarization = args.get('polarization') 
+        slcSplit = args.get('slcSplit') == 'True'
+        applyOrbitFile = args.get('applyOrbitFile') == 'True'
+        thermalNoiseRemoval = args.get('thermalNoiseRemoval') == 'True'
+        calibration = args.get('calibration') == 'True'
+        complexOutput = args.get('complexOutput') == 'True'
+        slcDeburst = args.get('slcDeburst') == 'True'
+        speckleFiltering = args.get('speckleFiltering') == 'True'
+        polarimetricSpeckleFiltering = args.get('polarimetricSpeckleFiltering') == 'True'
+        polarimetricParameters = args.get('polarimetricParameters') == 'True'
+        filterResolution = args.get('filterResolution')
+        terrainCorrection = args.get('terrainCorrection') == 'True'
+        terrainResolution = args.get('terrainResolution')
+        bandMaths = args.get('bandMaths') == 'True'
+        bandMathExpression = args.get('bandMathsExpression')
+        linearToDb = args.get('linearToDb') == 'True'
+        multilook = args.get('multilook') == 'True'
+        
+    parameters = {
+        'process': process,
+        'deleteUnprocessedImages': deleteUnprocessedImages,
+        'applyOrbitFile': applyOrbitFile,
+        'thermalNoiseRemoval': thermalNoiseRemoval,
+        'calibration': calibration,
+        'complexOutput': complexOutput,
+        'speckleFiltering': speckleFiltering,
+        'filterResolution': filterResolution,
+        'terrainCorrection': terrainCorrection,
+        'terrainResolution': terrainResolution,
+        'bandMaths': bandMaths,
+        'bandMathExpression': args.get('bandMathsExpression'),
+        'linearToDb': linearToDb,
+        'slcSplit': slcSplit,
+        'slcDeburst': slcDeburst,
+        'polarimetricSpeckleFiltering': polarimetricSpeckleFiltering,
+        'polarimetricParameters': polarimetricParameters,
+        'multilook': multilook,
+        'aoiFirst': args.get('aoiFirst') == 'True',
+        'outputFormat': args.get('outputFormat', 'GeoTIFF'),
+        'bigTiff': args.get('bigTiff', 'IF_SAFER'),
+        'multiTarget': args.get('multiTarget') == 'True',
+        # Only selective access leaves polarizations out of the product
+        'selectedPolarizations': args.get('selectedPolarizations', 'all') if args.get('productAccess') == 'selective' else 'all',
+        'instrumentation': args.get('instrumentation', 'False'),
+        'memoryPerScene': float(args.get('memoryPerScene', 8)),
+        'maxConcurrentScenes': int(args.get('maxConcurrentScenes', 0)),
+    }
+    return parameters
@@ -0,0 +1,167 @@
+'''
+Access to the downloaded Sentinel-1 products, replacing the full extraction of every zip.
+
+A product zip holds much more than the processing reads: quick-looks, KML, xsd schemas and the measurement rasters
+of every polarization. Depending on productAccess in arguments.csv, a product is either
+- extract: fully extracted, as before,
+- selective: extracted with only the manifest, the annotation (incl. calibration and noise) and the measurement
+  rasters of selectedPolarizations,
+- zip: not extracted at all. SNAP reads the .zip directly.
+
+With extractToScratch, the products are extracted to node-local storage ($LOCAL_SCRATCH) instead of the results folder,
+and a symbolic link to them is left in the results folder. This only works when the products are processed in the same
+batch job, since the node-local storage is cleared at the end of the job.
+'''
+import os, shutil, zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def access_options(args):
+    '''
+    Read the product access settings from the arguments file.
+
+    Input:
+    - args (dict) - Output of read_arguments_from_file.
+
+    Output:
+    - options (dict) - productAccess, polarizations, workers and toScratch, as taken by extract_products.
+    '''
+    selected = args.get('selectedPolarizations', 'all')
+    return {
+        'productAccess': args.get('productAccess', 'extract'),
+        'polarizations': [] if selected == 'all' else selected.replace('+', ' ').split(),
+        'workers': int(args.get('extractWorkers', 4)),
+        'toScratch': args.get('extractToScratch') == 'True',
+    }
+
+
+def wanted_member(member, polarizations):
+    '''
+    Decide whether a member of a product zip is needed for the processing.
+
+    Input:
+    - member (str) - Name of the member, e.g. S1A_..._ABCD.SAFE/measurement/s1a-iw-grd-vv-...-001.tiff
+    - polarizations (list) - Polarizations to keep in lower case, e.g. ['vv'], or an empty list to keep all.
+
+    Output:
+    - wanted (bool) - True if the member is extracted.
+    '''
+    parts = member.split('/')
+    # Drop the .SAFE folder
+    relative = '/'.join(parts[1:]) if parts[0].endswith('.SAFE') else member
+    if relative in ('', 'manifest.safe'):
+        return True
+    if not (relative.startswith('annotation/') or relative.startswith('measurement/')):
+        return False
+    if not polarizations or member.endswith('/'):
+        return True
+    # Annotation, calibration, noise and measurement files name their polarization, e.g. s1a-iw-grd-vv-...
+    fields = os.path.basename(relative).lower().split('-')
+    return any(polarization in fields for polarization in polarizations)
+
+
+def scratch_directory():
+    '''
+    Node-local folder for the extracted products.
+
+    Output:
+    - path (str) - Full path to the folder, or None if no node-local storage is available.
+    '''
+    scratch = os.environ.get('LOCAL_SCRATCH')
+    if not scratch:
+        return None
+    path = os.path.join(scratch, 'sarp_products')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def extract_product(zipPath, dataPath, productAccess='extract', polarizations=None, scratch=None):
+    '''
+    Make a downloaded product readable for SNAP.
+
+    Input:
+    - zipPath (str) - Full path to the product zip.
+    - dataPath (str) - Full path to the folder of the images.
+    - productAccess (str) - extract, selective or zip, see above.
+    - polarizations (list) - Polarizations to extract in selective mode, e.g. ['VV']. None or an empty list keeps all.
+    - scratch (str) - Folder to extract to instead of dataPath, or None.
+
+    Output:
+    - product (str) - Full path to the product to be read: the .SAFE folder (or its link), or the zip in zip mode.
+    '''
+    if productAccess == 'zip':
+        return zipPath
+
+    name = os.path.splitext(os.path.basename(zipPath))[0]
+    target = scratch if scratch else dataPath
+    product = os.path.join(target, f'{name}.SAFE')
+    polarizations = [polarization.lower() for polarization in polarizations or []]
+
+    # Extract into a temporary folder first, so that an interrupted extraction is never mistaken for a product
+    partial = os.path.join(target, f'{name}.partial')
+    shutil.rmtree(partial, ignore_errors=True)
+    with zipfile.ZipFile(zipPath, 'r') as zip_ref:
+        if productAccess == 'selective':
+            members = [member for member in zip_ref.namelist() if wanted_member(member, polarizations)]
+        else:
+            members = None
+        zip_ref.extractall(partial, members=members)
+    shutil.rmtree(product, ignore_errors=True)
+    os.rename(os.path.join(partial, f'{name}.SAFE'), product)
+    shutil.rmtree(partial, ignore_errors=True)
+    os.remove(zipPath)
+
+    if scratch:
+        link = os.path.join(dataPath, f'{name}.SAFE')
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(product, link)
+        return link
+    return product
+
+
+def extract_products(dataPath, productAccess='extract', polarizations=None, workers=4, toScratch=False):
+    '''
+    Extract all product zips of a folder in parallel.
+
+    Input:
+    - dataPath (str) - Full path to the folder of the downloaded zips.
+    - productAccess (str) - extract, selective or zip, see above.
+    - polarizations (list) - Polarizations to extract in selective mode.
+    - workers (int) - Number of products extracted at the same time. Unzipping is mostly disk bound, so a few are enough.
+    - toScratch (bool) - Whether to extract to node-local storage.
+
+    Output:
+    - products (list) - Full paths to the products to be read.
+    '''
+    zips = sorted(os.path.join(dataPath, file) for file in os.listdir(dataPath) if file.endswith('.zip'))
+    scratch = scratch_directory() if toScratch else None
+    if toScratch and scratch is None:
+        print('LOCAL_SCRATCH is not set, extracting to the results folder.')
+
+    products = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(extract_product, file, dataPath, productAccess, polarizations, scratch): file
+                   for file in zips}
+        for future in as_completed(futures):
+            try:
+                products.append(future.result())
+            except (zipfile.BadZipFile, OSError) as e:
+                print(f'Could not extract {futures[future]}: {e}')
+    return sorted(products)
+
+
+def remove_product(image):
+    '''
+    Remove a raw product after processing: a .SAFE folder, a link to one on node-local storage, or a zip.
+
+    Input:
+    - image (str) - Full path to the product.
+    '''
+    if os.path.islink(image):
+        shutil.rmtree(os.path.realpath(image), ignore_errors=True)
+        os.remove(image)
+    elif os.path.isdir(image):
+        shutil.rmtree(image)
+    elif os.path.isfile(image):
+        os.remove(image)
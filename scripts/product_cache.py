@@ -0,0 +1,220 @@
+'''
+Cache of processed products, so that reruns skip the scenes that are already done.
+
+Each processed image is recorded in product_cache.json next to the images, under a key made of the scene IDs, the
+effective processing parameters, the DEM and a hash of the target geometry. A scene is only processed again when one of
+those changes. Post-processing parameters (timeseries, movingAverage, ...) are not part of the key, so changing them
+does not trigger any SNAP processing.
+'''
+import os, json, hashlib, fcntl, datetime
+
+# Parameters that change the processed image. Scheduling and clean-up options are left out on purpose.
+PROCESSING_KEYS = ['process', 'applyOrbitFile', 'thermalNoiseRemoval', 'calibration', 'complexOutput',
+                   'speckleFiltering', 'filterResolution', 'terrainCorrection', 'terrainResolution', 'bandMaths',
+                   'bandMathExpression', 'linearToDb', 'slcSplit', 'slcDeburst', 'polarimetricSpeckleFiltering',
+                   'polarimetricParameters', 'multilook', 'aoiFirst', 'outputFormat', 'multiTarget',
+                   'selectedPolarizations']
+
+
+def parameters_hash(parameters):
+    '''
+    Hash of the parameters that affect the processed image.
+
+    Input:
+    - parameters (dict) - Output of read_processing_parameters.
+
+    Output:
+    - hash (str) - Hex digest.
+    '''
+    # Presets and custom settings are stored as different types (5 vs '5'), so compare them as strings
+    relevant = {key: str(parameters.get(key)) for key in PROCESSING_KEYS}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def file_hash(path):
+    '''
+    Hash of the contents of a file, e.g. the geometry (.shp) of the target.
+
+    Input:
+    - path (str) - Full path to the file.
+
+    Output:
+    - hash (str) - Hex digest, or 'none' if the file does not exist.
+    '''
+    if not os.path.exists(path):
+        return 'none'
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_dem_description(pathToDem):
+    '''
+    Read what a DEM was made from, see write_dem_description.
+
+    Input:
+    - pathToDem (str) - Full path to the DEM, a GeoTIFF or a VRT.
+
+    Output:
+    - description (dict) - The description, or None if there is none.
+    '''
+    try:
+        with open(f'{pathToDem}.json') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_dem_description(pathToDem, description):
+    '''
+    Store what a DEM was made from (source, area and pixel size) next to it, as <DEM>.json. download_dem.py writes the
+    DEM again on every run, so the description identifies it instead of its modification time.
+
+    Input:
+    - pathToDem (str) - Full path to the DEM.
+    - description (dict) - The description, or None to remove it.
+    '''
+    path = f'{pathToDem}.json'
+    if description is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(description, file, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def dem_signature(pathToDem):
+    '''
+    Identify the DEM by what it was made from, or by path, size and modification time if that is not known. Without an
+    external DEM, SNAP uses the Copernicus DEM.
+
+    Input:
+    - pathToDem (str) - Full path to the DEM.
+
+    Output:
+    - signature (str) - Identifier of the DEM.
+    '''
+    if not os.path.exists(pathToDem):
+        return 'Copernicus 30m Global DEM'
+    description = read_dem_description(pathToDem)
+    if description is not None:
+        return json.dumps(description, sort_keys=True)
+    stat = os.stat(pathToDem)
+    return f'{os.path.abspath(pathToDem)}:{stat.st_size}:{int(stat.st_mtime)}'
+
+
+def scene_id(image):
+    '''
+    Product ID of an image, i.e. its name without the .SAFE or .zip extension.
+    '''
+    return os.path.splitext(os.path.basename(image.rstrip('/')))[0]
+
+
+def product_key(images, parameters, pathToDem, pathToShapefile):
+    '''
+    Build the cache key of a processing unit.
+
+    Input:
+    - images (list) - Full paths to the SAR images of the unit.
+    - parameters (dict) - Output of read_processing_parameters.
+    - pathToDem (str) - Full path to the DEM.
+    - pathToShapefile (str) - Full path to the target shapefile.
+
+    Output:
+    - key (str) - The cache key.
+    - entry (dict) - The components of the key, stored along with the output.
+    '''
+    entry = {
+        'scenes': [scene_id(image) for image in images],
+        'parameters': parameters_hash(parameters),
+        'dem': dem_signature(pathToDem),
+        'aoi': file_hash(pathToShapefile),
+    }
+    key = hashlib.sha1(json.dumps(entry, sort_keys=True).encode()).hexdigest()
+    return key, entry
+
+
+def read_index(dataPath):
+    '''
+    Read the cache index of a folder of processed images.
+
+    Input:
+    - dataPath (str) - Full path to the folder of processed images.
+
+    Output:
+    - index (dict) - Cache entries by key.
+    '''
+    path = os.path.join(dataPath, 'product_cache.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except ValueError:
+            return {}
+
+
+def lookup(dataPath, key):
+    '''
+    Find an already processed image.
+
+    Input:
+    - dataPath (str) - Full path to the folder of processed images.
+    - key (str) - Output of product_key.
+
+    Output:
+    - output (str) - Full path to the processed image, or None if it is not cached or has been removed. With several
+      outputs (one per target), the first one is returned, and only if all of them still exist.
+    '''
+    entry = read_index(dataPath).get(key)
+    if entry is None:
+        return None
+    outputs = entry['output'] if isinstance(entry['output'], list) else [entry['output']]
+    outputs = [os.path.normpath(os.path.join(dataPath, output)) for output in outputs]
+    return outputs[0] if all(os.path.exists(output) for output in outputs) else None
+
+
+def processed_scenes(dataPath, parameters, pathToShapefile):
+    '''
+    Find the scenes that are already processed with the current parameters for the target, so that they are not
+    downloaded again. The DEM is left out, since it may not be created yet when the images are downloaded.
+
+    Input:
+    - dataPath (str) - Full path to the folder of processed images.
+    - parameters (dict) - Output of read_processing_parameters.
+    - pathToShapefile (str) - Full path to the target shapefile.
+
+    Output:
+    - scenes (set) - Product IDs of the processed scenes whose outputs still exist.
+    '''
+    parameters = parameters_hash(parameters)
+    aoi = file_hash(pathToShapefile)
+    scenes = set()
+    for key, entry in read_index(dataPath).items():
+        if entry.get('parameters') == parameters and entry.get('aoi') == aoi and lookup(dataPath, key) is not None:
+            scenes.update(entry['scenes'])
+    return scenes
+
+
+def record(dataPath, key, entry, outputFilename):
+    '''
+    Add a processed image to the cache. Several workers may write at the same time, so the index is updated under a lock.
+
+    Input:
+    - dataPath (str) - Full path to the folder of processed images.
+    - key (str) - Output of product_key.
+    - entry (dict) - Output of product_key.
+    - outputFilename (str or list) - Name of the processed image in dataPath, or the paths of several images relative to dataPath.
+    '''
+    with open(os.path.join(dataPath, 'product_cache.lock'), 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        index = read_index(dataPath)
+        index[key] = dict(entry, output=outputFilename, created=datetime.datetime.now().isoformat())
+        temporary = os.path.join(dataPath, 'product_cache.json.tmp')
+        with open(temporary, 'w') as file:
+            json.dump(index, file, indent=2)
+        os.replace(temporary, os.path.join(dataPath, 'product_cache.json'))
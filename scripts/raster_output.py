@@ -0,0 +1,75 @@
+'''
+Helpers for writing rasters in a layout that is cheap to store and to read in windows.
+
+SNAP writes striped, uncompressed GeoTIFFs. They are converted here into internally tiled and compressed GeoTIFFs
+with overviews, optionally as Cloud-Optimized GeoTIFFs. GDAL copies the data block by block, so the conversion does not
+need to hold the image in memory.
+'''
+import os, sys, subprocess
+
+try:
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+except:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--user", "rasterio"])
+    import rasterio
+    import rasterio.shutil
+    from rasterio.enums import Resampling
+
+
+def creation_options(dtype, blockSize=512, compress='DEFLATE', bigTiff='IF_SAFER'):
+    '''
+    GDAL creation options for a tiled, compressed GeoTIFF.
+
+    Input:
+    - dtype (str) - Data type of the raster, decides the predictor.
+    - blockSize (int) - Width and height of the internal tiles.
+    - compress (str) - Compression method, e.g. DEFLATE, LZW or ZSTD.
+    - bigTiff (str) - YES, NO or IF_SAFER. IF_SAFER switches to BigTIFF when the file could exceed 4 GB.
+
+    Output:
+    - options (dict) - Creation options, to be given to rasterio as keyword arguments.
+    '''
+    # Floating point predictor for float data, horizontal differencing for integers
+    predictor = 3 if dtype.startswith('float') else 2
+    return {'tiled': True, 'blockxsize': blockSize, 'blockysize': blockSize,
+            'compress': compress, 'predictor': predictor, 'BIGTIFF': bigTiff}
+
+
+def convert_geotiff(source, destination, outputFormat, compress='DEFLATE', bigTiff='IF_SAFER'):
+    '''
+    Convert a GeoTIFF written by SNAP into a tiled, compressed GeoTIFF with overviews, or a Cloud-Optimized GeoTIFF.
+
+    Input:
+    - source (str) - Full path to the GeoTIFF written by SNAP.
+    - destination (str) - Full path to the converted file.
+    - outputFormat (str) - 'tiled' for an internally tiled GeoTIFF, 'COG' for a Cloud-Optimized GeoTIFF.
+    - compress (str) - Compression method.
+    - bigTiff (str) - YES, NO or IF_SAFER.
+
+    Output:
+    - Converted file in destination. The source is removed.
+    '''
+    with rasterio.open(source) as src:
+        dtype = src.dtypes[0]
+        size = max(src.width, src.height)
+
+    options = creation_options(dtype, compress=compress, bigTiff=bigTiff)
+    if outputFormat == 'COG':
+        # The COG driver tiles, compresses and builds the overviews in the right order by itself
+        rasterio.shutil.copy(source, destination, driver='COG', COMPRESS=compress,
+                             PREDICTOR='YES', BIGTIFF=bigTiff, BLOCKSIZE=options['blockxsize'],
+                             OVERVIEWS='AUTO', RESAMPLING='AVERAGE')
+    else:
+        rasterio.shutil.copy(source, destination, driver='GTiff', **options)
+        factors = []
+        factor = 2
+        while size / factor >= options['blockxsize']:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            with rasterio.open(destination, 'r+') as dst:
+                dst.build_overviews(factors, Resampling.average)
+
+    os.remove(source)
@@ -39,6 +39,13 @@ fi
 
 echo "Bulk download: $bulk_download, Separate polygons: $separate"
 
+# Whether images are processed while they are downloaded (see streaming in arguments.csv)
+streaming=$(awk -F'\t' '$1 == "streaming" {print $2}' ../arguments.csv)
+# Whether bulk targets are split into clusters of nearby targets (see clusterDistance in arguments.csv)
+clustering=$(awk -F'\t' '$1 == "clusterDistance" {print ($2 > 0) ? "True" : "False"}' ../arguments.csv)
+# Whether one process downloads the images of all identifiers (see downloadTogether in arguments.csv)
+download_together=$(awk -F'\t' '$1 == "downloadTogether" {print $2}' ../arguments.csv)
+
 # Set the path to the folder containing the scripts
 script_folder=$(dirname "$0")
 module load geoconda
@@ -57,38 +64,62 @@ fi
 
 
 if [ "$bulk_download" = true ]; then
-    
-    # Download all files over target area
-    start_download=$(date +%s)
-    python download_images.py "$source_path" "$data_path" "$bulk_download"
-    end_download=$(date +%s)
+    # With clustering, every cluster of nearby targets is downloaded and processed as its own bulk project
+    if [ "$clustering" == "True" ] && [ -d "$data_path/clusters" ]; then
+        projects=("$data_path"/clusters/*/)
+    else
+        projects=("$data_path")
+    fi
+
+    for project_path in "${projects[@]}"; do
+        project_path=${project_path%/}
+        if [ "$project_path" == "$data_path" ]; then
+            project_source=$source_path
+        else
+            project_source="$project_path/$(basename "$project_path").shp"
+            echo "Cluster: $(basename "$project_path")"
+        fi
 
-    # Create DEM over the large area
-    python download_dem.py "$source_path" "$data_path" "$bulk_download"
+    if [ "$streaming" == "True" ]; then
+            # Create DEM over the large area, then download and process the images as a stream
+            python download_dem.py "$project_source" "$project_path" "$bulk_download"
+            module load snap
+            source snap_add_userdir $project_path
+            python3 stream_pipeline.py "$project_source" "$project_path" "$bulk_download"
+        else
+            # Download all files over target area
+            start_download=$(date +%s)
+            python download_images.py "$project_source" "$project_path" "$bulk_download"
+            end_download=$(date +%s)
+
+            # Create DEM over the large area
+            python download_dem.py "$project_source" "$project_path" "$bulk_download"
     
-    # Download orbit files
-    python download_orbits.py "$data_path" "$bulk_download"
+            # Download orbit files
+            python download_orbits.py "$project_path" "$bulk_download"
     
-    # Process all images, subset to greatest extent
-    start_process=$(date +%s)
-    module load snap
-    source snap_add_userdir $data_path
-    python3 process_images.py "$source_path" "$data_path" "$bulk_download"
-    end_process=$(date +%s)
+            # Process all images, subset to greatest extent
+            start_process=$(date +%s)
+            module load snap
+            source snap_add_userdir $project_path
+            python3 process_images.py "$project_source" "$project_path" "$bulk_download"
+        fi
+        end_process=$(date +%s)
   
     
-    module load geoconda
-    for folder_path in "$data_path"/*/; do
-        # Extract folder (id) name
-        id=$(basename "$folder_path")
-        if [ "$id" == "SLURM" ] || [ "$id" == "Error" ] || [ "$id" == "tiffs" ] || [ "$id" == "snap_cache" ] || [ "$id" == "*" ]; then
-            continue
-        fi
-        echo "ID: $id"
-
-        # Create timeseries of each target
-        python timeseries.py "$source_path" "$data_path" "$bulk_download" "$id"
-    done    
+        module load geoconda
+        for folder_path in "$project_path"/*/; do
+            # Extract folder (id) name
+            id=$(basename "$folder_path")
+            if [ "$id" == "SLURM" ] || [ "$id" == "Error" ] || [ "$id" == "tiffs" ] || [ "$id" == "snap_cache" ] || [ "$id" == "clusters" ] || [ "$id" == "*" ]; then
+                continue
+            fi
+            echo "ID: $id"
+
+            # Create timeseries of each target
+            python timeseries.py "$project_source" "$project_path" "$bulk_download" "$id"
+        done
+    done
 
     runtime=$((end_download-start_download))
     echo "Download execution time: $runtime seconds"
@@ -102,6 +133,9 @@ if [ "$bulk_download" = true ]; then
     
 
 else
+ if [ "$streaming" != "True" ] && [ "$download_together" == "True" ]; then
+    python download_images.py "$source_path" "$data_path" "$bulk_download" all
+ fi
  for folder_path in "$data_path"/*/; do
         # Extract folder (id) name
         id=$(basename "$folder_path")
@@ -109,15 +143,24 @@ else
             continue
         fi
         echo "ID: $id"
-        python download_images.py "$source_path" "$data_path" "$bulk_download" "$id"
-        python download_dem.py "$source_path" "$data_path" "$bulk_download" "$id"
+        if [ "$streaming" == "True" ]; then
+            python download_dem.py "$source_path" "$data_path" "$bulk_download" "$id"
+            module load snap
+            source snap_add_userdir $data_path
+            python3 stream_pipeline.py "$source_path" "$data_path" "$bulk_download" "$id"
+        else
+            if [ "$download_together" != "True" ]; then
+                python download_images.py "$source_path" "$data_path" "$bulk_download" "$id"
+            fi
+            python download_dem.py "$source_path" "$data_path" "$bulk_download" "$id"
         
-        # Download orbit files
-        python download_orbits.py "$data_path" "$bulk_download" "$id"  
+            # Download orbit files
+            python download_orbits.py "$data_path" "$bulk_download" "$id"  
     
-        module load snap
-        source snap_add_userdir $data_path
-        python3 process_images.py "$source_path" "$data_path" "$bulk_download" "$id"
+            module load snap
+            source snap_add_userdir $data_path
+            python3 process_images.py "$source_path" "$data_path" "$bulk_download" "$id"
+        fi
         
         module load geoconda
         python timeseries.py "$source_path" "$data_path" "$bulk_download" "$id"
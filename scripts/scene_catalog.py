@@ -0,0 +1,287 @@
+'''
+Local catalog of the found scenes.
+
+The metadata of every search (download_images.py, stream_pipeline.py) is stored in an SQLite database in
+path/.cache/scene_catalog.sqlite: product ID, acquisition times, absolute and relative orbit, frame, flight direction,
+polarization, size, footprint and where the product was downloaded to. The acquisition times are indexed and the
+footprints have an R*Tree index, so the scenes of a period or an area are found without searching ASF again. Planning,
+orbit download and processing read the times and orbits of a product from the catalog instead of splitting its name.
+Products that are not in the catalog (e.g. downloaded by hand) fall back to their name.
+'''
+import os, json, sqlite3, datetime
+from contextlib import closing
+from scene_store import store_directory
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    product_id TEXT PRIMARY KEY,
+    file_name TEXT,
+    start TEXT,
+    stop TEXT,
+    absolute_orbit INTEGER,
+    relative_orbit INTEGER,
+    frame INTEGER,
+    direction TEXT,
+    polarization TEXT,
+    processing_level TEXT,
+    platform TEXT,
+    bytes INTEGER,
+    footprint TEXT,
+    local_path TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS scenes_start ON scenes (start);
+CREATE INDEX IF NOT EXISTS scenes_orbit ON scenes (relative_orbit, direction);
+CREATE VIRTUAL TABLE IF NOT EXISTS scenes_footprint USING rtree (id, min_lon, max_lon, min_lat, max_lat);
+'''
+
+COLUMNS = ['product_id', 'file_name', 'start', 'stop', 'absolute_orbit', 'relative_orbit', 'frame', 'direction',
+           'polarization', 'processing_level', 'platform', 'bytes', 'footprint', 'local_path']
+
+
+def catalog_path(path):
+    '''
+    Location of the catalog for a results folder. Clusters (see initialize.py) share the catalog of the whole run.
+
+    Input:
+    - path (str) - Full path to the results folder, or to the folder of a cluster.
+
+    Output:
+    - catalogPath (str) - Full path to the catalog.
+    '''
+    return os.path.join(os.path.dirname(store_directory(path)), 'scene_catalog.sqlite')
+
+
+def find_catalog(dataPath):
+    '''
+    Find the catalog of a tiffs folder, which is one (bulk, cluster) or two (identifier) levels below the results folder.
+
+    Input:
+    - dataPath (str) - Full path to the tiffs folder.
+
+    Output:
+    - catalogPath (str) - Full path to the catalog, or None if there is none.
+    '''
+    folder = os.path.abspath(dataPath)
+    for _ in range(3):
+        folder = os.path.dirname(folder)
+        candidate = catalog_path(folder)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def connect(catalogPath):
+    '''
+    Open the catalog, creating it if needed. Several identifiers may write to it at the same time, so writers wait for
+    each other instead of failing.
+
+    Input:
+    - catalogPath (str) - Full path to the catalog.
+
+    Output:
+    - connection (sqlite3.Connection) - The open catalog.
+    '''
+    os.makedirs(os.path.dirname(catalogPath), exist_ok=True)
+    connection = sqlite3.connect(catalogPath, timeout=60)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def product_id(name):
+    '''
+    Product ID of a product name, file name or path, e.g. S1A_IW_GRDH_1SDV_..._ABCD.SAFE -> S1A_IW_GRDH_1SDV_..._ABCD
+    '''
+    name = os.path.basename(name.rstrip('/'))
+    for extension in ('.SAFE', '.zip'):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def parse_time(value):
+    '''
+    Parse an ASF time (e.g. 2021-03-01T16:00:00.123Z) to a datetime, to the second like in the product names.
+    '''
+    return datetime.datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def parse_product_name(filename):
+    '''
+    Parse the acquisition times and absolute orbit from a S1 product name.
+    SLC names have a double underscore after the product type, so empty fields are dropped before indexing.
+
+    Input:
+    - filename (str) - Name of the product, e.g. S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_ABCD.SAFE
+
+    Output:
+    - start (datetime) - Start of the acquisition.
+    - stop (datetime) - End of the acquisition.
+    - orbit (str) - Absolute orbit number.
+    '''
+    fields = [field for field in os.path.splitext(filename)[0].split('_') if field]
+    start = datetime.datetime.strptime(fields[4], '%Y%m%dT%H%M%S')
+    stop = datetime.datetime.strptime(fields[5], '%Y%m%dT%H%M%S')
+    orbit = fields[6]
+    return start, stop, orbit
+
+
+def footprint_bounds(geometry):
+    '''
+    Bounding box of a geojson geometry.
+
+    Output:
+    - bounds (tuple) - min_lon, max_lon, min_lat, max_lat.
+    '''
+    coordinates = geometry['coordinates']
+    while isinstance(coordinates[0][0], list):
+        coordinates = [point for part in coordinates for point in part]
+    lons = [point[0] for point in coordinates]
+    lats = [point[1] for point in coordinates]
+    return min(lons), max(lons), min(lats), max(lats)
+
+
+def add_results(catalogPath, results):
+    '''
+    Add the products of a search to the catalog. Products already in it are updated, keeping their local path.
+
+    Input:
+    - catalogPath (str) - Full path to the catalog.
+    - results (ASFSearchResults) - The found products, or CachedResults.
+    '''
+    updated = datetime.datetime.now().isoformat(timespec='seconds')
+    with closing(connect(catalogPath)) as connection, connection:
+        for feature in results.geojson()['features']:
+            properties = feature['properties']
+            geometry = feature.get('geometry')
+            row = (properties['sceneName'], properties.get('fileName'),
+                   parse_time(properties['startTime']).isoformat(), parse_time(properties['stopTime']).isoformat(),
+                   properties.get('orbit'), properties.get('pathNumber'), properties.get('frameNumber'),
+                   properties.get('flightDirection'), properties.get('polarization'),
+                   properties.get('processingLevel'), properties.get('platform'), properties.get('bytes'),
+                   json.dumps(geometry) if geometry else None, updated)
+            connection.execute('''
+                INSERT INTO scenes (product_id, file_name, start, stop, absolute_orbit, relative_orbit, frame,
+                                    direction, polarization, processing_level, platform, bytes, footprint, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (product_id) DO UPDATE SET
+                    file_name = excluded.file_name, start = excluded.start, stop = excluded.stop,
+                    absolute_orbit = excluded.absolute_orbit, relative_orbit = excluded.relative_orbit,
+                    frame = excluded.frame, direction = excluded.direction, polarization = excluded.polarization,
+                    processing_level = excluded.processing_level, platform = excluded.platform,
+                    bytes = excluded.bytes, footprint = excluded.footprint, updated = excluded.updated''', row)
+            if geometry:
+                rowid = connection.execute('SELECT rowid FROM scenes WHERE product_id = ?',
+                                           (properties['sceneName'],)).fetchone()[0]
+                connection.execute('INSERT OR REPLACE INTO scenes_footprint VALUES (?, ?, ?, ?, ?)',
+                                   (rowid, *footprint_bounds(geometry)))
+
+
+def record_local_path(catalogPath, name, localPath):
+    '''
+    Store where a product was downloaded to.
+
+    Input:
+    - catalogPath (str) - Full path to the catalog.
+    - name (str) - Product ID or file name.
+    - localPath (str) - Full path to the product.
+    '''
+    with closing(connect(catalogPath)) as connection, connection:
+        connection.execute('UPDATE scenes SET local_path = ? WHERE product_id = ?', (localPath, product_id(name)))
+
+
+def scene_row(row):
+    '''
+    Convert a row of the catalog to a dictionary, with the times as datetimes and the footprint as geojson.
+    '''
+    scene = {column: row[column] for column in COLUMNS}
+    scene['start'] = datetime.datetime.fromisoformat(scene['start'])
+    scene['stop'] = datetime.datetime.fromisoformat(scene['stop'])
+    scene['footprint'] = json.loads(scene['footprint']) if scene['footprint'] else None
+    return scene
+
+
+def lookup_scenes(catalogPath, names):
+    '''
+    Look up products in the catalog.
+
+    Input:
+    - catalogPath (str) - Full path to the catalog, or None.
+    - names (list) - Product IDs, file names or paths.
+
+    Output:
+    - scenes (dict) - Product ID: scene dictionary (see COLUMNS) of the products found in the catalog.
+    '''
+    if catalogPath is None or not os.path.exists(catalogPath):
+        return {}
+    ids = sorted({product_id(name) for name in names})
+    scenes = {}
+    with closing(connect(catalogPath)) as connection:
+        # Stay below the SQLite limit of parameters per query
+        for first in range(0, len(ids), 500):
+            batch = ids[first:first + 500]
+            rows = connection.execute(f'SELECT * FROM scenes WHERE product_id IN ({",".join("?" * len(batch))})', batch)
+            for row in rows:
+                scenes[row['product_id']] = scene_row(row)
+    return scenes
+
+
+def find_scenes(catalogPath, start=None, end=None, bounds=None, relativeOrbit=None, direction=None):
+    '''
+    Find the scenes of a period, area and track in the catalog.
+
+    Input:
+    - catalogPath (str) - Full path to the catalog.
+    - start, end (str or datetime) - Period of the acquisition start, end exclusive. None for no limit.
+    - bounds (tuple) - min_lon, min_lat, max_lon, max_lat the footprint has to overlap, or None.
+    - relativeOrbit (int) - Relative orbit (track), or None for all.
+    - direction (str) - ASCENDING or DESCENDING, or None for both.
+
+    Output:
+    - scenes (list) - Scene dictionaries (see COLUMNS) in acquisition order.
+    '''
+    conditions, parameters = [], []
+    if start is not None:
+        conditions.append('scenes.start >= ?')
+        parameters.append(str(start).replace(' ', 'T'))
+    if end is not None:
+        conditions.append('scenes.start < ?')
+        parameters.append(str(end).replace(' ', 'T'))
+    if relativeOrbit is not None:
+        conditions.append('scenes.relative_orbit = ?')
+        parameters.append(relativeOrbit)
+    if direction is not None:
+        conditions.append('scenes.direction = ?')
+        parameters.append(direction)
+    query = 'SELECT scenes.* FROM scenes'
+    if bounds is not None:
+        min_lon, min_lat, max_lon, max_lat = bounds
+        query += ' JOIN scenes_footprint ON scenes_footprint.id = scenes.rowid'
+        conditions += ['scenes_footprint.max_lon >= ?', 'scenes_footprint.min_lon <= ?',
+                       'scenes_footprint.max_lat >= ?', 'scenes_footprint.min_lat <= ?']
+        parameters += [min_lon, max_lon, min_lat, max_lat]
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY scenes.start'
+    with closing(connect(catalogPath)) as connection:
+        return [scene_row(row) for row in connection.execute(query, parameters)]
+
+
+def scene_facts(name, scenes=None):
+    '''
+    Acquisition times and absolute orbit of a product, from the catalog if it is there, otherwise from its name.
+
+    Input:
+    - name (str) - Product ID, file name or path.
+    - scenes (dict) - Output of lookup_scenes, or None.
+
+    Output:
+    - start (datetime) - Start of the acquisition.
+    - stop (datetime) - End of the acquisition.
+    - orbit (str) - Absolute orbit number, zero-padded like in the product names.
+    '''
+    scene = (scenes or {}).get(product_id(name))
+    if scene is None or scene['absolute_orbit'] is None:
+        return parse_product_name(os.path.basename(name.rstrip('/')))
+    return scene['start'], scene['stop'], f"{scene['absolute_orbit']:06d}"
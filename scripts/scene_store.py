@@ -0,0 +1,240 @@
+'''
+Shared store of downloaded products, so that identifiers whose targets are covered by the same images download each
+product only once.
+
+Products are kept as zips in path/.cache/scenes, named by their product ID. An identifier gets a hard link to the stored
+zip in its own tiffs folder (a symbolic link if the folders are on different file systems), which it can unzip and remove
+as before. Each product has its own lock, so when several identifiers need the same product at the same time, one of
+them downloads it and the others wait for it. Whenever a product is added and the store grows over sceneStoreQuota GB,
+the least recently used products are removed.
+'''
+import os, fcntl
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def run_root(path):
+    '''
+    Results folder of the whole run. Clusters (see initialize.py) are folders in results/clusters.
+
+    Input:
+    - path (str) - Full path to the results folder, or to the folder of a cluster.
+
+    Output:
+    - root (str) - Full path to the results folder.
+    '''
+    path = os.path.abspath(path)
+    if os.path.basename(os.path.dirname(path)) == 'clusters':
+        path = os.path.dirname(os.path.dirname(path))
+    return path
+
+
+def store_directory(path):
+    '''
+    Location of the store for a results folder. Clusters (see initialize.py) share the store of the whole run.
+
+    Input:
+    - path (str) - Full path to the results folder, or to the folder of a cluster.
+
+    Output:
+    - storeDir (str) - Full path to the store.
+    '''
+    return os.path.join(run_root(path), '.cache', 'scenes')
+
+
+def link_product(stored, destination):
+    '''
+    Link a stored product into the folder of an identifier.
+
+    Input:
+    - stored (str) - Full path to the zip in the store.
+    - destination (str) - Full path to the link.
+    '''
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(stored, destination)
+    except OSError:
+        os.symlink(stored, destination)
+
+
+def open_lock(path, blocking=True):
+    '''
+    Open and lock the lock file of a product or DEM cell. Lock files are removed together with what they lock, so a
+    lock taken on a file that was removed meanwhile is dropped and taken again on the new file.
+
+    Input:
+    - path (str) - Full path to the lock file.
+    - blocking (bool) - Wait for the lock. If False, give up when another process holds it.
+
+    Output:
+    - lock (file) - The locked file, closing it releases the lock. None if blocking is False and the lock is taken.
+    '''
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    while True:
+        lock = open(path, 'w')
+        try:
+            fcntl.flock(lock.fileno(), flags)
+        except BlockingIOError:
+            lock.close()
+            return None
+        try:
+            current = os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            return lock
+        lock.close()
+
+
+def remove_locked(path):
+    '''
+    Remove a product or DEM cell with its .empty and .lock sidecar files. The caller holds the lock, which is removed
+    last.
+
+    Input:
+    - path (str) - Full path to the product or cell.
+    '''
+    for file in (path, f'{path}.empty', f'{path}.lock'):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+
+def fetch_product(product, storeDir, pathToResult, session, download=None):
+    '''
+    Download a product to the store unless it is already there, and link it to pathToResult.
+
+    Input:
+    - product (ASFProduct) - The product.
+    - storeDir (str) - Full path to the store.
+    - pathToResult (str) - Full path to the tiffs folder of the identifier.
+    - session - Authenticated session.
+    - download (function) - Downloads a product to a folder, downloader.download_product by default.
+
+    Output:
+    - stats (dict) - Output of download, or None if the product came from the store.
+    '''
+    if download is None:
+        from downloader import download_product as download
+    fileName = product.properties['fileName']
+    stored = os.path.join(storeDir, fileName)
+    with open_lock(os.path.join(storeDir, f'{fileName}.lock')):
+        stats = None
+        if not os.path.exists(stored):
+            # The downloader writes to a .part file, so a broken download never shows up in the store
+            stats = download(product, storeDir, session)
+        # The modification time marks the last use, for evict
+        os.utime(stored)
+        link_product(stored, os.path.join(pathToResult, fileName))
+    return stats
+
+
+def evict(storeDir, quota, keep=()):
+    '''
+    Remove the least recently used products until the store fits in the quota. Products that are locked or in keep are
+    left alone.
+
+    Input:
+    - storeDir (str) - Full path to the store.
+    - quota (float) - Size limit of the store in GB. 0 for no limit.
+    - keep (list) - Names of products that must stay.
+
+    Output:
+    - removed (list) - Names of the removed products.
+    '''
+    if quota <= 0:
+        return []
+    products = []
+    for file in os.listdir(storeDir):
+        if file.endswith('.zip'):
+            stat = os.stat(os.path.join(storeDir, file))
+            products.append((stat.st_mtime, stat.st_size, file))
+    total = sum(size for _, size, _ in products)
+
+    removed = []
+    for _, size, file in sorted(products):
+        if total <= quota * 1024**3:
+            break
+        if file in keep:
+            continue
+        lock = open_lock(os.path.join(storeDir, f'{file}.lock'), blocking=False)
+        if lock is None:
+            continue
+        with lock:
+            remove_locked(os.path.join(storeDir, file))
+        total -= size
+        removed.append(file)
+    return removed
+
+
+def reclaim(storeDir, needed, keep=()):
+    '''
+    Remove processed products from the store to free disk space. A product is processed once its link in the results
+    folder is removed (deleteUnprocessedImages), which leaves the store as its only link.
+
+    Input:
+    - storeDir (str) - Full path to the store.
+    - needed (int) - Bytes to free.
+    - keep (list) - Names of products that must stay, e.g. the ones that are not processed yet.
+
+    Output:
+    - freed (int) - Bytes freed.
+    '''
+    products = []
+    for file in os.listdir(storeDir):
+        if file.endswith('.zip') and file not in keep:
+            stat = os.stat(os.path.join(storeDir, file))
+            if stat.st_nlink == 1:
+                products.append((stat.st_mtime, stat.st_size, file))
+
+    freed = 0
+    for _, size, file in sorted(products):
+        if freed >= needed:
+            break
+        lock = open_lock(os.path.join(storeDir, f'{file}.lock'), blocking=False)
+        if lock is None:
+            continue
+        with lock:
+            remove_locked(os.path.join(storeDir, file))
+        freed += size
+    if freed:
+        print(f'Removed processed images from the scene store to free {freed / 1024**3:.1f} GB.')
+    return freed
+
+
+def fetch_products(results, storeDir, pathToResult, session, processes, quota=0, admission=None):
+    '''
+    Fetch all products of a search through the store.
+
+    Input:
+    - results (ASFSearchResults) - The products.
+    - storeDir (str) - Full path to the store.
+    - pathToResult (str) - Full path to the tiffs folder of the identifier.
+    - session - Authenticated session.
+    - processes (int) - How many products are downloaded simultaneously.
+    - quota (float) - Size limit of the store in GB, 0 for no limit.
+    - admission (DiskAdmission) - Waits for disk space before each download, or None.
+    '''
+    from downloader import download_product
+    def download(product, path, session):
+        return download_product(product, path, session, admission=admission)
+
+    os.makedirs(storeDir, exist_ok=True)
+    os.makedirs(pathToResult, exist_ok=True)
+    keep = [product.properties['fileName'] for product in results]
+    fromStore = 0
+    removed = []
+    with ThreadPoolExecutor(max_workers=max(processes, 1)) as executor:
+        futures = {executor.submit(fetch_product, product, storeDir, pathToResult, session, download): product
+                   for product in results}
+        for future in as_completed(futures):
+            try:
+                fromStore += future.result() is None
+            except Exception as e:
+                print(f"Download of {futures[future].properties['fileName']} failed: {e}")
+            # The quota holds during the run, not only at its end
+            removed += evict(storeDir, quota, keep)
+    print(f'{fromStore} of {len(futures)} images were already in the scene store.')
+    if removed:
+        print(f'Removed {len(removed)} least recently used images from the scene store.')
@@ -0,0 +1,270 @@
+'''
+Admission control for the SNAP processing stage.
+
+A scene is admitted when the job has enough free memory (and CPU) for it, instead of when a fixed counter allows it.
+Memory is limited by the node and by the cgroup of the job, CPU by the CPUs allocated to the job. Other jobs on a shared
+node only count through the free memory of the node.
+Each running scene holds a lease file named after its PID. Leases of processes that no longer exist are removed on the
+next admission, so a crash or an early exit never leaks a slot. The admission decision itself is made under an flock,
+which the OS releases automatically if the holder dies.
+'''
+import os, sys, time, json, fcntl, subprocess
+
+try:
+    import psutil
+except:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--user", "psutil"])
+    import psutil
+
+
+lease_directory = os.path.join(os.getcwd(), 'leases')
+
+
+def cgroup_folders(procPath='/proc/self/cgroup', cgroupRoot='/sys/fs/cgroup'):
+    '''
+    Find the memory cgroup of this process, e.g. the one of its SLURM job step, and the cgroups above it.
+
+    Input:
+    - procPath (str) - Full path to the cgroup list of the process.
+    - cgroupRoot (str) - Full path to where the cgroups are mounted.
+
+    Output:
+    - folders (list) - (folder, limit file, usage file) of each cgroup, from the one of the process up to the root.
+    '''
+    try:
+        with open(procPath) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    # cgroup v1 has a memory hierarchy of its own, cgroup v2 a single unified one
+    base = None
+    for line in lines:
+        hierarchy, controllers, path = line.split(':', 2)
+        if 'memory' in controllers.split(','):
+            base, cgroup = os.path.join(cgroupRoot, 'memory'), path
+            names = ('memory.limit_in_bytes', 'memory.usage_in_bytes')
+            break
+        if hierarchy == '0' and controllers == '':
+            base, cgroup = cgroupRoot, path
+            names = ('memory.max', 'memory.current')
+    if base is None:
+        return []
+
+    folders = []
+    folder = os.path.normpath(os.path.join(base, cgroup.lstrip('/')))
+    while True:
+        folders.append((folder, os.path.join(folder, names[0]), os.path.join(folder, names[1])))
+        if folder == base or not folder.startswith(base):
+            return folders
+        folder = os.path.dirname(folder)
+
+
+def cgroup_available_memory(procPath='/proc/self/cgroup', cgroupRoot='/sys/fs/cgroup'):
+    '''
+    Read the memory still available within the cgroup of the job, e.g. the SLURM --mem limit. The limit can be set on
+    the job while the process is in a step or task below it, so every cgroup up to the root is checked.
+
+    Input:
+    - procPath (str) - See cgroup_folders.
+    - cgroupRoot (str) - See cgroup_folders.
+
+    Output:
+    - available (float) - Available memory in GB, or None if there is no cgroup limit.
+    '''
+    available = None
+    for folder, limit_path, usage_path in cgroup_folders(procPath, cgroupRoot):
+        try:
+            with open(limit_path) as f:
+                limit = f.read().strip()
+            with open(usage_path) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit == 'max' or int(limit) >= 2**60:
+            continue
+        left = (int(limit) - usage) / 1024**3
+        available = left if available is None else min(available, left)
+    return available
+
+
+def allocated_cpus():
+    '''
+    Number of CPUs this job may run on, e.g. the SLURM --cpus-per-task, instead of all CPUs of the node.
+
+    Output:
+    - cpus (int) - Number of CPUs.
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return psutil.cpu_count()
+
+
+def job_cpu_load(leases, interval=1.0):
+    '''
+    CPU use of the running scenes of this job, per allocated CPU. Other jobs on a shared node are not counted.
+
+    Input:
+    - leases (list) - Output of live_leases.
+    - interval (float) - Seconds over which the use is measured.
+
+    Output:
+    - load (float) - CPU time used per second and per allocated CPU, 1 when the allocation is fully used.
+    '''
+    def cpu_time():
+        total = 0
+        for lease in leases:
+            try:
+                process = psutil.Process(lease['pid'])
+                for member in [process] + process.children(recursive=True):
+                    times = member.cpu_times()
+                    total += times.user + times.system
+            except psutil.Error:
+                continue
+        return total
+
+    if not leases:
+        return 0.0
+    start = cpu_time()
+    time.sleep(interval)
+    return max(cpu_time() - start, 0) / (interval * allocated_cpus())
+
+
+def available_memory():
+    '''
+    Memory available for new scenes, the smaller of the node and the job limit.
+
+    Output:
+    - available (float) - Available memory in GB.
+    '''
+    available = psutil.virtual_memory().available / 1024**3
+    job_available = cgroup_available_memory()
+    if job_available is not None:
+        available = min(available, job_available)
+    return available
+
+
+def pool_size(snapWorkers, memoryPerScene, maxConcurrentScenes=0):
+    '''
+    Number of SNAP workers. The workers cap the number of concurrent scenes, so with auto there are as many of them as
+    the admission could let run at once, and acquire_slot decides how many actually do.
+
+    Input:
+    - snapWorkers (str) - Number of workers, or auto.
+    - memoryPerScene (float) - See acquire_slot.
+    - maxConcurrentScenes (int) - See acquire_slot.
+
+    Output:
+    - workers (int) - Number of workers.
+    '''
+    if str(snapWorkers) != 'auto':
+        return int(snapWorkers)
+    if maxConcurrentScenes > 0:
+        return maxConcurrentScenes
+    return max(int(available_memory() // memoryPerScene), 1)
+
+
+def live_leases():
+    '''
+    Read the leases of running scenes and remove the ones whose process has died.
+
+    Output:
+    - leases (list) - Dictionaries with the pid, process start time and reserved memory of each running scene.
+    '''
+    leases = []
+    for filename in os.listdir(lease_directory):
+        if not filename.endswith('.lease'):
+            continue
+        path = os.path.join(lease_directory, filename)
+        try:
+            with open(path) as f:
+                lease = json.load(f)
+            # The start time guards against the PID having been reused by another process
+            alive = psutil.Process(lease['pid']).create_time() == lease['create_time']
+        except (OSError, ValueError, KeyError, psutil.Error):
+            alive = False
+        if alive:
+            leases.append(lease)
+        else:
+            print(f'Removing stale lease {filename}.')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return leases
+
+
+def reserved_memory(leases):
+    '''
+    Memory that admitted scenes have reserved but not yet taken into use, as SNAP allocates gradually.
+
+    Input:
+    - leases (list) - Output of live_leases.
+
+    Output:
+    - reserved (float) - Reserved memory in GB.
+    '''
+    reserved = 0
+    for lease in leases:
+        try:
+            used = psutil.Process(lease['pid']).memory_info().rss / 1024**3
+        except psutil.Error:
+            continue
+        reserved += max(lease['memory'] - used, 0)
+    return reserved
+
+
+def acquire_slot(memoryPerScene, maxConcurrentScenes=0, maxCpuLoad=0.95, poll=5):
+    '''
+    Wait until there is room for a new scene, and take a lease for the calling process.
+    A scene is always admitted when nothing else is running, so a too large memoryPerScene cannot deadlock the stage.
+
+    Input:
+    - memoryPerScene (float) - Memory in GB that a scene is expected to use.
+    - maxConcurrentScenes (int) - Upper limit of concurrent scenes. 0 means no limit other than memory and CPU.
+    - maxCpuLoad (float) - CPU use of the running scenes per allocated CPU (see job_cpu_load) above which no new scenes
+      are admitted. 0 disables the check.
+    - poll (float) - Seconds between admission attempts.
+
+    Output:
+    - lease_path (str) - Full path to the lease, to be given to release_slot.
+    '''
+    os.makedirs(lease_directory, exist_ok=True)
+    pid = os.getpid()
+    lease_path = os.path.join(lease_directory, f'{pid}.lease')
+    waiting = False
+    while True:
+        with open(os.path.join(lease_directory, 'admission.lock'), 'w') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            leases = live_leases()
+            free = available_memory() - reserved_memory(leases)
+            load = 0.0
+            admit = (not leases or
+                     (free >= memoryPerScene and (maxConcurrentScenes <= 0 or len(leases) < maxConcurrentScenes)))
+            # Measuring the CPU takes a moment, so it is only done when the rest admits the scene
+            if admit and leases and maxCpuLoad > 0:
+                load = job_cpu_load(leases)
+                admit = load < maxCpuLoad
+            if admit:
+                with open(lease_path, 'w') as f:
+                    json.dump({'pid': pid, 'create_time': psutil.Process(pid).create_time(), 'memory': memoryPerScene}, f)
+                print(f'Slot acquired. Current processes: {len(leases) + 1}, free memory {free:.1f} GB.')
+                return lease_path
+        if not waiting:
+            print(f'Waiting for resources. Running: {len(leases)}, free memory {free:.1f} GB, load {load:.2f}.')
+            waiting = True
+        time.sleep(poll)
+
+
+def release_slot(lease_path):
+    '''
+    Give back the lease taken with acquire_slot.
+
+    Input:
+    - lease_path (str) - Output of acquire_slot.
+    '''
+    try:
+        os.remove(lease_path)
+        print('Slot released.')
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,83 @@
+'''
+Local cache of ASF search results.
+
+Every search is stored as geojson in path/.cache/search, under a key made of the query parameters and a hash of the AOI.
+The same search within searchCacheHours (e.g. the download step of another identifier over the same lake, or a rerun
+after a failed job) reads the stored results instead of querying ASF again.
+'''
+import os, json, time, hashlib, fcntl
+
+
+class CachedResults(list):
+    '''
+    Search results read from the cache. Works like ASFSearchResults for what the scripts use: iteration,
+    product.properties and results.geojson. Products are downloaded with downloader.py.
+    '''
+    def geojson(self):
+        return {'type': 'FeatureCollection', 'features': [product.feature for product in self]}
+
+
+class CachedProduct:
+    '''
+    A single product of CachedResults.
+    '''
+    def __init__(self, feature):
+        self.feature = feature
+        self.properties = feature['properties']
+        self.geometry = feature['geometry']
+
+
+def search_key(query, wkt_aoi):
+    '''
+    Key of a search.
+
+    Input:
+    - query (dict) - The search parameters, except the AOI.
+    - wkt_aoi (str) - WKT of the AOI.
+
+    Output:
+    - key (str) - Hex digest.
+    '''
+    aoi = hashlib.sha1(wkt_aoi.encode()).hexdigest()
+    return hashlib.sha1(json.dumps(dict(query, aoi=aoi), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cached_search(cacheDir, ttl, query, wkt_aoi, search):
+    '''
+    Return the stored results of a search, or run the search and store its results.
+
+    Input:
+    - cacheDir (str) - Full path to the cache folder, or None to always search.
+    - ttl (float) - How long the stored results are used, in hours. 0 disables the cache.
+    - query (dict) - The search parameters, except the AOI.
+    - wkt_aoi (str) - WKT of the AOI.
+    - search (function) - Runs the search, returns ASFSearchResults.
+
+    Output:
+    - results - ASFSearchResults from a new search, or CachedResults from the cache.
+    '''
+    if cacheDir is None or ttl <= 0:
+        return search()
+
+    os.makedirs(cacheDir, exist_ok=True)
+    path = os.path.join(cacheDir, f'{search_key(query, wkt_aoi)}.geojson')
+    # Identifiers sharing an AOI may search at the same time, only the first one queries ASF
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl * 3600:
+            with open(path) as file:
+                try:
+                    stored = json.load(file)
+                    print(f"Using cached search results from {path}.")
+                    return CachedResults(CachedProduct(feature) for feature in stored['features'])
+                except (ValueError, KeyError):
+                    pass
+
+        results = search()
+        stored = results.geojson()
+        stored['query'] = dict(query, aoi=wkt_aoi)
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(stored, file, default=str)
+        os.replace(temporary, path)
+    return results
@@ -0,0 +1,99 @@
+'''
+Sharded ASF search for long archives.
+
+A search over several years is split into date windows of at most searchShardDays. With a season, each window only
+covers the season of a year. The windows are searched in parallel, each one retried on its own if it fails, and the
+results are merged and de-duplicated by product ID.
+'''
+import time, datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+def season_windows(start, end, season):
+    '''
+    Date windows of the season within the observation period.
+
+    Input:
+    - start (date) - Start of the observation period.
+    - end (date) - End of the observation period, exclusive like in asf.search.
+    - season (list) - Start and end of the season in DOY, e.g. [100, 250], or [274, 152] over the new year. An empty
+      list for the whole year.
+
+    Output:
+    - windows (list) - (start, end) dates of each window, end exclusive.
+    '''
+    if not season:
+        return [(start, end)]
+    first, last = season
+    windows = []
+    for year in range(start.year - 1, end.year + 1):
+        window_start = datetime.date(year, 1, 1) + datetime.timedelta(days=first - 1)
+        end_year = year if first <= last else year + 1
+        window_end = datetime.date(end_year, 1, 1) + datetime.timedelta(days=last)
+        window_start, window_end = max(window_start, start), min(window_end, end)
+        if window_start < window_end:
+            windows.append((window_start, window_end))
+    return windows
+
+
+def date_shards(start, end, season, shardDays):
+    '''
+    Split the observation period into search shards.
+
+    Input:
+    - start (str) - Start of the observation period, e.g. 2015-01-01.
+    - end (str) - End of the observation period.
+    - season (list) - See season_windows.
+    - shardDays (int) - Longest shard in days. 0 to only split by season.
+
+    Output:
+    - shards (list) - (start, end) of each shard as strings. Each shard ends where the next one starts.
+    '''
+    start = datetime.date.fromisoformat(start)
+    end = datetime.date.fromisoformat(end)
+    shards = []
+    for window_start, window_end in season_windows(start, end, season):
+        while window_start < window_end:
+            shard_end = window_end
+            if shardDays > 0:
+                shard_end = min(window_start + datetime.timedelta(days=shardDays), window_end)
+            shards.append((window_start.isoformat(), shard_end.isoformat()))
+            window_start = shard_end
+    return shards
+
+
+def sharded_search(shards, search, workers=4, retries=3, backoff=5):
+    '''
+    Run the search of each shard in parallel and merge the results.
+
+    Input:
+    - shards (list) - Output of date_shards.
+    - search (function) - Searches one shard, takes its start and end and returns ASFSearchResults.
+    - workers (int) - Number of shards searched at the same time.
+    - retries (int) - How many times a failed shard is searched again.
+    - backoff (float) - Wait before the first retry in seconds, doubled for every following retry.
+
+    Output:
+    - results (list) - Results of the first shard's type, with every product once.
+    '''
+    def search_shard(shard):
+        for attempt in range(retries + 1):
+            try:
+                return search(*shard)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                wait = backoff * 2**attempt
+                print(f'Search of {shard[0]} - {shard[1]} failed ({e}), retrying in {wait} s.')
+                time.sleep(wait)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        shard_results = list(executor.map(search_shard, shards))
+
+    # Shards end on the same day the next one starts, so a product may be found twice
+    products = {}
+    for results in shard_results:
+        for product in results:
+            products.setdefault(product.properties['sceneName'], product)
+    print(f'Found {len(products)} images in {len(shards)} search shards.')
+    return shard_results[0].__class__(products.values())
@@ -0,0 +1,75 @@
+'''
+Cache of the ASF login.
+
+Logging in to Earthdata takes several requests, and the download step runs once per identifier. The cookies of a
+login are saved in path/.cache/asf_session.json (readable only by the user), and later processes reuse them until they
+expire or are older than sessionHours, instead of logging in again. Processes that start at the same time wait for
+the first one to log in.
+'''
+import os, json, time, fcntl
+from contextlib import contextmanager
+from requests.cookies import RequestsCookieJar
+
+
+@contextmanager
+def session_lock(cachePath):
+    '''
+    Hold the lock of the cached login, so that only one process logs in at a time.
+
+    Input:
+    - cachePath (str) - Full path to the cached login.
+    '''
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+    with open(f'{cachePath}.lock', 'w') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def save_cookies(session, cachePath):
+    '''
+    Save the cookies of a logged in session.
+
+    Input:
+    - session (requests.Session) - The session.
+    - cachePath (str) - Full path to the cached login.
+    '''
+    cookies = [{'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path,
+                'expires': cookie.expires, 'secure': cookie.secure} for cookie in session.cookies]
+    temporary = f'{cachePath}.tmp'
+    # The cookies give access to the account
+    with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+        json.dump({'saved': time.time(), 'cookies': cookies}, file)
+    os.replace(temporary, cachePath)
+
+
+def load_cookies(cachePath, maxHours):
+    '''
+    Read the cookies of a cached login, if the login is still valid.
+
+    Input:
+    - cachePath (str) - Full path to the cached login.
+    - maxHours (float) - How long a login is reused, in hours. 0 to always log in.
+
+    Output:
+    - cookies (RequestsCookieJar) - The cookies, or None if there is no cached login, or it is too old or expired.
+    '''
+    if maxHours <= 0 or not os.path.exists(cachePath):
+        return None
+    try:
+        with open(cachePath) as file:
+            stored = json.load(file)
+        cookies = stored['cookies']
+        saved = stored['saved']
+    except (ValueError, KeyError):
+        return None
+    now = time.time()
+    if not cookies or now - saved > maxHours * 3600:
+        return None
+    # One expired cookie may be the one that holds the login
+    if any(cookie['expires'] is not None and cookie['expires'] <= now for cookie in cookies):
+        return None
+    jar = RequestsCookieJar()
+    for cookie in cookies:
+        jar.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'],
+                expires=cookie['expires'], secure=cookie['secure'])
+    return jar
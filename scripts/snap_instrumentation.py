@@ -0,0 +1,178 @@
+'''
+Per-operator timing and JVM memory instrumentation of the SNAP processing.
+
+Every operator of snap_process.py is run through timed_step, which records the wall time, used and peak JVM heap,
+garbage collection time and the pixel count of the output product. The write step also records the bytes written.
+GPF builds the graph lazily, so in the default mode almost all of the cost shows up in the write step. In 'full' mode
+each operator is materialized to a temporary BEAM-DIMAP product, so that its cost is attributed to the operator itself;
+this is slower and meant for finding hot operators, not for production runs.
+
+Each scene adds one json line to snap_operators.jsonl, next to the Snakemake benchmark files.
+'''
+import os, time, json, fcntl, shutil, tempfile, datetime
+import jpy
+from snappy import ProductIO
+
+
+def jvm_memory():
+    '''
+    Read the JVM memory and garbage collection counters.
+
+    Output:
+    - heap (int) - Used heap in bytes.
+    - peak (int) - Peak heap usage since the last reset, in bytes.
+    - gc_time (int) - Total garbage collection time in milliseconds.
+    '''
+    ManagementFactory = jpy.get_type('java.lang.management.ManagementFactory')
+    heap = ManagementFactory.getMemoryMXBean().getHeapMemoryUsage().getUsed()
+
+    peak = 0
+    pools = ManagementFactory.getMemoryPoolMXBeans()
+    for i in range(pools.size()):
+        pool = pools.get(i)
+        if pool.getType().name() == 'HEAP':
+            peak += pool.getPeakUsage().getUsed()
+
+    gc_time = 0
+    collectors = ManagementFactory.getGarbageCollectorMXBeans()
+    for i in range(collectors.size()):
+        gc_time += max(collectors.get(i).getCollectionTime(), 0)
+    return heap, peak, gc_time
+
+
+def reset_peak():
+    '''
+    Reset the peak usage of the heap pools, so that the peak of the next step can be measured.
+    '''
+    ManagementFactory = jpy.get_type('java.lang.management.ManagementFactory')
+    pools = ManagementFactory.getMemoryPoolMXBeans()
+    for i in range(pools.size()):
+        pools.get(i).resetPeakUsage()
+
+
+def run_log_path(dataPath):
+    '''
+    Find where the run log is written: the snake_log folder of the results, or the parent of dataPath without Snakemake.
+
+    Input:
+    - dataPath (str) - Full path to the folder of processed images.
+
+    Output:
+    - path (str) - Full path to snap_operators.jsonl.
+    '''
+    folder = os.path.abspath(dataPath)
+    while os.path.dirname(folder) != folder:
+        if os.path.isdir(os.path.join(folder, 'snake_log')):
+            return os.path.join(folder, 'snake_log', 'snap_operators.jsonl')
+        folder = os.path.dirname(folder)
+    return os.path.join(os.path.dirname(os.path.abspath(dataPath)), 'snap_operators.jsonl')
+
+
+def start_run(images, mode):
+    '''
+    Start the record of one scene.
+
+    Input:
+    - images (list) - Full paths to the images of the scene.
+    - mode (str) - 'False' to disable, 'True' for lazy timing, or 'full' to materialize each operator.
+
+    Output:
+    - run (dict) - The record, given to timed_step and finish_run.
+    '''
+    run = {'mode': mode, 'scenes': [os.path.basename(image) for image in images],
+           'started': datetime.datetime.now().isoformat(), 'steps': []}
+    if mode == 'full':
+        run['workdir'] = tempfile.mkdtemp(prefix='snap_profile_', dir=os.environ.get('LOCAL_SCRATCH'))
+    return run
+
+
+def timed_step(run, name, func, *args, **kwargs):
+    '''
+    Run one operator and record its cost.
+
+    Input:
+    - run (dict) - Output of start_run.
+    - name (str) - Name of the step in the log.
+    - func (function) - The operator, e.g. do_calibration. Must return a product.
+    - args, kwargs - Arguments of func.
+
+    Output:
+    - product (ProductIO) - Output of func, or in full mode the materialized copy of it.
+    '''
+    if run['mode'] not in ('True', 'full'):
+        return func(*args, **kwargs)
+
+    reset_peak()
+    _, _, gc_before = jvm_memory()
+    start = time.perf_counter()
+    product = func(*args, **kwargs)
+    if run['mode'] == 'full':
+        path = os.path.join(run['workdir'], f"{len(run['steps']):02d}_{name}")
+        ProductIO.writeProduct(product, path, 'BEAM-DIMAP')
+        product = ProductIO.readProduct(path + '.dim')
+    wall = time.perf_counter() - start
+    heap, peak, gc_after = jvm_memory()
+
+    run['steps'].append({
+        'step': name,
+        'wall_s': round(wall, 3),
+        'heap_used_mb': round(heap / 1024**2, 1),
+        'heap_peak_mb': round(peak / 1024**2, 1),
+        'gc_ms': gc_after - gc_before,
+        'pixels': product.getSceneRasterWidth() * product.getSceneRasterHeight() * product.getNumBands(),
+    })
+    return product
+
+
+def timed_write(run, name, func, *args, outputPath=None, **kwargs):
+    '''
+    Run a write step and record its cost along with the number of bytes written.
+
+    Input:
+    - run (dict) - Output of start_run.
+    - name (str) - Name of the step in the log.
+    - func (function) - The writing function.
+    - args, kwargs - Arguments of func.
+    - outputPath (str) - Full path to the written file.
+    '''
+    if run['mode'] not in ('True', 'full'):
+        func(*args, **kwargs)
+        return
+
+    reset_peak()
+    _, _, gc_before = jvm_memory()
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    heap, peak, gc_after = jvm_memory()
+    run['steps'].append({
+        'step': name,
+        'wall_s': round(wall, 3),
+        'heap_used_mb': round(heap / 1024**2, 1),
+        'heap_peak_mb': round(peak / 1024**2, 1),
+        'gc_ms': gc_after - gc_before,
+        'bytes_written': os.path.getsize(outputPath) if outputPath and os.path.exists(outputPath) else None,
+    })
+
+
+def finish_run(run, dataPath, output):
+    '''
+    Append the record of the scene to the run log and remove the temporary products of full mode.
+
+    Input:
+    - run (dict) - Output of start_run.
+    - dataPath (str) - Full path to the folder of processed images.
+    - output (str) - Name of the processed image, or None if nothing was written.
+    '''
+    if run['mode'] not in ('True', 'full'):
+        return
+    if 'workdir' in run:
+        shutil.rmtree(run.pop('workdir'), ignore_errors=True)
+    run['output'] = output
+    run['pid'] = os.getpid()
+    run['total_s'] = round(sum(step['wall_s'] for step in run['steps']), 3)
+
+    with open(run_log_path(dataPath), 'a') as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        file.write(json.dumps(run) + '\n')
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
@@ -1,59 +1,22 @@
 '''
 This script does all the actual processing, and is run by calling it from the parent script (process_images.py). Running it standalone won't work.
-Running this processing takes a considerable amount of memory, and that is why it is called separately each time in order to force clean the temp memory between processes.
+Running this processing takes a considerable amount of memory. Each scene therefore waits in scheduler.acquire_slot until the node has memoryPerScene GB free, and releases its slot even if the processing fails.
 '''
-import os, gc, subprocess, sys, argparse, csv, time, shutil, tempfile
-import fcntl, io
-
-# Function to acquire lock
-# Define the lock file path in the current working directory
-lock_filepath = os.path.join(os.getcwd(), "lock.lock")
-processinglimit_filepath = os.path.join(os.getcwd(), "processinglimit.txt")
-processingLimit = 3
-
-# Create the processing limit file if it doesn't exist
-while not os.path.exists(processinglimit_filepath):
-    try:
-        with open(processinglimit_filepath, 'w+') as f:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            f.write('0')
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-        print('Processing limit file created.')
-    except IOError:
-        print('Could not create processing limit file. Retrying...')
-        time.sleep(1)
-
-# Acquire lock
-lock = open(lock_filepath, 'w')
-lock_acquired = False
-while not lock_acquired:
-    try:
-        # Read the current processing limit with a lock
-        with open(processinglimit_filepath, 'r+') as f:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            concurrentProcesses = int(f.read().strip())
-            if concurrentProcesses < processingLimit:
-                # Increment the processing limit
-                # Try to acquire the lock
-                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                lock_acquired = True
-                print('Lock acquired.')
-                print(f'Current processes: {concurrentProcesses + 1}')
-                f.seek(0)
-                f.write(str(concurrentProcesses + 1))
-                f.truncate()
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            else:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                lock_acquired = False
-                time.sleep(1)
-    except IOError:
-        time.sleep(1)
+import os, gc, subprocess, sys, argparse, csv, time, shutil, tempfile, math
+import io
+from scheduler import acquire_slot, release_slot
+from raster_output import convert_geotiff
+from processing_parameters import read_processing_parameters
+from product_cache import product_key, lookup, record
+from product_access import remove_product
+from scene_catalog import scene_facts, lookup_scenes, find_catalog
+from dem_window import resolve_dem
 
 # Import snappy and other modules
 from snappy import HashMap, GPF, ProductIO
 from snapista import Operator
 import jpy
+from snap_instrumentation import start_run, timed_step, timed_write, finish_run
 
 
 try:
@@ -111,8 +74,7 @@ def parse_arguments():
     - Dictionary containing the arguments.
     """
     parser = argparse.ArgumentParser(description="Process SAR data.")
-    parser.add_argument("image1", type=str, help="Path to the first SAR image.")
-    parser.add_argument("image2", type=str, help="Path to the second SAR image.")
+    parser.add_argument("images", type=str, help="Comma-separated paths to the SAR images. Several images are slice assembled in the given order.")
     parser.add_argument("pathToResult", type=str, help="Path to the results folder.")
     parser.add_argument("pathToDem", type=str, help="Path to DEM.")
     parser.add_argument("pathToShapefile", type=str, help="Path to shapefile.")
@@ -143,8 +105,7 @@ def apply_orbit_file(source):
 
 def do_slice_assembly(sources):
     '''
-    Assemble two bands from different sources into a single product.
-    This could be modified to take in any number 
+    Assemble consecutive slices of the same orbit into a single product.
     
     Inputs:
     sources (list) - List of SAR images with auxiliary files.
@@ -335,13 +296,14 @@ def do_linear_to_db(source):
     return output
 
 
-def do_subset(source, wkt):
+def do_subset(source, wkt, copyMetadata=False):
     '''
     Subset SAR image to a wkt, based on snappy.
     
     Input:
     source (productIO) - SAR image with auxiliary files.
     wkt (str) - WKT of the subset area, given in WGS84 projection.
+    copyMetadata (bool) - Whether the full metadata is kept, needed when radar operators follow the subset.
     
     Output:
     output (productIO) - Subsetted product.
@@ -349,6 +311,7 @@ def do_subset(source, wkt):
     print('\tSubsetting...')
     parameters = HashMap()
     parameters.put('geoRegion', wkt)
+    parameters.put('copyMetadata', copyMetadata)
     output = GPF.createProduct('Subset', parameters, source)
     return output
 
@@ -411,13 +374,14 @@ def do_mosaicing(inputs, proj, wkt):
     return output
 
 
-def shapefile_to_wkt(pathToShapefile, epsg):
+def shapefile_to_wkt(pathToShapefile, epsg, buffer=500):
     '''
     Create a wkt of bounds out of a shapefile. NOTE: the wkt is of the bounds, not the exact shapefile.
     
     Inputs:
     - pathToShapefile (str): Full path to the shapefile.
     - epsg (str): The projection in which the wkt is presented. Example: 'epsg:3067'
+    - buffer (float): Buffer around the bounds, in meters.
     
     Output:
     - wkt (polygon) - Polygon object in wkt format.
@@ -444,7 +408,6 @@ def shapefile_to_wkt(pathToShapefile, epsg):
                 max(bounds[3], polygon_bounds[3])
             )
 
-    buffer = 500
     bounds = (
         bounds[0] - buffer,
         bounds[1] - buffer,
@@ -476,6 +439,49 @@ def shapefile_to_wkt(pathToShapefile, epsg):
 
 
 
+def dem_max_elevation(pathToDem):
+    '''
+    Read the highest elevation of the DEM, used to estimate the terrain displacement in radar geometry.
+    
+    Inputs:
+    - pathToDem (str): Full path to the DEM.
+    
+    Output:
+    - elevation (float): Highest elevation in meters. Without an external DEM, 1500 m is assumed (above any Finnish fell).
+    '''
+    if not os.path.exists(pathToDem):
+        return 1500.0
+    dem = ProductIO.readProduct(pathToDem)
+    elevation = dem.getBandAt(0).getStx().getMaximum()
+    dem.dispose()
+    return elevation
+
+
+def aoi_margin(source, filterResolution, pathToDem):
+    '''
+    Margin needed around the target when subsetting in radar geometry, before speckle filtering and terrain correction.
+    It covers the speckle filter kernel, and the shift of elevated terrain towards the sensor (foreshortening/layover),
+    which is at most the elevation divided by the tangent of the near-range incidence angle.
+    
+    Inputs:
+    - source (ProductIO): SAR image with auxiliary files.
+    - filterResolution (int): Speckle filter size in pixels.
+    - pathToDem (str): Full path to the DEM.
+    
+    Output:
+    - margin (float): Margin in meters.
+    '''
+    metadata = source.getMetadataRoot().getElement('Abstracted_Metadata')
+    pixelSpacing = max(metadata.getAttributeDouble('range_spacing'), metadata.getAttributeDouble('azimuth_spacing'))
+    incidence = metadata.getAttributeDouble('incidence_near')
+    
+    kernel = (int(filterResolution) // 2 + 1) * pixelSpacing
+    displacement = dem_max_elevation(pathToDem) / math.tan(math.radians(incidence))
+    
+    # Double the kernel, so that pixels at the edge of the target are filtered with a full window
+    return 2 * kernel + displacement
+
+
 def do_band_maths(source, expression):
     '''
     Do band maths based on hard-coded parameters.
@@ -673,92 +679,170 @@ def multilooking(source):
     
     return output
 
-def main():
+def geotiff_writer(product, bigTiff):
+    '''
+    Choose the SNAP writer of a GeoTIFF. The plain GeoTIFF writer cannot write files over 4 GB.
     
-    # --------START READ VARIABLES ---------
-    # Read arguments from the text file
-    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
-    deleteUnprocessedImages = args.get('deleteUnprocessedImages')
-    process = args.get('process')
-    if process == 'GRD':
-        applyOrbitFile = True
-        thermalNoiseRemoval = True
-        calibration = True
-        complexOutput = False
-        speckleFiltering = True
-        filterResolution = 5
-        terrainCorrection = True
-        terrainResolution = 10.0
-        bandMaths = False
-        linearToDb = True
-        slcSplit = False
-        slcDeburst = False
-        polarimetricSpeckleFiltering = False
-        polarimetricParameters = False
-        multilook = False
-        
-    elif process == 'SLC':
-        applyOrbitFile = True
-        thermalNoiseRemoval = False
-        calibration = True
-        complexOutput = True
-        speckleFiltering = True
-        filterResolution = 5
-        terrainCorrection = True
-        terrainResolution = 10.0
-        bandMaths = False
-        linearToDb = False
-        slcSplit = True
-        slcDeburst = True
-        polarimetricSpeckleFiltering = False
-        polarimetricParameters = False
-        multilook = True
-        
-    elif process == 'polSAR':
-        applyOrbitFile = True
-        thermalNoiseRemoval = False
-        calibration = True
-        complexOutput = True
-        speckleFiltering = False
-        filterResolution = 5
-        terrainCorrection = True
-        terrainResolution = 10.0
-        bandMaths = False
-        linearToDb = False
-        slcSplit = False
-        slcDeburst = True
-        polarimetricSpeckleFiltering = True
-        polarimetricParameters = True
-        multilook = True
-        
-        
+    Input:
+    - product (ProductIO) - The product to write.
+    - bigTiff (str) - YES, NO or IF_SAFER. IF_SAFER uses BigTIFF when the uncompressed bands could exceed 4 GB.
+    
+    Output:
+    - writer (str) - GeoTIFF or GeoTIFF-BigTIFF.
+    '''
+    if bigTiff != 'IF_SAFER':
+        return 'GeoTIFF-BigTIFF' if bigTiff == 'YES' else 'GeoTIFF'
+    ProductData = jpy.get_type('org.esa.snap.core.datamodel.ProductData')
+    size = sum(band.getRasterWidth() * band.getRasterHeight() * ProductData.getElemSize(band.getDataType())
+               for band in product.getBands())
+    # Leave room for the headers and the tags
+    return 'GeoTIFF-BigTIFF' if size > 3.9 * 1024**3 else 'GeoTIFF'
+
+
+def write_product(product, outPath, output_filename, outputFormat, bigTiff, run):
+    '''
+    Write a processed product as GeoTIFF, and convert it to a tiled GeoTIFF or COG if requested.
+    
+    Input:
+    - product (ProductIO) - The processed product.
+    - outPath (str) - Full path to the folder where the image is written.
+    - output_filename (str) - Name of the image.
+    - outputFormat (str) - GeoTIFF, tiled or COG.
+    - bigTiff (str) - YES, NO or IF_SAFER.
+    - run (dict) - Instrumentation record, output of start_run.
+    '''
+    if outputFormat == 'GeoTIFF':
+        timed_write(run, 'Write', ProductIO.writeProduct, product, os.path.join(outPath, output_filename), geotiff_writer(product, bigTiff),
+                    outputPath=os.path.join(outPath, output_filename))
     else:
-        polarization = args.get('polarization') 
-        slcSplit = args.get('slcSplit') == 'True'
-        applyOrbitFile = args.get('applyOrbitFile') == 'True'
-        thermalNoiseRemoval = args.get('thermalNoiseRemoval') == 'True'
-        calibration = args.get('calibration') == 'True'
-        complexOutput = args.get('complexOutput') == 'True'
-        slcDeburst = args.get('slcDeburst') == 'True'
-        speckleFiltering = args.get('speckleFiltering') == 'True'
-        polarimetricSpeckleFiltering = args.get('polarimetricSpeckleFiltering') == 'True'
-        polarimetricParameters = args.get('polarimetricParameters') == 'True'
-        filterResolution = args.get('filterResolution')
-        terrainCorrection = args.get('terrainCorrection') == 'True'
-        terrainResolution = args.get('terrainResolution')
-        bandMaths = args.get('bandMaths') == 'True'
-        bandMathExpression = args.get('bandMathsExpression')
-        linearToDb = args.get('linearToDb') == 'True'
-        multilook = args.get('multilook') == 'True'
+        # Write to a hidden folder first, so that the striped file is never picked up as a processed image.
+        # The intermediate file is converted anyway, so it is a BigTIFF unless that is ruled out.
+        snap_output = os.path.join(outPath, '.snap_output')
+        os.makedirs(snap_output, exist_ok=True)
+        timed_write(run, 'Write', ProductIO.writeProduct, product, os.path.join(snap_output, output_filename), 'GeoTIFF' if bigTiff == 'NO' else 'GeoTIFF-BigTIFF',
+                    outputPath=os.path.join(snap_output, output_filename))
+        print(f'Converting to {outputFormat}...')
+        timed_write(run, 'Convert', convert_geotiff, os.path.join(snap_output, output_filename), os.path.join(outPath, output_filename), outputFormat, bigTiff=bigTiff,
+                    outputPath=os.path.join(outPath, output_filename))
+
+
+def find_targets(resultPath):
+    '''
+    List the targets in the results folder, i.e. the folders with a shapefile/<identifier>.shp created by initialize.py.
     
+    Input:
+    - resultPath (str) - Full path to the results folder.
     
-    # Read arguments from the parent script
-    args = parse_arguments()
-    image1 = args.image1
-    image2 = args.image2
-    pathToShapefile = args.pathToShapefile
-    dataPath = args.pathToResult
-    pathToDem = args.pathToDem
+    Output:
+    - targets (list) - (identifier, full path to the shapefile) of each target.
+    '''
+    targets = []
+    for identifier in sorted(os.listdir(resultPath)):
+        pathToTarget = os.path.join(resultPath, identifier, 'shapefile', f'{identifier}.shp')
+        if os.path.exists(pathToTarget):
+            targets.append((identifier, pathToTarget))
+    return targets
+
+
+def product_footprint(product):
+    '''
+    Footprint of a product in WGS84, from the geocoding of its corners.
+    
+    Input:
+    - product (ProductIO) - Terrain corrected product.
+    
+    Output:
+    - footprint (Polygon) - The footprint.
+    '''
+    PixelPos = jpy.get_type('org.esa.snap.core.datamodel.PixelPos')
+    geocoding = product.getSceneGeoCoding()
+    width = product.getSceneRasterWidth()
+    height = product.getSceneRasterHeight()
+    corners = []
+    for x, y in [(0, 0), (width, 0), (width, height), (0, height)]:
+        position = geocoding.getGeoPos(PixelPos(x, y), None)
+        corners.append((position.getLon(), position.getLat()))
+    return Polygon(corners)
+
+
+def process_scene(images, dataPath, pathToDem, pathToShapefile, parameters):
+    '''
+    Process one scene, or several slices of the same orbit, once the scheduler admits it. The slot is always released,
+    also when the target does not overlap or the processing crashes. Can be called repeatedly from a long-lived worker,
+    so the JVM is only started once.
+    
+    Input:
+    - images (list) - Full paths to the SAR images. Several images are slice assembled in the given order.
+    - dataPath (str) - Full path to the folder where the processed image is written.
+    - pathToDem (str) - Full path to the DEM. Without it, the VRT window of the shared DEM is used (see dem_window.py).
+    - pathToShapefile (str) - Full path to the target shapefile.
+    - parameters (dict) - Output of read_processing_parameters.
+    
+    Output:
+    - Processed GeoTIFF in dataPath, or with multiTarget one GeoTIFF in the tiffs folder of each overlapping target.
+    - output (str or list) - See process_products. None if nothing was written, also when the scene was already processed.
+    '''
+    pathToDem = resolve_dem(pathToDem)
+
+    # Skip scenes that were already processed with the same parameters, DEM and target
+    key, entry = product_key(images, parameters, pathToDem, pathToShapefile)
+    cached = lookup(dataPath, key)
+    if cached is not None:
+        print(f'Already processed: {os.path.basename(cached)}')
+        return
+
+    run = start_run(images, parameters['instrumentation'])
+    output = None
+    lease = acquire_slot(parameters['memoryPerScene'], parameters['maxConcurrentScenes'])
+    try:
+        output = process_products(images, dataPath, pathToDem, pathToShapefile, parameters, run)
+    finally:
+        release_slot(lease)
+        finish_run(run, dataPath, output)
+    if output is not None:
+        record(dataPath, key, entry, output)
+    return output
+
+
+def process_products(images, dataPath, pathToDem, pathToShapefile, parameters, run):
+    '''
+    Process one scene, or several slices of the same orbit, and write the result to dataPath.
+    
+    Input:
+    - images (list) - Full paths to the SAR images. Several images are slice assembled in the given order.
+    - dataPath (str) - Full path to the folder where the processed image is written.
+    - pathToDem (str) - Full path to the DEM.
+    - pathToShapefile (str) - Full path to the target shapefile.
+    - parameters (dict) - Output of read_processing_parameters.
+    - run (dict) - Instrumentation record, output of start_run.
+    
+    Output:
+    - output (str or list) - Name of the processed GeoTIFF in dataPath, or with multiTarget the paths of the written
+      subsets relative to dataPath. None if the target does not overlap.
+    '''
+    process = parameters['process']
+    deleteUnprocessedImages = parameters['deleteUnprocessedImages']
+    applyOrbitFile = parameters['applyOrbitFile']
+    thermalNoiseRemoval = parameters['thermalNoiseRemoval']
+    calibration = parameters['calibration']
+    complexOutput = parameters['complexOutput']
+    speckleFiltering = parameters['speckleFiltering']
+    filterResolution = parameters['filterResolution']
+    terrainCorrection = parameters['terrainCorrection']
+    terrainResolution = parameters['terrainResolution']
+    bandMaths = parameters['bandMaths']
+    bandMathExpression = parameters['bandMathExpression']
+    linearToDb = parameters['linearToDb']
+    slcSplit = parameters['slcSplit']
+    slcDeburst = parameters['slcDeburst']
+    polarimetricSpeckleFiltering = parameters['polarimetricSpeckleFiltering']
+    polarimetricParameters = parameters['polarimetricParameters']
+    multilook = parameters['multilook']
+    aoiFirst = parameters['aoiFirst']
+    outputFormat = parameters['outputFormat']
+    bigTiff = parameters['bigTiff']
+    multiTarget = parameters['multiTarget']
+    image1 = images[0]
     outPath = dataPath
 
     # ---------END READ VARIABLES ----------
@@ -808,85 +892,89 @@ def main():
     #        print('Locked. Waiting 2 seconds before retry.')
     #        time.sleep(2)
 
-    # If there are two images, remove noise first and then assemble them
-    if image2 != 'none':
+    # If there are several slices, remove noise first and then assemble them
+    if len(images) > 1:
     
-        # Read files to appropriate format
-        product1 = ProductIO.readProduct(image1)
-        product2 = ProductIO.readProduct(image2)
-        
-        #0.5 APPLY ORBIT FILE
-        if applyOrbitFile:
-            product1 = apply_orbit_file(product1)
-            product2 = apply_orbit_file(product2)
-
-        #1: REMOVE THERMAL NOISE
-        product1 = do_thermal_noise_removal(product1)
-        product2 = do_thermal_noise_removal(product2)
-
         # Create a list of the products to be assembled
-        products =[]
-        products.append(product1)
-        products.append(product2)
+        products = []
+        for image in images:
+            # Read file to appropriate format
+            slice_product = timed_step(run, 'Read', ProductIO.readProduct, image)
+            
+            #0.5 APPLY ORBIT FILE
+            if applyOrbitFile:
+                slice_product = timed_step(run, 'Apply-Orbit-File', apply_orbit_file, slice_product)
+
+            #1: REMOVE THERMAL NOISE
+            slice_product = timed_step(run, 'ThermalNoiseRemoval', do_thermal_noise_removal, slice_product)
+            products.append(slice_product)
         
         #1.5: SLICE ASSEMBLE
-        product = do_slice_assembly(products)
+        product = timed_step(run, 'SliceAssembly', do_slice_assembly, products)
         
         # Some housekeeping
-        del product1
-        del product2
+        del products
     
     # If there is only one image, proceed normally
     else:
         # Read file to appropriate format
-        product = ProductIO.readProduct(image1)
+        product = timed_step(run, 'Read', ProductIO.readProduct, image1)
         
         
         if slcSplit:
             wkt = shapefile_to_wkt(pathToShapefile, 'epsg:4326')
             try:
-                product = TOPSAR_split(product,wkt)
+                product = timed_step(run, 'TOPSAR-Split', TOPSAR_split, product, wkt)
             except RuntimeError:
                 print('Target does not overlap with any bursts.')
-                sys.exit()
+                return
         
         # 0.5: APPLY ORBIT FILE 
         if applyOrbitFile:
-            product = apply_orbit_file(product)
+            product = timed_step(run, 'Apply-Orbit-File', apply_orbit_file, product)
         
         #1: REMOVE THERMAL NOISE
         if thermalNoiseRemoval:
-            product = do_thermal_noise_removal(product)
+            product = timed_step(run, 'ThermalNoiseRemoval', do_thermal_noise_removal, product)
+
+    #1.75: CROP TO THE TARGET
+    # GRD only, SLC is already reduced to the overlapping bursts by TOPSAR_split
+    if aoiFirst and productstamp.startswith('GRD'):
+        margin = aoi_margin(product, filterResolution, pathToDem)
+        print(f'\tCropping to target with a {margin:.0f} m margin...')
+        wkt = shapefile_to_wkt(pathToShapefile, 'epsg:4326', buffer=500 + margin)
+        try:
+            product = timed_step(run, 'Subset-AOI', do_subset, product, wkt, copyMetadata=True)
+        except RuntimeError:
+            print('Target does not overlap with the image.')
+            return
 
-    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
-    lock.close()
-    print('Lock released.')    
 
     #2: CALIBRATE
     if calibration:
-        product = do_calibration(product, polarization, pols, complexOutput)
+        product = timed_step(run, 'Calibration', do_calibration, product, polarization, pols, complexOutput)
         
         
     if slcDeburst:
-        product = TOPSAR_deburst(product)
+        product = timed_step(run, 'TOPSAR-Deburst', TOPSAR_deburst, product)
 
     if multilook:
-        product = multilooking(product)
+        product = timed_step(run, 'Multilook', multilooking, product)
 
 
     #3: SPECKLE FILTER
     if speckleFiltering:
         filterType = 'Lee'
-        product = do_speckle_filtering(product, filterType, filterResolution)
+        product = timed_step(run, 'Speckle-Filter', do_speckle_filtering, product, filterType, filterResolution)
         
     if polarimetricSpeckleFiltering:
-        product = polarimetric_speckle_filtering(product,filterResolution)
+        product = timed_step(run, 'Polarimetric-Speckle-Filter', polarimetric_speckle_filtering, product, filterResolution)
 
     if polarimetricParameters:
-        product = polarimetric_decomposition(product)
+        product = timed_step(run, 'Polarimetric-Decomposition', polarimetric_decomposition, product)
         #C2_matrix = polarimetric_matrices(product)
-        product_stokes = polarimetric_parameters(product)
-        product = stack(product, product_stokes)
+        product_stokes = timed_step(run, 'CP-Stokes-Parameters', polarimetric_parameters, product)
+        product = timed_step(run, 'CreateStack', stack, product, product_stokes)
 
 
     #4: TERRAIN CORRECTION
@@ -894,23 +982,25 @@ def main():
     proj = '''PROJCS["ETRS89 / TM35FIN(E,N)", GEOGCS["ETRS89", DATUM["European Terrestrial Reference System 1989", SPHEROID["GRS 1980", 6378137.0, 298.257222101, AUTHORITY["EPSG","7019"]], TOWGS84[0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0], AUTHORITY["EPSG","6258"]], PRIMEM["Greenwich", 0.0, AUTHORITY["EPSG","8901"]], UNIT["degree", 0.017453292519943295], AXIS["Geodetic longitude", EAST], AXIS["Geodetic latitude", NORTH], AUTHORITY["EPSG","4258"]], PROJECTION["Transverse_Mercator", AUTHORITY["EPSG","9807"]], PARAMETER["central_meridian", 27.0], PARAMETER["latitude_of_origin", 0.0], PARAMETER["scale_factor", 0.9996], PARAMETER["false_easting", 500000.0], PARAMETER["false_northing", 0.0], UNIT["m", 1.0], AXIS["Easting", EAST], AXIS["Northing", NORTH], AUTHORITY["EPSG","3067"]]'''
     if terrainCorrection:
         try:
-            product = do_terrain_correction(product, proj, pathToDem, terrainResolution)
+            product = timed_step(run, 'Terrain-Correction', do_terrain_correction, product, proj, pathToDem, terrainResolution)
         except RuntimeError:
             print('Target does not overlap with the image.')
-            sys.exit()
+            return
           
     #5 COVERT TO DB
     if linearToDb:
-        product = do_linear_to_db(product)
+        product = timed_step(run, 'LinearToFromdB', do_linear_to_db, product)
         
     #6: SUBSET
-    wkt = shapefile_to_wkt(pathToShapefile, 'epsg:4326')
-    product = do_subset(product, wkt)
+    # With several targets, each target is subset separately when writing
+    if not multiTarget:
+        wkt = shapefile_to_wkt(pathToShapefile, 'epsg:4326')
+        product = timed_step(run, 'Subset', do_subset, product, wkt)
 
     #7: BAND MATHS
     if bandMaths:
-        maths = do_band_maths(product, bandMathExpression)
-        product = do_band_merge(product, maths)
+        maths = timed_step(run, 'BandMaths', do_band_maths, product, bandMathExpression)
+        product = timed_step(run, 'BandMerge', do_band_merge, product, maths)
         
         
     # Get relevant metadata
@@ -947,32 +1037,61 @@ def main():
 
     print('Writing...')
     filename = os.path.basename(image1)
-    if slcDeburst:
-        time_str = filename.split('_')[5][:8]
-    else:
-        time_str = filename.split('_')[4][:8]
+    start = scene_facts(filename, lookup_scenes(find_catalog(dataPath), [filename]))[0]
+    time_str = start.strftime('%Y%m%d')
     output_filename = f'{time_str}_{product_type}_{direction}_{rel_orbit}_{look}_processed.tif'
-    ProductIO.writeProduct(product, os.path.join(dataPath, output_filename), 'GeoTIFF')
+    if multiTarget:
+        # One subset per target that the scene covers, written directly to the folder of the target
+        outputs = []
+        footprint = product_footprint(product)
+        resultPath = os.path.dirname(dataPath)
+        for identifier, pathToTarget in find_targets(resultPath):
+            target_wkt = shapefile_to_wkt(pathToTarget, 'epsg:4326')
+            if not footprint.intersects(loads(target_wkt)):
+                continue
+            targetPath = os.path.join(resultPath, identifier, 'tiffs')
+            os.makedirs(targetPath, exist_ok=True)
+            try:
+                subset = timed_step(run, 'Subset-target', do_subset, product, target_wkt)
+            except RuntimeError:
+                print(f'Target {identifier} does not overlap with the image.')
+                continue
+            write_product(subset, targetPath, output_filename, outputFormat, bigTiff, run)
+            subset.dispose()
+            outputs.append(os.path.relpath(os.path.join(targetPath, output_filename), dataPath))
+        product.dispose()
+        print(f'Wrote subsets for {len(outputs)} targets.')
+        output = outputs if outputs else None
+    else:
+        write_product(product, dataPath, output_filename, outputFormat, bigTiff, run)
+        product.dispose()
+        output = output_filename
     
     print('Processing done. \n')
     gc.collect()
 
-    with open(processinglimit_filepath, 'r+') as f:
-        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-        concurrentProcesses = int(f.read().strip())
-        f.seek(0)
-        f.write(str(concurrentProcesses - 1))
-        f.truncate()
-        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-
     # -------- END OF PROCESSING ----------
 
     # -------- REMOVE RAW FILES -----------
-    if deleteUnprocessedImages:
-        shutil.rmtree(image1)
-        if os.path.exists(image2) and os.path.isdir(image2):
-            shutil.rmtree(image2)
+    # Without an output, e.g. when no target was found, the images are kept
+    if deleteUnprocessedImages and output is not None:
+        for image in images:
+            remove_product(image)
     # --------- REMOVE RAW FILES ---------
+
+    return output
+    
+
+
+def main():
+    
+    # --------START READ VARIABLES ---------
+    # Read arguments from the text file
+    parameters = read_processing_parameters(read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv')))
+    
+    # Read arguments from the parent script
+    args = parse_arguments()
+    process_scene(args.images.split(','), args.pathToResult, args.pathToDem, args.pathToShapefile, parameters)
     
 if __name__== "__main__":
     main()
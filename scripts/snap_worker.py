@@ -0,0 +1,209 @@
+'''
+Long-lived SNAP workers, used by process_images.py.
+
+Each worker imports snap_process once, so snappy, jpy and the JVM are only started once per worker instead of once per scene.
+Scenes are taken from a shared queue. SNAP leaks memory between products, which is why the pipeline originally started a
+new interpreter for every scene; here a worker is instead recycled after a number of products, or when its resident memory
+or JVM heap grows past a threshold, and the parent starts a fresh one in its place.
+'''
+import os, sys, gc, subprocess
+import multiprocessing
+import threading
+import queue
+
+try:
+    import psutil
+except:
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "--user", "psutil"])
+    import psutil
+
+
+def memory_usage():
+    '''
+    Measure the memory used by the calling worker.
+
+    Output:
+    - rss (float) - Resident memory of the process, in GB.
+    - heap (float) - Used JVM heap, in GB.
+    '''
+    import jpy
+    runtime = jpy.get_type('java.lang.Runtime').getRuntime()
+    heap = (runtime.totalMemory() - runtime.freeMemory()) / 1024**3
+    rss = psutil.Process().memory_info().rss / 1024**3
+    return rss, heap
+
+
+def worker_loop(task_queue, result_queue, maxProducts, maxMemory):
+    '''
+    Process scenes from task_queue until a None task is received, or until the worker should be recycled.
+
+    Input:
+    - task_queue (multiprocessing.Queue) - Tasks as (images, dataPath, pathToDem, pathToShapefile).
+    - result_queue (multiprocessing.Queue) - Messages to the parent, as (state, pid, images, output). output is the
+      output of process_scene for a done task, else None.
+    - maxProducts (int) - Number of products after which the worker is recycled.
+    - maxMemory (float) - Resident memory or JVM heap in GB after which the worker is recycled. 0 disables the check.
+    '''
+    # Importing snap_process starts the JVM, which is then reused for every scene of this worker
+    import snap_process
+    parameters = snap_process.read_processing_parameters(
+        snap_process.read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv')))
+    System = snap_process.jpy.get_type('java.lang.System')
+
+    pid = os.getpid()
+    processed = 0
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        images, dataPath, pathToDem, pathToShapefile = task
+        result_queue.put(('started', pid, images, None))
+        try:
+            output = snap_process.process_scene(images, dataPath, pathToDem, pathToShapefile, parameters)
+            result_queue.put(('done', pid, images, output))
+        except Exception as e:
+            print(f'Error processing {images}: {e}')
+            result_queue.put(('failed', pid, images, None))
+        processed += 1
+
+        # Clean up both the python and the java side before the next scene
+        gc.collect()
+        System.gc()
+        rss, heap = memory_usage()
+        print(f'Worker {pid}: {processed} products, memory {rss:.1f} GB, JVM heap {heap:.1f} GB.')
+        if processed >= maxProducts or (maxMemory > 0 and max(rss, heap) > maxMemory):
+            print(f'Recycling worker {pid}.')
+            break
+
+
+def run_workers(tasks, numWorkers, maxProducts, maxMemory, on_done=None, target=worker_loop):
+    '''
+    Process tasks with a pool of long-lived SNAP workers. Workers that exit, either because they were recycled or because
+    they crashed, are replaced as long as there are tasks left. A task whose worker dies mid-scene is counted as failed.
+    When numWorkers workers have died before starting any task, e.g. because snappy or the JVM cannot be started, no more
+    workers are started and the remaining tasks are counted as failed.
+
+    Input:
+    - tasks (iterable) - Tasks as (images, dataPath, pathToDem, pathToShapefile). Can be a generator that yields tasks as
+      they become ready, in which case the workers start processing before the last task is known.
+    - numWorkers (int) - Number of concurrent workers.
+    - maxProducts (int) - Number of products after which a worker is recycled.
+    - maxMemory (float) - Resident memory or JVM heap in GB after which a worker is recycled. 0 disables the check.
+    - on_done (function) - Optional callback, called with the state ('done' or 'failed'), the images and the output of
+      each task (see worker_loop).
+    - target (function) - The worker, worker_loop or one with the same arguments.
+
+    Output:
+    - failed (list) - The tasks that could not be processed.
+    '''
+    # Spawn instead of fork, so that no JVM state is ever shared between workers
+    context = multiprocessing.get_context('spawn')
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+
+    workers = {}
+    in_flight = {}
+    failed = []
+    counts = {'submitted': 0, 'completed': 0, 'broken': 0}
+    # Workers that have taken a task
+    started = set()
+    feeding_done = threading.Event()
+
+    def feed():
+        for task in tasks:
+            task_queue.put(task)
+            counts['submitted'] += 1
+        feeding_done.set()
+
+    if isinstance(tasks, list):
+        feed()
+    else:
+        threading.Thread(target=feed, daemon=True).start()
+
+    def start_worker():
+        process = context.Process(target=target, args=(task_queue, result_queue, maxProducts, maxMemory))
+        process.start()
+        workers[process.pid] = process
+
+    def wanted_workers():
+        # While tasks may still arrive, keep the whole pool warm
+        if not feeding_done.is_set():
+            return numWorkers
+        return min(numWorkers, counts['submitted'] - counts['completed'])
+
+    def complete(state, images, output=None):
+        counts['completed'] += 1
+        if state == 'failed':
+            failed.append(images)
+        if on_done is not None:
+            on_done(state, images, output)
+
+    def handle(message):
+        state, pid, images, output = message
+        started.add(pid)
+        if state == 'started':
+            in_flight[pid] = images
+            return
+        in_flight.pop(pid, None)
+        complete(state, images, output)
+
+    def stop_workers():
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
+        workers.clear()
+        # Tasks that the workers took before they were stopped
+        try:
+            while True:
+                handle(result_queue.get_nowait())
+        except queue.Empty:
+            pass
+        for images in list(in_flight.values()):
+            complete('failed', images)
+        in_flight.clear()
+        # The remaining tasks, also the ones that are still being fed
+        while True:
+            try:
+                complete('failed', task_queue.get(timeout=1)[0])
+            except queue.Empty:
+                if feeding_done.is_set():
+                    return
+
+    while not feeding_done.is_set() or counts['completed'] < counts['submitted']:
+        # Replace workers that have exited, and start new ones when tasks arrive
+        for pid, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            del workers[pid]
+            # Messages sent by the worker right before exiting are already in the queue
+            try:
+                while True:
+                    handle(result_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if pid in in_flight:
+                print(f'Worker {pid} died while processing {in_flight[pid]}.')
+                complete('failed', in_flight.pop(pid))
+            if pid not in started:
+                counts['broken'] += 1
+                print(f'Worker {pid} exited with code {process.exitcode} before taking a task.')
+        if counts['broken'] >= numWorkers:
+            print(f'{counts["broken"]} workers could not start, check the SNAP installation. Stopping the processing.')
+            stop_workers()
+            break
+        while len(workers) < wanted_workers():
+            start_worker()
+
+        try:
+            handle(result_queue.get(timeout=5))
+        except queue.Empty:
+            pass
+
+    # Stop the remaining workers
+    for _ in workers:
+        task_queue.put(None)
+    for process in workers.values():
+        process.join()
+
+    return failed
@@ -0,0 +1,318 @@
+'''
+Streaming alternative to running download_images.py, download_orbits.py and process_images.py one after another.
+
+Instead of waiting for every image to download, then every image to unzip, and only then starting SNAP, each product
+moves on as soon as it is ready:
+1. Products are downloaded in the order of their processing groups (consecutive slices of an orbit).
+2. Each downloaded zip is unzipped right away (or left zipped, see productAccess).
+3. When all slices of a group are extracted, its orbit files are fetched and the group is handed to the SNAP workers.
+4. When a group is processed, the images it wrote are masked for the time series (if timeseries is enabled).
+
+The stages are connected by bounded queues, and at most streamBuffer products are on the scratch disk at a time:
+a new download only starts when a processed group has freed its slot. For this to work, deleteUnprocessedImages
+should be True. timeseries.py is still run afterwards to build the databases, and skips the already masked images.
+
+Run it like process_images.py, after initialize.py and download_dem.py:
+python3 stream_pipeline.py <source_path> <data_path> <bulk_download> [identifier]
+'''
+import os, sys, threading, queue
+from concurrent.futures import ThreadPoolExecutor
+from download_images import read_arguments_from_file, authenticate, search_products, create_wkt
+from product_access import extract_product, access_options, scratch_directory
+from scene_store import fetch_product, evict, reclaim, store_directory
+from downloader import download_product, local_product
+from disk_admission import disk_admission
+from download_orbits import download_orbits_for
+from process_images import group_slices
+from processing_parameters import read_processing_parameters
+from product_cache import processed_scenes
+from scene_catalog import add_results, record_local_path, lookup_scenes, catalog_path
+from snap_worker import run_workers
+from scheduler import pool_size
+
+
+def find_target_folders(path, bulkDownload, identifier, multiTarget):
+    '''
+    List the targets whose time series are updated as images get processed.
+
+    Input:
+    - path (str) - Full path to the results folder.
+    - bulkDownload (bool) - Whether the images are downloaded in bulk.
+    - identifier (str) - The target, when not downloading in bulk.
+    - multiTarget (bool) - Whether bulk processing writes the images to the folders of the targets.
+
+    Output:
+    - targets (list) - (full path to the processed images, full path to the shapefile, full path to the masked images).
+    '''
+    if bulkDownload:
+        identifiers = [name for name in sorted(os.listdir(path))
+                       if os.path.exists(os.path.join(path, name, 'shapefile', f'{name}.shp'))]
+    else:
+        identifiers = [identifier]
+
+    targets = []
+    for name in identifiers:
+        if not bulkDownload or multiTarget:
+            data_path = os.path.join(path, name, 'tiffs')
+        else:
+            data_path = os.path.join(path, 'tiffs')
+        targets.append((data_path, os.path.join(path, name, 'shapefile', f'{name}.shp'),
+                        os.path.join(path, name, 'masked_tiffs')))
+    return targets
+
+
+def stream(results, pathToResult, pathToDem, pathToShapefile, orbit_folder, args, targets, session, storeDir=None,
+           catalogPath=None):
+    '''
+    Download, unzip and process the search results as a stream.
+
+    Input:
+    - results (ASFSearchResults) - The products to download and process.
+    - pathToResult (str) - Full path to the folder where the images are downloaded and processed.
+    - pathToDem (str) - Full path to the DEM.
+    - pathToShapefile (str) - Full path to the shapefile.
+    - orbit_folder (str) - Full path to the POEORB folder of the SNAP auxdata, or None if orbit files are not needed.
+    - args (dict) - Arguments from arguments.csv.
+    - targets (list) - Output of find_target_folders, or an empty list if no time series are made.
+    - session - Authenticated session.
+    - storeDir (str) - Full path to the shared scene store, or None to download straight to pathToResult.
+    - catalogPath (str) - Full path to the scene catalog the results were added to, or None.
+
+    Output:
+    - failed (list) - The groups that could not be processed.
+    '''
+    processes = int(args.get('processes'))
+    streamBuffer = int(args.get('streamBuffer', 10))
+    # Scenes processed on an earlier run are left out, downloaded or extracted ones skip those steps
+    processed = processed_scenes(pathToResult, read_processing_parameters(args), pathToShapefile)
+    results = results.__class__(product for product in results if product.properties['sceneName'] not in processed)
+    products = {product.properties['sceneName']: product for product in results}
+    scenes = lookup_scenes(catalogPath, products)
+    groups = group_slices(list(products), scenes=scenes)
+    largest = max([len(names) for orbit, names in groups], default=0)
+    if streamBuffer < largest:
+        print(f'streamBuffer ({streamBuffer}) is smaller than the largest slice group, using {largest}.')
+        streamBuffer = largest
+    print(f'Streaming {len(products)} images in {len(groups)} processing units.')
+
+    # Slots for products on the scratch disk, taken before a download and freed once the group is processed
+    on_disk = threading.Semaphore(streamBuffer)
+    unzip_queue = queue.Queue(maxsize=streamBuffer)
+    process_queue = queue.Queue(maxsize=streamBuffer)
+    timeseries_queue = queue.Queue()
+    group_of = {name: index for index, (orbit, names) in enumerate(groups) for name in names}
+    access = access_options(args)
+    scratch = scratch_directory() if access['toScratch'] else None
+    # Path of each extracted product, the .SAFE folder or the zip
+    extracted = {}
+    state = {'ready': {}, 'resolved': 0, 'processing': 0}
+    state_lock = threading.Lock()
+    # Products of this run that are not processed yet stay in the scene store
+    unprocessed = {product.properties['fileName'] for product in results}
+
+    def reclaim_store(needed):
+        with state_lock:
+            keep = set(unprocessed)
+        return reclaim(storeDir, needed, keep)
+
+    # Downloads wait for the space freed by processed scenes
+    admission = disk_admission(storeDir or pathToResult, args, wait=True,
+                               reclaim=reclaim_store if storeDir is not None else None,
+                               busy=lambda: state['processing'] > 0)
+    orbit_lock = threading.Lock()
+
+    def slice_ready(name, ok):
+        # Called when a slice is extracted, or when its download or extraction failed
+        index = group_of[name]
+        orbit, names = groups[index]
+        with state_lock:
+            ready = state['ready'].setdefault(index, {})
+            ready[name] = ok
+            if len(ready) < len(names):
+                return
+            state['resolved'] += 1
+            last = state['resolved'] == len(groups)
+        if all(ready.values()):
+            if orbit_folder is not None:
+                with orbit_lock:
+                    download_orbits_for([f'{name}.SAFE' for name in names], orbit_folder, scenes)
+            images = [extracted[name] for name in names]
+            with state_lock:
+                state['processing'] += 1
+            process_queue.put((images, pathToResult, pathToDem, pathToShapefile))
+        else:
+            print(f'Skipping orbit {orbit}, not all of its slices could be downloaded.')
+            for _ in names:
+                on_disk.release()
+        if last:
+            process_queue.put(None)
+
+    def download(name):
+        product = products[name]
+        local = local_product(product, pathToResult)
+        if local is not None and local.endswith('.SAFE'):
+            extracted[name] = local
+            slice_ready(name, True)
+            return
+        if local is not None:
+            unzip_queue.put((name, False))
+            return
+        try:
+            if storeDir is not None:
+                stats = fetch_product(product, storeDir, pathToResult, session,
+                                      lambda item, path, session: download_product(item, path, session,
+                                                                                   admission=admission))
+                with state_lock:
+                    keep = set(unprocessed)
+                evict(storeDir, float(args.get('sceneStoreQuota', 0)), keep)
+            else:
+                stats = download_product(product, pathToResult, session, admission=admission)
+            if catalogPath is not None:
+                record_local_path(catalogPath, name, os.path.join(storeDir or pathToResult, product.properties['fileName']))
+            # Store hits and zips already on disk hold no space for unzipping
+            unzip_queue.put((name, stats is not None and stats['reserved']))
+        except Exception as e:
+            print(f'Download of {name} failed: {e}')
+            slice_ready(name, False)
+
+    def dispatch():
+        # Downloads start in group order, so the earliest incomplete group is always completed first
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            for orbit, names in groups:
+                for name in names:
+                    on_disk.acquire()
+                    executor.submit(download, name)
+        unzip_queue.put(None)
+
+    def unzip_worker():
+        while True:
+            item = unzip_queue.get()
+            if item is None:
+                # Let the other unzip workers stop as well
+                unzip_queue.put(None)
+                return
+            name, reserved = item
+            try:
+                extracted[name] = extract_product(os.path.join(pathToResult, products[name].properties['fileName']),
+                                                  pathToResult, access['productAccess'], access['polarizations'],
+                                                  scratch)
+                ok = True
+            except Exception as e:
+                print(f'Unzipping {name} failed: {e}')
+                ok = False
+            if reserved:
+                admission.extracted(products[name].properties['bytes'])
+            slice_ready(name, ok)
+
+    def timeseries_worker():
+        # Only the outputs of finished groups are masked, the workers may still be writing others
+        from timeseries import mask_and_save_rasters
+        while True:
+            output = timeseries_queue.get()
+            if output is None:
+                return
+            written = [os.path.normpath(os.path.join(pathToResult, file))
+                       for file in (output if isinstance(output, list) else [output])]
+            for data_path, path_to_shapefile, masked_path in targets:
+                for file in written:
+                    if os.path.dirname(file) != os.path.normpath(data_path):
+                        continue
+                    try:
+                        mask_and_save_rasters(data_path, path_to_shapefile, masked_path, [os.path.basename(file)])
+                    except Exception as e:
+                        print(f'Masking {os.path.basename(file)} for {path_to_shapefile} failed: {e}')
+
+    def processed(result, images, output):
+        with state_lock:
+            state['processing'] -= 1
+            for image in images:
+                unprocessed.discard(f'{os.path.splitext(os.path.basename(image))[0]}.zip')
+        for _ in images:
+            on_disk.release()
+        if result == 'done' and output is not None and targets:
+            timeseries_queue.put(output)
+
+    threads = [threading.Thread(target=dispatch, daemon=True)]
+    threads += [threading.Thread(target=unzip_worker, daemon=True) for _ in range(access['workers'])]
+    timeseries_thread = threading.Thread(target=timeseries_worker, daemon=True)
+    for thread in threads + [timeseries_thread]:
+        thread.start()
+
+    if groups:
+        parameters = read_processing_parameters(args)
+        snapWorkers = pool_size(args.get('snapWorkers', 'auto'), parameters['memoryPerScene'],
+                                parameters['maxConcurrentScenes'])
+        failed = run_workers(iter(process_queue.get, None), snapWorkers,
+                             int(args.get('workerMaxProducts', 10)), float(args.get('workerMaxMemory', 0)),
+                             on_done=processed)
+    else:
+        failed = []
+
+    timeseries_queue.put(None)
+    timeseries_thread.join()
+    if storeDir is not None:
+        evict(storeDir, float(args.get('sceneStoreQuota', 0)), unprocessed)
+    return failed
+
+
+def main():
+    # ------- START ARGUMENT CALL --------
+    source_path = sys.argv[1]
+    path = sys.argv[2]
+    bulkDownload = sys.argv[3].lower() == 'true'
+    identifier = None
+    if not bulkDownload:
+        identifier = sys.argv[4]
+        pathToResult = os.path.join(path, identifier, 'tiffs')
+        pathToShapefile = os.path.join(path, identifier, 'shapefile', f'{identifier}.shp')
+        pathToDem = os.path.join(path, identifier, f'{identifier}_dem.tif')
+    else:
+        pathToResult = os.path.join(path, 'tiffs')
+        filename = os.path.splitext(os.path.basename(source_path))[0]
+        pathToShapefile = os.path.join(path, f'{filename}.shp')
+        pathToDem = os.path.join(path, f'{filename}_dem.tif')
+
+    args = read_arguments_from_file(os.path.join(os.path.dirname(os.getcwd()), 'arguments.csv'))
+    season = args.get('season')
+    if season != 'none':
+        season = list(map(int, season.split()))
+    else:
+        season = []
+    # Checks the arguments before anything is downloaded
+    read_processing_parameters(args, bulkDownload)
+    # ------- END ARGUMENT CALL --------
+
+    os.makedirs(pathToResult, exist_ok=True)
+    session = authenticate(os.path.dirname(store_directory(path)), float(args.get('sessionHours', 12)),
+                           max(int(args.get('processes')), int(args.get('searchWorkers', 4))))
+    results = search_products(args.get('start'), args.get('end'), season, create_wkt(pathToShapefile),
+                              args.get('beamMode'), args.get('flightDirection'), args.get('polarization'),
+                              args.get('processingLevel'), os.path.join(path, '.cache', 'search'),
+                              float(args.get('searchCacheHours', 24)), pathToShapefile,
+                              int(args.get('searchShardDays', 0)), int(args.get('searchWorkers', 4)))
+    catalogPath = catalog_path(path)
+    add_results(catalogPath, results)
+
+    # Same rule as in download_orbits.py
+    orbit_folder = None
+    if args.get('process').lower() in ['grd', 'slc', 'polsar'] or args.get('applyOrbitFile') == 'True':
+        orbit_folder = os.path.join(path, 'snap_cache/auxdata/Orbits/Sentinel-1/POEORB/S1A/')
+
+    targets = []
+    if args.get('timeseries') == 'True':
+        targets = find_target_folders(path, bulkDownload, identifier, args.get('multiTarget') == 'True')
+
+    storeDir = None
+    if args.get('sceneStore') == 'True':
+        storeDir = store_directory(path)
+        os.makedirs(storeDir, exist_ok=True)
+
+    failed = stream(results, pathToResult, pathToDem, pathToShapefile, orbit_folder, args, targets, session, storeDir,
+                    catalogPath)
+    if failed:
+        print(f'{len(failed)} processing units failed: {failed}')
+    print("All tasks completed.")
+
+
+if __name__ == "__main__":
+    main()
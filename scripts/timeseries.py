@@ -14,6 +14,7 @@ import datetime
 from scipy.stats import zscore
 import sqlite3
 import warnings
+from scene_store import run_root
 
 try:
     from fmiopendata.wfs import download_stored_query
@@ -169,7 +170,7 @@ def calculate_average_raster(df, data_path, output_folder, window):
             
             
 
-def mask_and_save_rasters(data_path, path_to_shapefile, output_folder):
+def mask_and_save_rasters(data_path, path_to_shapefile, output_folder, files=None):
     '''
     Calculates a moving average of a defined window sizwe for the processed rasters.
     
@@ -177,6 +178,7 @@ def mask_and_save_rasters(data_path, path_to_shapefile, output_folder):
     - data_path (str): Full path to the folder where the processed tiff are located.
     - path_to_shapefile (str): Full path to the shapefile to which masking is done.
     - output_folder (str): Full path to the folder to be created and where the averaged raster are saved.
+    - files (list): Names of the rasters in data_path to mask. All rasters if None.
     
     Output:
     - Folder masked_tiffs that contains all the masked rasters. Averaged non-masked rasters are deleted for brevity.
@@ -190,10 +192,16 @@ def mask_and_save_rasters(data_path, path_to_shapefile, output_folder):
         shapefile = shapefile.to_crs(epsg=3067)
     shapefile['geometry'] = shapefile.geometry.buffer(-20)
     # Get list of averaged raster files
-    files = [file for file in os.listdir(data_path) if file.endswith('.tif')]
+    if files is None:
+        files = [file for file in os.listdir(data_path) if file.endswith('.tif')]
     
     # Loop over each raster file
     for file in files:
+        # Rasters masked earlier, e.g. by the streaming pipeline, are not masked again unless they were reprocessed since
+        masked_file = os.path.join(output_folder, os.path.splitext(file)[0] + '_masked.tif')
+        if os.path.exists(masked_file) and os.path.getmtime(masked_file) >= os.path.getmtime(os.path.join(data_path, file)):
+            continue
+
         # Open the averaged raster file
         with rasterio.open(os.path.join(data_path, file)) as src:
             # Mask the raster with the shapefile
@@ -231,9 +239,10 @@ def mask_and_save_rasters(data_path, path_to_shapefile, output_folder):
                 output_tiff_file = os.path.splitext(file)[0] + '_masked.tif'
                 output_path = os.path.join(output_folder, output_tiff_file)
 
-                # Write the masked raster to a new GeoTIFF file
+                # Write the masked raster to a new GeoTIFF file. It is renamed once complete, so an interrupted write is
+                # not taken for a masked raster.
                 with rasterio.open(
-                    output_path,
+                    f'{output_path}.tmp',
                     'w',
                     driver='GTiff',
                     height=out_image.shape[1],
@@ -245,6 +254,7 @@ def mask_and_save_rasters(data_path, path_to_shapefile, output_folder):
                 ) as dst:
                     for i in range(1, src.count + 1):
                         dst.write(out_image[i - 1], i)
+                os.replace(f'{output_path}.tmp', output_path)
             
 
             # Delete the original unmasked file
@@ -1620,6 +1630,7 @@ def main():
     process = args.get('process')
     processingLevel = args.get('processingLevel')
     downloadWeather = args.get('downloadWeather') == 'True'
+    multiTarget = args.get('multiTarget') == 'True'
     
 
     if timeseries:
@@ -1630,7 +1641,8 @@ def main():
             bulkDownload = sys.argv[3].lower() == 'true'
             identifier = sys.argv[4]
 
-            if not bulkDownload:
+            # With multiTarget, bulk processing writes a subset of each image to the folder of each target
+            if not bulkDownload or multiTarget:
                 data_path = os.path.join(path,identifier,'tiffs')
             else:
                 data_path = os.path.join(path,'tiffs')
@@ -1680,7 +1692,8 @@ def main():
             # Use either ready weather data, or download them again
             if downloadWeather:
                 if bulkDownload:
-                    temperature, snows, precipitation_amount, precipitation_intensity, meteo_dates = extract_intersected_data(os.path.join(path,'weather.nc'), path_to_shapefile)
+                    # The weather of a bulk run is downloaded once, also when its clusters are processed separately
+                    temperature, snows, precipitation_amount, precipitation_intensity, meteo_dates = extract_intersected_data(os.path.join(run_root(path),'weather.nc'), path_to_shapefile)
                 else:
                     temperature, snows, precipitation_amount,precipitation_intensity, meteo_dates = find_meteorological_data(data_path, path, identifier, path_to_shapefile)
                 make_plot(path,identifier,temperature,precipitation_amount,snows,VV,VH,dates,meteo_dates, reflector)
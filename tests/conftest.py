@@ -0,0 +1,4 @@
+import os, sys
+
+# The scripts import each other as top-level modules, as they are run from the scripts folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
@@ -0,0 +1,40 @@
+import os, time
+from dem_cache import CELL_PIXELS, snap_bounds, grid_cells, cached_cells, evict
+
+
+def test_cells_are_built_once_and_empty_cells_remembered(tmp_path):
+    built = []
+
+    def build(cell_bounds, path):
+        built.append(cell_bounds)
+        # Cells west of x = 0 have no data
+        if cell_bounds[0] < 0:
+            return False
+        with open(path, 'wb') as file:
+            file.write(b'dem')
+        return True
+
+    size = CELL_PIXELS * 5.0
+    bounds = snap_bounds((-100.2, 10.3, size + 100.7, 20.1), 5.0)
+    assert bounds == (-105.0, 10.0, size + 105.0, 25.0)
+    assert [cell[:2] for cell in grid_cells(bounds, 5.0)] == [(-1, 0), (0, 0), (1, 0)]
+
+    folder = str(tmp_path / 'cells')
+    cells, count = cached_cells(folder, bounds, 5.0, build)
+    assert count == 3 and len(cells) == 2
+    cells, count = cached_cells(folder, bounds, 5.0, build)
+    assert count == 0 and [os.path.basename(path) for path, _ in cells] == ['0_0.tif', '1_0.tif']
+    assert len(built) == 3
+
+
+def test_least_recently_used_cells_are_evicted(tmp_path):
+    for index, age in enumerate([7200, 5400, 10]):
+        path = str(tmp_path / f'{index}_0.tif')
+        with open(path, 'wb') as file:
+            file.write(b'x' * 1024)
+        open(f'{path}.lock', 'w').close()
+        os.utime(path, (time.time() - age, time.time() - age))
+
+    # Room for one cell, but the cell used seconds ago is kept
+    assert evict(str(tmp_path), 1.5 / 1024**2) == 2
+    assert sorted(os.listdir(tmp_path)) == ['2_0.tif', '2_0.tif.lock']
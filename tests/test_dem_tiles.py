@@ -0,0 +1,58 @@
+import os
+import xml.etree.ElementTree as ET
+from dem_tiles import dem_source, find_tiles, index_path, update_tile_index
+
+
+def fake_tiles(tmp_path):
+    # 1 km tiles of 2 m pixels in a row, the last one at 10 m
+    folder = tmp_path / 'tiles'
+    folder.mkdir()
+    tiles = {}
+    for column, pixel in enumerate([2.0, 2.0, 10.0]):
+        path = str(folder / f'tile_{column}.tif')
+        with open(path, 'w') as file:
+            file.write(str(column))
+        tiles[path] = {'width': int(1000 / pixel), 'height': int(1000 / pixel), 'bands': 1, 'dtype': 'float32',
+                       'nodata': -9999.0, 'crs': 'EPSG:3067', 'x': 500000.0 + 1000 * column, 'y': 7001000.0,
+                       'pixel_x': pixel, 'pixel_y': pixel}
+    return str(folder), tiles
+
+
+def test_index_is_only_updated_for_changed_tiles(tmp_path):
+    folder, tiles = fake_tiles(tmp_path)
+    reads = []
+
+    def read(path):
+        reads.append(path)
+        return tiles[path]
+
+    indexPath = index_path(str(tmp_path / 'cache'), folder)
+    assert update_tile_index(folder, indexPath, read) == 3
+    assert update_tile_index(folder, indexPath, read) == 0
+
+    os.remove(os.path.join(folder, 'tile_0.tif'))
+    with open(os.path.join(folder, 'tile_1.tif'), 'w') as file:
+        file.write('changed')
+    assert update_tile_index(folder, indexPath, read) == 1
+    assert len(reads) == 4
+    assert [os.path.basename(tile['path']) for tile in find_tiles(indexPath, (501500, 7000200, 502500, 7000800))] == \
+        ['tile_1.tif', 'tile_2.tif']
+
+
+def test_mosaic_of_intersecting_tiles(tmp_path):
+    folder, tiles = fake_tiles(tmp_path)
+    cacheDir = str(tmp_path / 'cache')
+
+    source = dem_source(folder, (500200, 7000200, 501500, 7000800), cacheDir, tiles.get)
+    root = ET.parse(source).getroot()
+    assert (root.get('rasterXSize'), root.get('rasterYSize')) == ('1000', '500')
+    assert [os.path.basename(band.find('SourceFilename').text) for band in root.iter('ComplexSource')] == \
+        ['tile_0.tif', 'tile_1.tif']
+
+    # The 10 m tile is scaled to the 2 m grid
+    source = dem_source(folder, (501500, 7000200, 502500, 7000800), cacheDir, tiles.get)
+    rect = list(ET.parse(source).getroot().iter('DstRect'))[1].attrib
+    assert (float(rect['xOff']), float(rect['xSize'])) == (500.0, 500.0)
+
+    assert dem_source(folder, (600000, 7000000, 601000, 7001000), cacheDir, tiles.get) is None
+    assert dem_source(os.path.join(folder, 'tile_0.tif'), (0, 0, 1, 1), cacheDir) == os.path.join(folder, 'tile_0.tif')
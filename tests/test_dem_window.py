@@ -0,0 +1,31 @@
+import os
+import xml.etree.ElementTree as ET
+from dem_window import resolve_dem, grid_window, window_vrt
+
+
+def test_window_is_snapped_outwards_and_clipped():
+    # Grid of 5 m pixels, 100 x 200 pixels, upper left corner at (1000, 2000)
+    assert grid_window((1012, 1900, 1050, 1990), (1000, 2000), 5.0, (100, 200)) == (2, 2, 8, 18)
+    assert grid_window((990, 1400, 2100, 2010), (1000, 2000), 5.0, (100, 200)) == (0, 0, 200, 100)
+
+
+def test_vrt_points_to_window_and_dem_falls_back_to_it(tmp_path):
+    sharedPath = os.path.join(tmp_path, '.cache', 'dem', 'shared_dem.tif')
+    pathToDem = os.path.join(tmp_path, 'lake', 'lake_dem.tif')
+    os.makedirs(os.path.dirname(pathToDem))
+    assert resolve_dem(pathToDem) == pathToDem
+
+    window_vrt(sharedPath, os.path.join(tmp_path, 'lake', 'lake_dem.vrt'), (2, 3, 8, 20), (1000.0, 2000.0), 5.0,
+               'PROJCS["ETRS89 / TM35FIN(E,N)"]', 'float32')
+    assert resolve_dem(pathToDem) == os.path.join(tmp_path, 'lake', 'lake_dem.vrt')
+
+    root = ET.parse(resolve_dem(pathToDem)).getroot()
+    assert (root.get('rasterXSize'), root.get('rasterYSize')) == ('8', '20')
+    assert [float(value) for value in root.find('GeoTransform').text.split(',')] == [1010.0, 5.0, 0.0, 1985.0, 0.0, -5.0]
+    source = root.find('VRTRasterBand/SimpleSource')
+    assert source.find('SourceFilename').text == os.path.join('..', '.cache', 'dem', 'shared_dem.tif')
+    assert source.find('SrcRect').attrib == {'xOff': '2', 'yOff': '3', 'xSize': '8', 'ySize': '20'}
+
+    with open(pathToDem, 'w') as file:
+        file.write('')
+    assert resolve_dem(pathToDem) == pathToDem
@@ -0,0 +1,81 @@
+import os, errno, shutil, threading, time
+import pytest
+from disk_admission import DiskAdmission
+
+
+def test_download_waits_until_space_is_freed(tmp_path, monkeypatch):
+    free = {'bytes': 10 * 1024**3}
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(0, 0, free['bytes']))
+    admission = DiskAdmission(str(tmp_path), spaceFactor=2, wait=True, poll=0.01)
+
+    admission.acquire(4 * 1024**3, str(tmp_path / 'a.zip.part'))
+    started = threading.Event()
+    thread = threading.Thread(target=lambda: (admission.acquire(4 * 1024**3, str(tmp_path / 'b.zip.part')),
+                                              started.set()))
+    thread.start()
+    time.sleep(0.05)
+    assert not started.is_set()
+
+    # A processed scene is removed
+    free['bytes'] += 8 * 1024**3
+    thread.join(1)
+    assert started.is_set()
+
+
+def test_product_that_never_fits_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(0, 0, 3 * 1024**3))
+    admission = DiskAdmission(str(tmp_path), spaceFactor=2)
+
+    with pytest.raises(OSError, match='Not enough disk space') as error:
+        admission.acquire(2 * 1024**3, str(tmp_path / 'a.zip.part'))
+    assert error.value.errno == errno.ENOSPC
+
+
+def test_waiting_stops_when_nothing_can_free_space(tmp_path, monkeypatch):
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(0, 0, 3 * 1024**3))
+    busy = {'processing': True}
+    admission = DiskAdmission(str(tmp_path), spaceFactor=2, wait=True, poll=0.01, busy=lambda: busy['processing'])
+    failed = []
+
+    def acquire():
+        try:
+            admission.acquire(2 * 1024**3, str(tmp_path / 'a.zip.part'))
+        except OSError as e:
+            failed.append(e)
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.05)
+    # Processing may still free space
+    assert thread.is_alive()
+
+    busy['processing'] = False
+    thread.join(1)
+    assert not thread.is_alive()
+    assert failed[0].errno == errno.ENOSPC
+
+
+def test_processed_store_products_are_reclaimed(tmp_path, monkeypatch):
+    from scene_store import reclaim
+    store = tmp_path / 'store'
+    tiffs = tmp_path / 'tiffs'
+    store.mkdir()
+    tiffs.mkdir()
+    for name in ['processed.zip', 'linked.zip', 'pending.zip']:
+        (store / name).write_bytes(b'x' * 1000)
+    os.link(store / 'linked.zip', tiffs / 'linked.zip')
+
+    free = {'bytes': 0}
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(0, 0, free['bytes']))
+
+    def reclaim_store(needed):
+        freed = reclaim(str(store), needed, keep=['pending.zip'])
+        free['bytes'] += freed
+        return freed
+    admission = DiskAdmission(str(tmp_path), spaceFactor=1, wait=True, poll=0.01, reclaim=reclaim_store)
+
+    admission.acquire(1000, str(tmp_path / 'a.zip.part'))
+    assert sorted(os.listdir(store)) == ['linked.zip', 'pending.zip']
+    admission.downloaded(str(tmp_path / 'a.zip.part'))
+    with pytest.raises(OSError, match='Not enough disk space') as error:
+        admission.acquire(2000, str(tmp_path / 'b.zip.part'))
+    assert error.value.errno == errno.ENOSPC
@@ -0,0 +1,68 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('geopandas')
+from rasterio.transform import from_origin
+import os
+from download_dem import dem_pixel_size, extract_dem, write_target_dem
+from product_cache import product_key
+from processing_parameters import read_processing_parameters
+
+
+def test_pixel_size_follows_terrain_resolution():
+    assert dem_pixel_size('10.0', 2) == 5.0
+    assert dem_pixel_size(10, 0) == 2.0
+    assert dem_pixel_size(10, 10) == 2.0
+
+
+def write_source(path, data):
+    with rasterio.open(path, 'w', driver='GTiff', width=data.shape[2], height=data.shape[1], count=1, dtype='float32',
+                       crs='EPSG:3067', transform=from_origin(500000, 7000200, 2, 2), nodata=-9999) as dst:
+        dst.write(data)
+
+
+def test_dem_is_averaged_to_the_pixel_size(tmp_path):
+    source = str(tmp_path / 'dem2m.tif')
+    data = np.arange(100 * 100, dtype='float32').reshape(1, 100, 100)
+    write_source(source, data)
+
+    pathToDem = str(tmp_path / 'dem.tif')
+    assert extract_dem(source, (500000, 7000000, 500200, 7000200), pathToDem, 10.0, workers=2)
+
+    with rasterio.open(pathToDem) as dem:
+        assert (dem.width, dem.height) == (20, 20)
+        assert dem.res == (10.0, 10.0)
+        assert dem.profile['tiled']
+        assert dem.read(1)[0, 0] == pytest.approx(data[0, :5, :5].mean())
+
+
+def test_empty_dem_is_not_written(tmp_path):
+    source = str(tmp_path / 'dem2m.tif')
+    write_source(source, np.full((1, 1200, 1200), -9999, dtype='float32'))
+
+    pathToDem = str(tmp_path / 'dem.tif')
+    assert not extract_dem(source, (500000, 6997800, 502400, 7000200), pathToDem, 2.0, workers=3)
+    assert not list(tmp_path.glob('dem.tif*'))
+
+
+def test_rerun_of_the_dem_step_keeps_processed_scenes_cached(tmp_path):
+    source = str(tmp_path / 'dem2m.tif')
+    write_source(source, np.arange(100 * 100, dtype='float32').reshape(1, 100, 100))
+    bounds = (500000, 7000000, 500200, 7000200)
+    pathToDem = str(tmp_path / 'target_dem.tif')
+    images = [str(tmp_path / 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA.SAFE')]
+    parameters = read_processing_parameters({'process': 'GRD'})
+    shapefile = str(tmp_path / 'target.shp')
+
+    assert write_target_dem(source, source, bounds, pathToDem, 10.0)
+    key, _ = product_key(images, parameters, pathToDem, shapefile)
+    os.utime(pathToDem, (0, 0))
+
+    assert write_target_dem(source, source, bounds, pathToDem, 10.0)
+    assert os.path.getmtime(pathToDem) == 0
+    assert product_key(images, parameters, pathToDem, shapefile)[0] == key
+
+    # Another pixel size is another DEM
+    assert write_target_dem(source, source, bounds, pathToDem, 5.0)
+    assert product_key(images, parameters, pathToDem, shapefile)[0] != key
@@ -0,0 +1,126 @@
+import os, time, hashlib, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+pytest.importorskip('requests')
+from downloader import download_file, missing_products
+
+CONTENT = os.urandom(256 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    Serves CONTENT with Range support. The first responses are cut after dropAfter bytes, and every response waits
+    latency seconds before sending.
+    '''
+    drops = 0
+    dropAfter = None
+    latency = 0
+    ranges = []
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.ranges.append(start)
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = CONTENT[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.drops > 0:
+            type(self).drops -= 1
+            self.wfile.write(body[:self.dropAfter])
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.drops, Handler.dropAfter, Handler.latency, Handler.ranges = 0, None, 0, []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/product.zip'
+    httpd.shutdown()
+
+
+def test_dropped_connections_are_resumed(server, tmp_path):
+    Handler.drops, Handler.dropAfter, Handler.latency = 2, 64 * 1024, 0.05
+    destination = str(tmp_path / 'product.zip')
+
+    stats = download_file(server, destination, md5=hashlib.md5(CONTENT).hexdigest(), size=len(CONTENT), backoff=0,
+                          chunkSize=16 * 1024)
+
+    with open(destination, 'rb') as file:
+        assert file.read() == CONTENT
+    assert stats['attempts'] == 3
+    assert Handler.ranges == [64 * 1024, 128 * 1024]
+    assert not os.path.exists(destination + '.part')
+
+
+def test_checksum_mismatch_fails_without_leaving_a_product(server, tmp_path):
+    destination = str(tmp_path / 'product.zip')
+
+    with pytest.raises(Exception, match='MD5'):
+        download_file(server, destination, md5='0' * 32, retries=1, backoff=0)
+    assert not os.path.exists(destination) and not os.path.exists(destination + '.part')
+
+
+class Product:
+    def __init__(self, name, size=4):
+        self.properties = {'sceneName': name, 'fileName': f'{name}.zip', 'bytes': size}
+
+
+def test_only_missing_products_are_downloaded(tmp_path):
+    os.makedirs(tmp_path / 'EXTRACTED.SAFE')
+    (tmp_path / 'ZIPPED.zip').write_bytes(b'zips')
+    (tmp_path / 'PARTIAL.zip').write_bytes(b'zi')
+    results = [Product(name) for name in ['EXTRACTED', 'ZIPPED', 'PARTIAL', 'PROCESSED', 'NEW']]
+
+    missing = missing_products(results, str(tmp_path), processed={'PROCESSED'})
+
+    assert [product.properties['sceneName'] for product in missing] == ['PARTIAL', 'NEW']
+
+
+def test_space_is_only_given_back_for_reserved_downloads(tmp_path, monkeypatch):
+    import shutil, downloader
+    from disk_admission import DiskAdmission
+    from scene_store import fetch_product
+
+    class Product:
+        properties = {'fileName': 'S1A_AAAA.zip', 'sceneName': 'S1A_AAAA', 'url': 'http://example', 'bytes': 1024}
+
+    def fake_download(url, destination, session, md5=None, size=None, retries=5):
+        with open(destination, 'wb') as file:
+            file.write(b'x' * size)
+        return {'file': os.path.basename(destination), 'bytes': size, 'seconds': 1, 'MBps': 1, 'attempts': 1,
+                'resumed': 0}
+    monkeypatch.setattr(downloader, 'download_file', fake_download)
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: shutil._ntuple_diskusage(0, 0, 1024**3))
+    admission = DiskAdmission(str(tmp_path), spaceFactor=2)
+    store, first, second = tmp_path / 'store', tmp_path / 'a', tmp_path / 'b'
+    for folder in (store, first, second):
+        folder.mkdir()
+
+    def download(product, path, session):
+        return downloader.download_product(product, path, session, admission=admission)
+
+    # A new download holds the space for unzipping until it is extracted
+    stats = fetch_product(Product(), str(store), str(first), None, download)
+    assert stats['reserved'] and admission.held == 1024
+    admission.extracted(1024)
+
+    # A store hit and a zip already on disk reserve nothing, and nothing is given back for them
+    assert fetch_product(Product(), str(store), str(second), None, download) is None
+    assert not downloader.download_product(Product(), str(first), admission=admission)['reserved']
+    assert admission.held == 0
@@ -0,0 +1,37 @@
+import os
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+# download_images installs asf_search when it is missing
+pytest.importorskip('asf_search')
+from shapely.geometry import box, mapping
+from download_images import filter_by_footprint
+
+
+class Product:
+    def __init__(self, name, footprint):
+        self.geometry = mapping(footprint)
+        self.properties = {'sceneName': name, 'bytes': 1024**3}
+
+
+class Results(list):
+    pass
+
+
+def test_products_outside_every_target_are_dropped(tmp_path):
+    # Two lakes far apart, in the Finnish CRS as given by users
+    targets = gpd.GeoDataFrame({'name': ['west', 'east']},
+                               geometry=[box(21.0, 61.0, 21.1, 61.1), box(28.0, 62.0, 28.1, 62.1)],
+                               crs='epsg:4326').to_crs(epsg=3067)
+    pathToTarget = os.path.join(tmp_path, 'targets.shp')
+    targets.to_file(pathToTarget)
+
+    results = Results([Product('WEST', box(20.5, 60.5, 22.0, 61.5)),
+                       # Inside the bounding box of the targets, but between them
+                       Product('BETWEEN', box(24.0, 61.0, 25.5, 62.0)),
+                       Product('EAST', box(27.9, 61.9, 28.05, 62.05)),
+                       Product('BOTH', box(20.0, 60.0, 29.0, 63.0))])
+
+    kept = filter_by_footprint(results, pathToTarget)
+    assert isinstance(kept, Results)
+    assert [product.properties['sceneName'] for product in kept] == ['WEST', 'EAST', 'BOTH']
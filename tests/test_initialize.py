@@ -0,0 +1,50 @@
+import os
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+from shapely.geometry import box
+from initialize import cluster_targets, write_clusters
+
+
+def squares(xs, y=7000000):
+    # 100 m squares in a metric CRS
+    return gpd.GeoDataFrame({'name': [f'target_{i}' for i in range(len(xs))]},
+                            geometry=[box(x, y, x + 100, y + 100) for x in xs], crs='epsg:3067')
+
+
+def test_nearby_polygons_are_clustered():
+    # Two neighbours 5 km apart, one 12 km from them and one far away
+    assert cluster_targets(squares([300000, 305000, 317100, 400000]), 10) == [0, 0, 1, 2]
+    # Polygons within the distance through another polygon share the cluster
+    assert cluster_targets(squares([300000, 308000, 316000, 324000]), 10) == [0, 0, 0, 0]
+
+
+def test_wide_clusters_are_split_by_extent():
+    chain = squares([300000, 308000, 316000, 324000])
+    assert cluster_targets(chain, 10, clusterMaxExtent=15) == [0, 0, 1, 1]
+    # A cluster narrower than the extent is not split
+    assert cluster_targets(chain, 10, clusterMaxExtent=30) == [0, 0, 0, 0]
+
+
+def test_geographic_polygons_are_clustered_in_metres():
+    gdf = squares([300000, 305000, 400000]).to_crs('epsg:4326')
+    assert cluster_targets(gdf, 10) == [0, 0, 1]
+
+
+def test_clusters_get_bulk_folders(tmp_path):
+    source = os.path.join(tmp_path, 'targets.shp')
+    squares([300000, 305000, 400000]).to_file(source)
+    result = os.path.join(tmp_path, 'results')
+
+    write_clusters(source, result, 'name', 10)
+
+    clusters = os.path.join(result, 'clusters')
+    assert sorted(os.listdir(clusters)) == ['cluster_000', 'cluster_001', 'clusters.csv']
+    with open(os.path.join(clusters, 'clusters.csv')) as file:
+        assert file.read().split() == ['name', 'cluster', 'target_0', 'cluster_000', 'target_1', 'cluster_000',
+                                       'target_2', 'cluster_001']
+    first = gpd.read_file(os.path.join(clusters, 'cluster_000', 'cluster_000.shp'))
+    assert sorted(first['name']) == ['target_0', 'target_1']
+    assert 'cluster' not in first.columns
+    for cluster, name in [('cluster_000', 'target_0'), ('cluster_000', 'target_1'), ('cluster_001', 'target_2')]:
+        assert os.path.exists(os.path.join(clusters, cluster, name, 'shapefile', f'{name}.shp'))
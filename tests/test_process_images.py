@@ -0,0 +1,32 @@
+import os
+from process_images import plan_slice_groups
+
+
+def make_products(tmp_path, names):
+    for name in names:
+        os.makedirs(os.path.join(tmp_path, name))
+
+
+def test_consecutive_slices_are_grouped(tmp_path):
+    make_products(tmp_path, [
+        'S1A_IW_GRDH_1SDV_20210301T160025_20210301T160050_036800_045123_BBBB.SAFE',
+        'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA.SAFE',
+        'S1A_IW_GRDH_1SDV_20210301T160050_20210301T160115_036800_045123_CCCC.SAFE',
+        'S1A_IW_GRDH_1SDV_20210313T160000_20210313T160025_036975_04571F_DDDD.SAFE',
+    ])
+    plan = plan_slice_groups(str(tmp_path))
+
+    assert [len(group['images']) for group in plan] == [3, 1]
+    assert [os.path.basename(image)[-9:-5] for image in plan[0]['images']] == ['AAAA', 'BBBB', 'CCCC']
+
+
+def test_gap_splits_orbit_and_slc_names_are_parsed(tmp_path):
+    make_products(tmp_path, [
+        'S1A_IW_SLC__1SDV_20210301T160000_20210301T160027_036800_045123_AAAA.SAFE',
+        'S1A_IW_SLC__1SDV_20210301T161000_20210301T161027_036800_045123_BBBB.SAFE',
+        'S1A_IW_SLC__1SDV_20210301T160000_20210301T160027_036800_045123_AAAA.zip',
+    ])
+    plan = plan_slice_groups(str(tmp_path))
+
+    assert [group['orbit'] for group in plan] == ['036800', '036800']
+    assert all(len(group['images']) == 1 for group in plan)
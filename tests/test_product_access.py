@@ -0,0 +1,47 @@
+import os, zipfile
+from product_access import extract_product, remove_product
+
+NAME = 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA'
+MEMBERS = [
+    'manifest.safe',
+    'annotation/s1a-iw-grd-vv-20210301t160000-20210301t160025-036800-045123-001.xml',
+    'annotation/s1a-iw-grd-vh-20210301t160000-20210301t160025-036800-045123-002.xml',
+    'annotation/calibration/calibration-s1a-iw-grd-vv-20210301t160000-20210301t160025-036800-045123-001.xml',
+    'measurement/s1a-iw-grd-vv-20210301t160000-20210301t160025-036800-045123-001.tiff',
+    'measurement/s1a-iw-grd-vh-20210301t160000-20210301t160025-036800-045123-002.tiff',
+    'preview/quick-look.png',
+    'support/s1-level-1-product.xsd',
+]
+
+
+def make_zip(folder):
+    path = os.path.join(folder, f'{NAME}.zip')
+    with zipfile.ZipFile(path, 'w') as zip_ref:
+        for member in MEMBERS:
+            zip_ref.writestr(f'{NAME}.SAFE/{member}', 'x')
+    return path
+
+
+def extracted_files(product):
+    return sorted(os.path.relpath(os.path.join(root, file), product)
+                  for root, _, files in os.walk(product) for file in files)
+
+
+def test_selective_extraction_keeps_selected_polarization(tmp_path):
+    product = extract_product(make_zip(str(tmp_path)), str(tmp_path), 'selective', ['VV'])
+
+    assert product == os.path.join(str(tmp_path), f'{NAME}.SAFE')
+    assert extracted_files(product) == sorted(MEMBERS[i] for i in (0, 1, 3, 4))
+    assert os.listdir(str(tmp_path)) == [f'{NAME}.SAFE']
+
+
+def test_scratch_extraction_is_linked_and_removed(tmp_path):
+    data, scratch = tmp_path / 'tiffs', tmp_path / 'scratch'
+    data.mkdir()
+    scratch.mkdir()
+    product = extract_product(make_zip(str(data)), str(data), 'extract', scratch=str(scratch))
+
+    assert os.path.islink(product)
+    assert len(extracted_files(product)) == len(MEMBERS)
+    remove_product(product)
+    assert os.listdir(str(data)) == [] and os.listdir(str(scratch)) == []
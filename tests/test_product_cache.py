@@ -0,0 +1,74 @@
+import os
+import pytest
+from processing_parameters import read_processing_parameters
+from product_cache import product_key, lookup, record, processed_scenes
+
+
+def test_rerun_is_cached_until_processing_parameters_change(tmp_path):
+    images = [os.path.join(tmp_path, 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA.SAFE')]
+    dem = os.path.join(tmp_path, 'missing_dem.tif')
+    shapefile = os.path.join(tmp_path, 'target.shp')
+    with open(shapefile, 'wb') as file:
+        file.write(b'geometry')
+    parameters = read_processing_parameters({'process': 'GRD', 'timeseries': 'True'})
+
+    key, entry = product_key(images, parameters, dem, shapefile)
+    assert lookup(str(tmp_path), key) is None
+
+    with open(os.path.join(tmp_path, 'output_processed.tif'), 'w') as file:
+        file.write('')
+    record(str(tmp_path), key, entry, 'output_processed.tif')
+    assert lookup(str(tmp_path), key) == os.path.join(tmp_path, 'output_processed.tif')
+
+    # Post-processing parameters are not part of the key
+    rerun = read_processing_parameters({'process': 'GRD', 'timeseries': 'False'})
+    assert product_key(images, rerun, dem, shapefile)[0] == key
+
+    changed = read_processing_parameters({'process': 'SLC'})
+    assert product_key(images, changed, dem, shapefile)[0] != key
+
+
+def test_processed_scenes_match_parameters_and_target_but_not_dem(tmp_path):
+    images = [os.path.join(tmp_path, 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA.SAFE')]
+    shapefile = os.path.join(tmp_path, 'target.shp')
+    with open(shapefile, 'wb') as file:
+        file.write(b'geometry')
+    parameters = read_processing_parameters({'process': 'GRD'})
+    key, entry = product_key(images, parameters, os.path.join(tmp_path, 'dem.tif'), shapefile)
+    with open(os.path.join(tmp_path, 'output_processed.tif'), 'w') as file:
+        file.write('')
+    record(str(tmp_path), key, entry, 'output_processed.tif')
+
+    scene = 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA'
+    assert processed_scenes(str(tmp_path), parameters, shapefile) == {scene}
+    assert processed_scenes(str(tmp_path), read_processing_parameters({'process': 'SLC'}), shapefile) == set()
+
+    os.remove(os.path.join(tmp_path, 'output_processed.tif'))
+    assert processed_scenes(str(tmp_path), parameters, shapefile) == set()
+
+
+def test_multi_target_needs_bulk_download():
+    assert read_processing_parameters({'process': 'GRD', 'multiTarget': 'True'}, bulkDownload=True)['multiTarget']
+    with pytest.raises(ValueError, match='multiTarget needs bulk download'):
+        read_processing_parameters({'process': 'GRD', 'multiTarget': 'True'}, bulkDownload=False)
+
+
+def test_rewritten_dem_with_the_same_description_keeps_the_key(tmp_path):
+    from product_cache import write_dem_description
+    images = [os.path.join(tmp_path, 'S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA.SAFE')]
+    parameters = read_processing_parameters({'process': 'GRD'})
+    dem = os.path.join(tmp_path, 'target_dem.tif')
+    description = {'source': '/data/dem2m.vrt:10:1000', 'bounds': [0.0, 0.0, 100.0, 100.0], 'pixelSize': 5.0}
+    with open(dem, 'wb') as file:
+        file.write(b'dem')
+    write_dem_description(dem, description)
+    key, _ = product_key(images, parameters, dem, os.path.join(tmp_path, 'target.shp'))
+
+    # The DEM step of a rerun writes the DEM again
+    os.utime(dem, (0, 0))
+    assert product_key(images, parameters, dem, os.path.join(tmp_path, 'target.shp'))[0] == key
+
+    write_dem_description(dem, dict(description, pixelSize=2.0))
+    assert product_key(images, parameters, dem, os.path.join(tmp_path, 'target.shp'))[0] != key
+    write_dem_description(dem, None)
+    assert not os.path.exists(f'{dem}.json')
@@ -0,0 +1,55 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+# raster_output installs rasterio when it is missing
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin
+from raster_output import convert_geotiff
+
+
+def write_striped(path, width=1200, height=1000):
+    # Striped and uncompressed, like the GeoTIFFs written by SNAP
+    data = np.arange(width * height, dtype='float32').reshape(1, height, width)
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=1, dtype='float32',
+                       crs='EPSG:3067', transform=from_origin(300000, 7000000, 10, 10)) as dst:
+        dst.write(data)
+    return data
+
+
+def header(path):
+    with open(path, 'rb') as f:
+        return f.read(4)
+
+
+@pytest.mark.parametrize('outputFormat', ['tiled', 'COG'])
+def test_conversion_tiles_compresses_and_builds_overviews(tmp_path, outputFormat):
+    source = os.path.join(tmp_path, 'snap.tif')
+    destination = os.path.join(tmp_path, 'converted.tif')
+    data = write_striped(source)
+
+    convert_geotiff(source, destination, outputFormat)
+
+    assert not os.path.exists(source)
+    with rasterio.open(destination) as src:
+        assert src.profile['tiled']
+        assert src.block_shapes == [(512, 512)]
+        assert src.profile['compress'].upper() == 'DEFLATE'
+        assert src.overviews(1)
+        assert src.overviews(1)[0] == 2
+        assert src.crs.to_epsg() == 3067
+        assert np.array_equal(src.read(), data)
+
+
+@pytest.mark.parametrize('outputFormat', ['tiled', 'COG'])
+def test_big_tiff_setting_is_honored(tmp_path, outputFormat):
+    for bigTiff, magic in (('NO', b'II*\x00'), ('YES', b'II+\x00')):
+        source = os.path.join(tmp_path, f'snap_{bigTiff}.tif')
+        destination = os.path.join(tmp_path, f'converted_{bigTiff}.tif')
+        write_striped(source, 600, 600)
+
+        convert_geotiff(source, destination, outputFormat, compress='LZW', bigTiff=bigTiff)
+
+        assert header(destination) == magic
+        with rasterio.open(destination) as src:
+            assert src.profile['compress'].upper() == 'LZW'
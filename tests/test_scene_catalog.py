@@ -0,0 +1,53 @@
+import os, datetime
+from scene_catalog import add_results, record_local_path, lookup_scenes, find_scenes, scene_facts, catalog_path
+
+NAMES = ['S1A_IW_GRDH_1SDV_20210301T160000_20210301T160025_036800_045123_AAAA',
+         'S1A_IW_GRDH_1SDV_20210313T160000_20210313T160025_036975_04571F_BBBB']
+
+
+def feature(name, start, stop, orbit, lon):
+    return {'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[lon, 60], [lon + 2, 60], [lon + 2, 62], [lon, 62], [lon, 60]]]},
+            'properties': {'sceneName': name, 'fileName': f'{name}.zip', 'startTime': start, 'stopTime': stop,
+                           'orbit': orbit, 'pathNumber': 29, 'frameNumber': 200, 'flightDirection': 'ASCENDING',
+                           'polarization': 'VV+VH', 'processingLevel': 'GRD_HD', 'platform': 'Sentinel-1A',
+                           'bytes': 1000}}
+
+
+class Results(list):
+    def geojson(self):
+        return {'type': 'FeatureCollection', 'features': list(self)}
+
+
+def make_catalog(tmp_path):
+    path = catalog_path(str(tmp_path))
+    add_results(path, Results([
+        feature(NAMES[0], '2021-03-01T15:59:59.500Z', '2021-03-01T16:00:25.000Z', 36800, 20),
+        feature(NAMES[1], '2021-03-13T16:00:00.000Z', '2021-03-13T16:00:25.000Z', 36975, 30),
+    ]))
+    return path
+
+
+def test_facts_come_from_catalog_and_fall_back_to_name(tmp_path):
+    path = make_catalog(tmp_path)
+    record_local_path(path, f'{NAMES[0]}.zip', '/data/tiffs/AAAA.zip')
+    # Searching again keeps the local path
+    add_results(path, Results([feature(NAMES[0], '2021-03-01T15:59:59Z', '2021-03-01T16:00:25Z', 36800, 20)]))
+
+    scenes = lookup_scenes(path, [f'{NAMES[0]}.SAFE', 'S1A_IW_SLC__1SDV_20210301T160000_20210301T160027_036801_045123_CCCC.SAFE'])
+    assert list(scenes) == [NAMES[0]]
+    assert scenes[NAMES[0]]['local_path'] == '/data/tiffs/AAAA.zip'
+    assert scene_facts(f'/data/tiffs/{NAMES[0]}.SAFE', scenes) == (
+        datetime.datetime(2021, 3, 1, 15, 59, 59), datetime.datetime(2021, 3, 1, 16, 0, 25), '036800')
+    assert scene_facts('S1A_IW_SLC__1SDV_20210301T160000_20210301T160027_036801_045123_CCCC.SAFE', scenes)[2] == '036801'
+    assert lookup_scenes(os.path.join(str(tmp_path), 'missing.sqlite'), NAMES) == {}
+
+
+def test_scenes_are_found_by_time_and_area(tmp_path):
+    path = make_catalog(tmp_path)
+
+    assert [scene['product_id'] for scene in find_scenes(path)] == NAMES
+    assert [scene['product_id'] for scene in find_scenes(path, start='2021-03-10')] == [NAMES[1]]
+    assert [scene['product_id'] for scene in find_scenes(path, bounds=(21, 61, 21.5, 61.5))] == [NAMES[0]]
+    assert find_scenes(path, bounds=(25, 61, 26, 62)) == []
+    assert len(find_scenes(path, relativeOrbit=29, direction='ASCENDING')) == 2
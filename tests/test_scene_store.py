@@ -0,0 +1,61 @@
+import os
+from scene_store import fetch_product, evict, run_root, store_directory
+
+
+class Product:
+    def __init__(self, name, calls):
+        self.properties = {'fileName': f'{name}.zip'}
+        self.calls = calls
+
+
+def download(product, path, session):
+    product.calls.append(product.properties['fileName'])
+    with open(os.path.join(path, product.properties['fileName']), 'wb') as file:
+        file.write(b'x' * 1024)
+    return {'file': product.properties['fileName'], 'bytes': 1024, 'reserved': False}
+
+
+def test_product_is_downloaded_once_and_linked(tmp_path):
+    store, first, second = tmp_path / 'store', tmp_path / 'a', tmp_path / 'b'
+    for folder in (store, first, second):
+        folder.mkdir()
+    calls = []
+
+    assert fetch_product(Product('S1A_AAAA', calls), str(store), str(first), None, download)
+    assert not fetch_product(Product('S1A_AAAA', calls), str(store), str(second), None, download)
+    assert calls == ['S1A_AAAA.zip']
+    assert os.path.samefile(first / 'S1A_AAAA.zip', second / 'S1A_AAAA.zip')
+
+
+def test_least_recently_used_products_are_evicted(tmp_path):
+    calls = []
+    (tmp_path / 'store').mkdir()
+    (tmp_path / 'a').mkdir()
+    for age, name in enumerate(['S1A_NEW', 'S1A_MID', 'S1A_OLD']):
+        fetch_product(Product(name, calls), str(tmp_path / 'store'), str(tmp_path / 'a'), None, download)
+        os.utime(tmp_path / 'store' / f'{name}.zip', (1000 - age, 1000 - age))
+
+    removed = evict(str(tmp_path / 'store'), 2.5 / 1024**2, keep=['S1A_OLD.zip'])
+    assert removed == ['S1A_MID.zip']
+    # The lock goes with the product
+    assert sorted(os.listdir(tmp_path / 'store')) == ['S1A_NEW.zip', 'S1A_NEW.zip.lock', 'S1A_OLD.zip', 'S1A_OLD.zip.lock']
+
+
+def test_locked_product_is_not_evicted(tmp_path):
+    from scene_store import open_lock
+    store = tmp_path / 'store'
+    store.mkdir()
+    (store / 'S1A_BUSY.zip').write_bytes(b'x' * 1024)
+    with open_lock(str(store / 'S1A_BUSY.zip.lock')):
+        assert evict(str(store), 0.5 / 1024**2) == []
+        assert open_lock(str(store / 'S1A_BUSY.zip.lock'), blocking=False) is None
+    assert evict(str(store), 0.5 / 1024**2) == ['S1A_BUSY.zip']
+    assert os.listdir(store) == []
+
+
+def test_clusters_share_the_folder_of_the_run(tmp_path):
+    root = os.path.join(tmp_path, 'results')
+    cluster = os.path.join(root, 'clusters', 'cluster_000')
+    assert run_root(cluster) == root
+    assert run_root(root) == root
+    assert store_directory(cluster) == store_directory(root) == os.path.join(root, '.cache', 'scenes')
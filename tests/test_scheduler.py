@@ -0,0 +1,84 @@
+import os, json
+import pytest
+
+pytest.importorskip('psutil')
+import scheduler
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def test_job_limit_is_read_from_the_cgroup_of_the_process(tmp_path):
+    root = os.path.join(tmp_path, 'cgroup')
+    proc = os.path.join(tmp_path, 'proc_cgroup')
+    write(proc, '0::/slurm/uid_1/job_2/step_0/user/task_0\n')
+    # The root has no limit, the job has --mem=16G, its task is unlimited
+    write(os.path.join(root, 'memory.max'), 'max\n')
+    write(os.path.join(root, 'memory.current'), str(100 * 1024**3))
+    write(os.path.join(root, 'slurm/uid_1/job_2/memory.max'), str(16 * 1024**3))
+    write(os.path.join(root, 'slurm/uid_1/job_2/memory.current'), str(10 * 1024**3))
+    write(os.path.join(root, 'slurm/uid_1/job_2/step_0/user/task_0/memory.max'), 'max\n')
+    write(os.path.join(root, 'slurm/uid_1/job_2/step_0/user/task_0/memory.current'), str(9 * 1024**3))
+
+    folders = [folder for folder, _, _ in scheduler.cgroup_folders(proc, root)]
+    assert folders[0] == os.path.join(root, 'slurm/uid_1/job_2/step_0/user/task_0')
+    assert folders[-1] == root
+    assert scheduler.cgroup_available_memory(proc, root) == 6
+
+
+def test_cgroup_v1_memory_hierarchy(tmp_path):
+    root = os.path.join(tmp_path, 'cgroup')
+    proc = os.path.join(tmp_path, 'proc_cgroup')
+    write(proc, '4:cpu,cpuacct:/slurm/uid_1/job_3\n3:memory:/slurm/uid_1/job_3/step_batch\n0::/\n')
+    write(os.path.join(root, 'memory/slurm/uid_1/job_3/step_batch/memory.limit_in_bytes'), str(8 * 1024**3))
+    write(os.path.join(root, 'memory/slurm/uid_1/job_3/step_batch/memory.usage_in_bytes'), str(2 * 1024**3))
+
+    assert scheduler.cgroup_available_memory(proc, root) == 6
+    # Without a limit, or without cgroups, only the node limits the memory
+    write(proc, '0::/\n')
+    write(os.path.join(root, 'memory.max'), 'max\n')
+    write(os.path.join(root, 'memory.current'), '0')
+    assert scheduler.cgroup_available_memory(proc, root) is None
+    assert scheduler.cgroup_available_memory(os.path.join(tmp_path, 'missing'), root) is None
+
+
+def test_cpus_come_from_the_affinity_of_the_job(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3}, raising=False)
+    assert scheduler.allocated_cpus() == 4
+    assert scheduler.job_cpu_load([]) == 0.0
+
+
+def test_scene_is_admitted_by_memory_and_job_cpu(tmp_path, monkeypatch):
+    monkeypatch.setattr(scheduler, 'lease_directory', str(tmp_path))
+    monkeypatch.setattr(scheduler, 'available_memory', lambda: 20.0)
+    load = {'value': 0.5}
+    monkeypatch.setattr(scheduler, 'job_cpu_load', lambda leases: load['value'])
+    sleeps = []
+    monkeypatch.setattr(scheduler.time, 'sleep', lambda seconds: sleeps.append(seconds) or load.update(value=0.5))
+
+    # A scene of another live process, which has taken its memory into use
+    with open(os.path.join(tmp_path, 'running.lease'), 'w') as f:
+        json.dump({'pid': os.getpid(), 'create_time': scheduler.psutil.Process().create_time(), 'memory': 0}, f)
+    # A lease left behind by a process that died
+    with open(os.path.join(tmp_path, 'dead.lease'), 'w') as f:
+        json.dump({'pid': os.getpid(), 'create_time': 0, 'memory': 8}, f)
+
+    load['value'] = 0.99
+    lease = scheduler.acquire_slot(8, maxCpuLoad=0.95, poll=0)
+    # The scene waited once for the CPU of the job, not for the dead lease
+    assert sleeps == [0]
+    assert not os.path.exists(os.path.join(tmp_path, 'dead.lease'))
+    assert os.path.exists(lease)
+    scheduler.release_slot(lease)
+    assert not os.path.exists(lease)
+
+
+def test_pool_size_follows_the_admission_limits(monkeypatch):
+    monkeypatch.setattr(scheduler, 'available_memory', lambda: 50.0)
+    assert scheduler.pool_size('3', 8) == 3
+    assert scheduler.pool_size('auto', 8) == 6
+    assert scheduler.pool_size('auto', 8, maxConcurrentScenes=2) == 2
+    assert scheduler.pool_size('auto', 80) == 1
@@ -0,0 +1,32 @@
+import os, time
+from search_cache import cached_search
+
+FEATURE = {'type': 'Feature', 'geometry': None,
+           'properties': {'sceneName': 'S1A_AAAA', 'fileName': 'S1A_AAAA.zip', 'url': 'https://example.org/S1A_AAAA.zip'}}
+
+
+class Results(list):
+    def geojson(self):
+        return {'type': 'FeatureCollection', 'features': list(self)}
+
+
+def test_repeated_search_is_read_from_cache_until_expired(tmp_path):
+    calls = []
+
+    def search():
+        calls.append(1)
+        return Results([FEATURE])
+
+    query = {'start': '2021-03-01', 'end': '2021-04-01', 'season': []}
+    cached_search(str(tmp_path), 1, query, 'POINT (1 1)', search)
+    results = cached_search(str(tmp_path), 1, query, 'POINT (1 1)', search)
+    assert len(calls) == 1
+    assert [product.properties['sceneName'] for product in results] == ['S1A_AAAA']
+
+    cached_search(str(tmp_path), 1, query, 'POINT (2 2)', search)
+    assert len(calls) == 2
+
+    for file in os.listdir(str(tmp_path)):
+        os.utime(os.path.join(str(tmp_path), file), (time.time() - 7200, time.time() - 7200))
+    cached_search(str(tmp_path), 1, query, 'POINT (1 1)', search)
+    assert len(calls) == 3
@@ -0,0 +1,29 @@
+from search_shards import date_shards, sharded_search
+
+
+class Product:
+    def __init__(self, name):
+        self.properties = {'sceneName': name}
+
+
+def test_long_period_and_season_over_new_year_are_sharded():
+    assert date_shards('2015-01-01', '2017-03-01', [], 365) == [
+        ('2015-01-01', '2016-01-01'), ('2016-01-01', '2016-12-31'), ('2016-12-31', '2017-03-01')]
+    # DOY 274 - 59: from October to the end of February, end exclusive
+    assert date_shards('2021-01-01', '2022-06-01', [274, 59], 0) == [
+        ('2021-01-01', '2021-03-01'), ('2021-10-01', '2022-03-01')]
+
+
+def test_failed_shard_is_retried_and_duplicates_merged():
+    failures = []
+
+    def search(start, end):
+        if start == '2016-01-01' and not failures:
+            failures.append(start)
+            raise ConnectionError('dropped')
+        return [Product(f'S1A_{start}'), Product('S1A_SHARED')]
+
+    results = sharded_search([('2015-01-01', '2016-01-01'), ('2016-01-01', '2017-01-01')], search, backoff=0)
+    assert failures == ['2016-01-01']
+    assert sorted(product.properties['sceneName'] for product in results) == [
+        'S1A_2015-01-01', 'S1A_2016-01-01', 'S1A_SHARED']
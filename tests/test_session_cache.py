@@ -0,0 +1,23 @@
+import os, time, stat
+import pytest
+
+requests = pytest.importorskip('requests')
+from session_cache import save_cookies, load_cookies
+
+
+def test_login_is_reused_until_it_expires(tmp_path):
+    cachePath = str(tmp_path / 'asf_session.json')
+    session = requests.Session()
+    session.cookies.set('asf-urs', 'token', domain='.asf.alaska.edu', path='/', expires=int(time.time()) + 3600)
+    save_cookies(session, cachePath)
+    assert stat.S_IMODE(os.stat(cachePath).st_mode) == 0o600
+
+    cookies = load_cookies(cachePath, 12)
+    assert cookies.get('asf-urs', domain='.asf.alaska.edu') == 'token'
+    assert not next(iter(cookies)).is_expired()
+
+    assert load_cookies(cachePath, 0) is None
+    expired = requests.Session()
+    expired.cookies.set('asf-urs', 'token', domain='.asf.alaska.edu', path='/', expires=int(time.time()) - 1)
+    save_cookies(expired, cachePath)
+    assert load_cookies(cachePath, 12) is None
@@ -0,0 +1,21 @@
+import sys
+import pytest
+
+pytest.importorskip('psutil')
+from snap_worker import run_workers
+
+
+def exit_at_once(task_queue, result_queue, maxProducts, maxMemory):
+    # Like a worker whose snappy import or JVM fails
+    sys.exit(1)
+
+
+def test_workers_that_cannot_start_fail_the_tasks(tmp_path):
+    tasks = [([str(tmp_path / f'scene_{i}.SAFE')], str(tmp_path), 'dem.tif', 'target.shp') for i in range(4)]
+    done = []
+
+    failed = run_workers(tasks, 2, 10, 0, on_done=lambda state, images, output: done.append(state),
+                         target=exit_at_once)
+
+    assert sorted(failed) == sorted(task[0] for task in tasks)
+    assert done == ['failed'] * 4